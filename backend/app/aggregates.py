@@ -0,0 +1,571 @@
+import copy
+
+import numpy as np
+import pandas as pd
+from constants import START_TIME
+from filters import OPERATOR_MAP
+
+
+def day_ordinals(start):
+    """
+    Days since 1970-01-01 of every event start, taken from the wall-clock date
+    so tz-aware starts are counted on their local calendar day.
+    """
+    start = pd.to_datetime(start)
+
+    if start.dt.tz is not None:
+        start = start.dt.tz_localize(None)
+
+    return start.to_numpy().astype("datetime64[D]").astype(np.int64)
+
+
+def count_per_day(days):
+    """
+    Count events per calendar day with a single bincount. The counts span whole
+    years, from January 1st of the first year to December 31st of the last one,
+    so days without rain events get a 0.
+
+    Returns the day ordinal of the first bin and the counts.
+    """
+    if not len(days):
+        return 0, np.zeros(0, dtype=np.int64)
+
+    first_year, last_year = (
+        np.array([days.min(), days.max()], dtype="datetime64[D]")
+        .astype("datetime64[Y]")
+        .astype(np.int64)
+    )
+    first_day, end_day = (
+        np.array([first_year, last_year + 1], dtype="datetime64[Y]")
+        .astype("datetime64[D]")
+        .astype(np.int64)
+    )
+
+    return first_day, np.bincount(days - first_day, minlength=end_day - first_day)
+
+
+def nest_day_counts(first_day, counts):
+    """
+    Turn per-day counts into the year -> month -> day shape the frontend expects,
+    e.g. `{1979: {1: {1: 0, 2: 3, ...}, ...}, ...}`
+    """
+    dates = np.arange(first_day, first_day + len(counts)).astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+
+    years = months.astype("datetime64[Y]").astype(np.int64) + 1970
+    month_numbers = months.astype(np.int64) % 12 + 1
+    day_numbers = (dates - months.astype("datetime64[D]")).astype(np.int64) + 1
+
+    time_counts = {}
+    for year, month, day, count in zip(
+        years.tolist(), month_numbers.tolist(), day_numbers.tolist(), counts.tolist()
+    ):
+        time_counts.setdefault(year, {}).setdefault(month, {})[day] = count
+
+    return time_counts
+
+
+def trim_to_years(first_day, counts):
+    """
+    Drop the leading and trailing years without any events from per-day counts,
+    so they span the same years `count_per_day` would for those events.
+    """
+    (nonzero,) = np.nonzero(counts)
+
+    if not len(nonzero):
+        return 0, np.zeros(0, dtype=np.int64)
+
+    span_start, span_counts = count_per_day(first_day + nonzero[[0, -1]])
+    offset = span_start - first_day
+
+    return span_start, counts[offset : offset + len(span_counts)]
+
+
+RESOLUTIONS = ("year", "month", "week", "day", "hour")
+
+# nominal length of a bin, to estimate the number of bins over a time range
+RESOLUTION_SECONDS = {
+    "year": 365.2425 * 86400,
+    "month": 30.436875 * 86400,
+    "week": 7 * 86400,
+    "day": 86400,
+    "hour": 3600,
+}
+DATETIME_UNITS = {"year": "Y", "month": "M", "day": "D", "hour": "h"}
+
+# weeks start on Mondays, the first one after the epoch is 1970-01-05
+FIRST_MONDAY = 4 * 86400
+
+
+def bin_edges(resolution, start, end):
+    """
+    Start times (posix seconds, UTC) of all calendar bins of `resolution`
+    overlapping [start, end), followed by the end of the last bin.
+    """
+    if resolution == "week":
+        week = RESOLUTION_SECONDS["week"]
+        first, last = (np.array([start, end - 1]) - FIRST_MONDAY) // week
+        return np.arange(first, last + 2, dtype=np.int64) * week + FIRST_MONDAY
+
+    unit = DATETIME_UNITS[resolution]
+    first, last = np.array([start, end - 1], dtype="datetime64[s]").astype(
+        f"datetime64[{unit}]"
+    )
+    return np.arange(first, last + 2).astype("datetime64[s]").astype(np.int64)
+
+
+def choose_resolution(start, end, bins):
+    """
+    The finest resolution splitting [start, end) into at most about `bins` bins,
+    year if even that takes more.
+    """
+    for resolution in reversed(RESOLUTIONS):
+        if (end - start) / RESOLUTION_SECONDS[resolution] <= bins:
+            return resolution
+
+    return RESOLUTIONS[0]
+
+
+def count_per_bin(times, edges, weights=None):
+    """
+    Count `times` (optionally weighted) per bin between consecutive `edges`,
+    ignoring those outside of all bins.
+    """
+    bins = np.searchsorted(edges, times, side="right") - 1
+    inside = (bins >= 0) & (bins < len(edges) - 1)
+
+    counts = np.bincount(
+        bins[inside],
+        weights=None if weights is None else weights[inside],
+        minlength=len(edges) - 1,
+    )
+    return counts.astype(np.int64)
+
+
+class CountPyramid:
+    """
+    Event counts per calendar bin at every resolution, from hours up to years,
+    over the time span of the dataset. The coarser levels are summed up from
+    the hourly counts once, so the counts of any range of bins at any
+    resolution are sliced out instead of counted from the rows.
+    """
+
+    def __init__(self, start_time):
+        self.span = None
+        self._levels = {
+            resolution: (np.zeros(0, np.int64), np.zeros(0, np.int64))
+            for resolution in RESOLUTIONS
+        }
+
+        if not len(start_time):
+            return
+
+        span = (int(start_time.min()), int(start_time.max()) + 1)
+        hours = bin_edges("hour", *span)
+        self._sum_up(span, hours, count_per_bin(start_time, hours))
+
+    def _sum_up(self, span, hours, hour_counts):
+        self.span = span
+        self._levels["hour"] = (hours[:-1], hour_counts)
+
+        for resolution in RESOLUTIONS[:-1]:
+            # every coarser bin starts at a full hour, so whole hours add up to it
+            edges = bin_edges(resolution, *span)
+            self._levels[resolution] = (
+                edges[:-1],
+                count_per_bin(hours[:-1], edges, weights=hour_counts),
+            )
+
+    def extended(self, start_time):
+        """
+        Pyramid over the events of this one plus those starting at `start_time`.
+        Only the new events are counted, the coarser levels are summed up from
+        the hourly counts again.
+        """
+        if not len(start_time):
+            return self
+        if self.span is None:
+            return CountPyramid(start_time)
+
+        span = (
+            min(self.span[0], int(start_time.min())),
+            max(self.span[1], int(start_time.max()) + 1),
+        )
+        hours = bin_edges("hour", *span)
+        hour_counts = count_per_bin(start_time, hours)
+
+        previous_hours, previous_counts = self._levels["hour"]
+        offset = (previous_hours[0] - hours[0]) // RESOLUTION_SECONDS["hour"]
+        hour_counts[offset : offset + len(previous_counts)] += previous_counts
+
+        pyramid = CountPyramid(start_time[:0])
+        pyramid._sum_up(span, hours, hour_counts)
+        return pyramid
+
+    def counts(self, resolution, edges):
+        """
+        Counts of the bins of `resolution` between `edges`, as returned by
+        `bin_edges`. Bins outside of the dataset's time span have no events.
+        """
+        starts, counts = self._levels[resolution]
+
+        bins = np.searchsorted(starts, edges[:-1])
+        found = bins < len(starts)
+        found[found] = starts[bins[found]] == edges[:-1][found]
+
+        result = np.zeros(len(edges) - 1, dtype=np.int64)
+        result[found] = counts[bins[found]]
+        return result
+
+
+def _nice_edges(values, buckets):
+    # quantile edges rounded to one significant digit, so thresholds users
+    # actually type in (severity_index >= 2, area > 100) tend to fall on them
+    finite = values[np.isfinite(values)]
+
+    if not len(finite):
+        return np.zeros(0)
+
+    quantiles = np.quantile(finite, np.linspace(0, 1, buckets + 1)[1:-1])
+    return np.unique([float(f"{quantile:.1g}") for quantile in quantiles])
+
+
+def _bucket_bounds(values, buckets, count):
+    # smallest and largest value per bucket, NaN for buckets without any values
+    lower, upper = np.full(count, np.nan), np.full(count, np.nan)
+
+    values = values.astype(np.float64)
+    valid = ~np.isnan(values)
+    order = np.argsort(buckets[valid], kind="stable")
+    values, buckets = values[valid][order], buckets[valid][order]
+
+    if len(values):
+        present, starts = np.unique(buckets, return_index=True)
+        lower[present] = np.minimum.reduceat(values, starts)
+        upper[present] = np.maximum.reduceat(values, starts)
+
+    return lower, upper
+
+
+def _classify(operator, value, lower, upper):
+    """
+    Buckets with the value range [lower, upper] that satisfy `<operator> value`
+    completely (included) and not at all (excluded). Buckets that are neither
+    would need the row-level data. Empty buckets have NaN bounds and are never
+    undecided: they are excluded by every operator but "neq".
+    """
+    if operator in ("eq", "neq"):
+        only_value = (lower == value) & (upper == value)
+        without_value = ~((lower <= value) & (value <= upper))
+        return (
+            (only_value, without_value)
+            if operator == "eq"
+            else (without_value, only_value)
+        )
+
+    # all remaining operators are monotone, so checking both bounds is enough
+    at_lower = OPERATOR_MAP[operator](lower, value)
+    at_upper = OPERATOR_MAP[operator](upper, value)
+    return at_lower & at_upper, ~at_lower & ~at_upper
+
+
+def _runs(mask):
+    # start and stop indexes of all runs of True values in a boolean array
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _entries(keys, start_time, fields):
+    # sorted unique keys and the count, field sums and start_time bounds of the
+    # rows of every key
+    order = np.argsort(keys, kind="stable")
+    keys, starts = np.unique(keys[order], return_index=True)
+
+    def entry_sums(values):
+        if not len(order):
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values[order], starts)
+
+    counts = entry_sums(np.ones(len(order), dtype=np.int64))
+    sums = {
+        field: entry_sums(np.nan_to_num(values.astype(np.float64)))
+        for field, values in fields.items()
+    }
+
+    first_start_time = last_start_time = start_time[:0]
+    if len(order):
+        first_start_time = np.minimum.reduceat(start_time[order], starts)
+        last_start_time = np.maximum.reduceat(start_time[order], starts)
+
+    return keys, counts, sums, first_start_time, last_start_time
+
+
+class AggregateCube:
+    """
+    Event counts, field sums and start_time bounds per day, bucketed on the
+    filterable fields. The cube is stored sparsely, one entry per (bucket cell,
+    day) with events, sorted by cell and day and with prefix sums over the
+    entries, so any range of days within a cell is summed in constant time.
+
+    Filters are answered from the cube as long as they only cut along day and
+    bucket boundaries. Otherwise `None` is returned and the caller has to fall
+    back to the row-level data.
+    """
+
+    def __init__(self, days, start_time, fields, buckets_per_field=4):
+        self._first_day, day_span = count_per_day(days)
+        self._day_count = len(day_span)
+        day_index = days - self._first_day
+
+        # per-day start_time bounds to check whether time filters align with days
+        self._bounds = {
+            START_TIME: _bucket_bounds(start_time, day_index, self._day_count)
+        }
+
+        self._fields = list(fields)
+        self._edges = {}
+        self._nan_buckets = {}
+        shape = []
+
+        for field, values in fields.items():
+            values = values.astype(np.float64)
+            self._edges[field] = _nice_edges(values, buckets_per_field)
+            bucket_count = len(self._edges[field]) + 1
+
+            # rows without a value get their own bucket, which only "neq" selects
+            if np.isnan(values).any():
+                self._nan_buckets[field] = bucket_count
+                bucket_count += 1
+
+            shape.append(bucket_count)
+
+        self._shape = tuple(shape)
+        self._cell_buckets = dict(
+            zip(self._fields, np.unravel_index(np.arange(np.prod(shape)), shape))
+        )
+        self._cell_count = int(np.prod(shape))
+
+        cells = self._cells(fields)
+        self._set_entries(
+            *_entries(cells * self._day_count + day_index, start_time, fields)
+        )
+
+    def _cells(self, fields):
+        # the cell of every row, updating the value bounds of the buckets
+        cell = np.zeros(len(next(iter(fields.values()))), dtype=np.int64)
+
+        for field, bucket_count in zip(self._fields, self._shape):
+            values = fields[field].astype(np.float64)
+            buckets = np.searchsorted(self._edges[field], values, side="right")
+            if field in self._nan_buckets:
+                buckets[np.isnan(values)] = self._nan_buckets[field]
+
+            lower, upper = _bucket_bounds(values, buckets, bucket_count)
+            if field in self._bounds:
+                lower = np.fmin(self._bounds[field][0], lower)
+                upper = np.fmax(self._bounds[field][1], upper)
+            self._bounds[field] = (lower, upper)
+
+            cell = cell * bucket_count + buckets
+
+        return cell
+
+    def _set_entries(self, keys, counts, sums, first_start_time, last_start_time):
+        # one entry per (cell, day), sorted by cell first and day second, with
+        # prefix sums over the entries
+        self._keys = keys
+        self._first_start_time = first_start_time
+        self._last_start_time = last_start_time
+        self._count = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._sums = {
+            field: np.concatenate([[0], np.cumsum(field_sums)])
+            for field, field_sums in sums.items()
+        }
+
+    def extended(self, days, start_time, fields):
+        """
+        Cube over the events of this one plus the given ones, bucketed on the
+        same bucket edges. Only the new events are aggregated and their entries
+        merged into the existing ones. None if they don't fit into the buckets,
+        i.e. they lack a value of a field whose events had all values so far,
+        then the cube has to be built from all events again.
+        """
+        for field, values in fields.items():
+            if field not in self._nan_buckets and np.isnan(values).any():
+                return None
+
+        if not self._day_count:
+            return None
+
+        cube = copy.copy(self)
+        cube._bounds = dict(self._bounds)
+
+        # the days may now span more years, which moves the days of the entries
+        previous_last_day = self._first_day + self._day_count - 1
+        cube._first_day, day_span = count_per_day(
+            np.concatenate([[self._first_day, previous_last_day], days])
+        )
+        cube._day_count = len(day_span)
+        shift = self._first_day - cube._first_day
+
+        lower, upper = (np.full(cube._day_count, np.nan) for _ in range(2))
+        lower[shift : shift + self._day_count] = self._bounds[START_TIME][0]
+        upper[shift : shift + self._day_count] = self._bounds[START_TIME][1]
+        day_index = days - cube._first_day
+        day_lower, day_upper = _bucket_bounds(start_time, day_index, cube._day_count)
+        cube._bounds[START_TIME] = (
+            np.fmin(lower, day_lower),
+            np.fmax(upper, day_upper),
+        )
+
+        cells = cube._cells(fields)
+        keys, counts, sums, first, last = _entries(
+            cells * cube._day_count + day_index, start_time, fields
+        )
+
+        previous_keys = (self._keys // self._day_count) * cube._day_count + (
+            self._keys % self._day_count + shift
+        )
+        previous_sums = {field: np.diff(self._sums[field]) for field in fields}
+
+        # add the new entries up with existing ones of the same key and insert
+        # the others, both key arrays are sorted
+        at = np.searchsorted(previous_keys, keys)
+        existing = at < len(previous_keys)
+        existing[existing] = previous_keys[at[existing]] == keys[existing]
+        into, new = at[existing], ~existing
+
+        merged_counts = np.diff(self._count)
+        merged_counts[into] += counts[existing]
+        merged_first = np.array(self._first_start_time)
+        merged_first[into] = np.minimum(merged_first[into], first[existing])
+        merged_last = np.array(self._last_start_time)
+        merged_last[into] = np.maximum(merged_last[into], last[existing])
+        for field in fields:
+            previous_sums[field][into] += sums[field][existing]
+
+        cube._set_entries(
+            np.insert(previous_keys, at[new], keys[new]),
+            np.insert(merged_counts, at[new], counts[new]),
+            {
+                field: np.insert(previous_sums[field], at[new], sums[field][new])
+                for field in fields
+            },
+            np.insert(merged_first, at[new], first[new]),
+            np.insert(merged_last, at[new], last[new]),
+        )
+        return cube
+
+    def _select(self, predicates):
+        # selected days and cells for the predicates, None if they don't align
+        included = {
+            f: np.ones(len(lower), bool) for f, (lower, _) in self._bounds.items()
+        }
+        excluded = {
+            f: np.zeros(len(lower), bool) for f, (lower, _) in self._bounds.items()
+        }
+
+        for (field, operator, value) in predicates:
+            if field not in self._bounds:
+                return None
+
+            with np.errstate(invalid="ignore"):
+                field_included, field_excluded = _classify(
+                    operator, value, *self._bounds[field]
+                )
+
+            included[field] &= field_included
+            excluded[field] |= field_excluded
+
+        selected = {}
+        for field in self._bounds:
+            selected[field] = ~excluded[field]
+
+            if (selected[field] & ~included[field]).any():
+                return None
+
+        cells = np.ones(self._cell_count, dtype=bool)
+        for field in self._fields:
+            cells &= selected[field][self._cell_buckets[field]]
+
+        return selected[START_TIME], cells
+
+    def _entry_ranges(self, selection):
+        # [lower, upper) entry ranges of all selected (cell, run of days) pairs
+        days, cells = selection
+        run_starts, run_stops = _runs(days)
+        (cells,) = np.nonzero(cells)
+
+        cell_keys = cells[:, None] * self._day_count
+        lower = np.searchsorted(self._keys, (cell_keys + run_starts).ravel())
+        upper = np.searchsorted(self._keys, (cell_keys + run_stops).ravel())
+
+        return np.repeat(cells, len(run_starts)), lower, upper
+
+    def day_counts(self, predicates):
+        """
+        Events per day for the predicates, spanning the years with matching
+        events like `count_per_day`. None if they don't align with the cube.
+        """
+        selection = self._select(predicates)
+        if selection is None:
+            return None
+
+        _, lower, upper = self._entry_ranges(selection)
+
+        # mark the selected entries and add their counts up per day
+        marks = np.zeros(len(self._keys) + 1, dtype=np.int64)
+        np.add.at(marks, lower, 1)
+        np.add.at(marks, upper, -1)
+        entries = np.cumsum(marks[:-1]) > 0
+
+        counts = np.bincount(
+            self._keys[entries] % self._day_count,
+            weights=np.diff(self._count)[entries],
+            minlength=self._day_count,
+        ).astype(np.int64)
+
+        return trim_to_years(self._first_day, counts)
+
+    def statistics(self, predicates):
+        """
+        Count, start_time bounds and field means of the events matching the
+        predicates. None if they don't align with the cube.
+        """
+        selection = self._select(predicates)
+        if selection is None:
+            return None
+
+        cells, lower, upper = self._entry_ranges(selection)
+        cell_counts = np.bincount(
+            cells,
+            weights=self._count[upper] - self._count[lower],
+            minlength=self._cell_count,
+        )
+        count = int(cell_counts.sum())
+
+        statistics = {
+            "count": count,
+            "first_start_time": None,
+            "last_start_time": None,
+        }
+
+        if count:
+            nonempty = upper > lower
+            statistics["first_start_time"] = self._first_start_time[
+                lower[nonempty]
+            ].min()
+            statistics["last_start_time"] = self._last_start_time[
+                upper[nonempty] - 1
+            ].max()
+
+        for field in self._fields:
+            field_sum = (self._sums[field][upper] - self._sums[field][lower]).sum()
+
+            # rows without a value don't count towards the mean, like in pandas
+            valid_cells = self._cell_buckets[field] != self._nan_buckets.get(field)
+            valid_count = cell_counts[valid_cells].sum()
+
+            statistics[field] = field_sum / valid_count if valid_count else np.nan
+
+        return statistics
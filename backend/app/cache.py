@@ -0,0 +1,287 @@
+import asyncio
+import heapq
+import sys
+import time
+from asyncio import Lock
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi_cache.backends import Backend
+
+MAX_PENDING_MISSES = 1024
+
+
+@dataclass
+class Entry:
+    data: str
+    ttl_ts: int
+    size: int
+    cost: float
+    priority: float
+    # the compiled predicates the response depends on, see `tag`
+    filters: Optional[tuple] = None
+
+
+def endpoint_of(key):
+    # keys are built by `utils.cache_key_with_query_params` as
+    # "<prefix>:<namespace>:<module>:<function>:...", count them per function
+    parts = key.split(":", 4)
+    return parts[3] if len(parts) > 3 else key
+
+
+class BoundedInMemoryBackend(Backend):
+    """
+    In-memory cache backend holding at most `max_bytes` of cached responses.
+
+    Once the budget is exceeded, entries are evicted by GreedyDual-Size: every
+    entry is worth the time it took to compute per byte it occupies, plus an
+    inflation value that rises with every eviction, so entries that are cheap
+    to recompute, large or haven't been hit in a while go first.
+
+    The compute time of an entry is measured from the cache miss for its key
+    until the response is stored, which is how the `cache` decorator uses the
+    backend.
+    """
+
+    def __init__(self, max_bytes: int, clock=time.perf_counter):
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._store: Dict[str, Entry] = {}
+        self._heap = []
+        self._bytes = 0
+        self._inflation = 0.0
+        self._misses_since = {}
+        self._pending_filters = {}
+        self._invalidated_at = float("-inf")
+        self._counters = defaultdict(lambda: {"hits": 0, "misses": 0, "evictions": 0})
+        self._lock = Lock()
+
+    @property
+    def _now(self) -> int:
+        return int(time.time())
+
+    def _get(self, key: str):
+        entry = self._store.get(key)
+
+        if entry and entry.ttl_ts < self._now:
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self._counters[endpoint_of(key)]["misses"] += 1
+            self._misses_since[key] = self._clock()
+
+            # misses that are never followed by a `set` must not pile up
+            if len(self._misses_since) > MAX_PENDING_MISSES:
+                del self._misses_since[next(iter(self._misses_since))]
+
+            return None
+
+        self._counters[endpoint_of(key)]["hits"] += 1
+        self._pending_filters.pop(key, None)
+        self._prioritize(key, entry)
+        return entry
+
+    def _prioritize(self, key, entry):
+        # outdated heap items are skipped when evicting, see `_evict`
+        entry.priority = self._inflation + entry.cost / max(entry.size, 1)
+        heapq.heappush(self._heap, (entry.priority, key))
+
+        if len(self._heap) > 2 * len(self._store) + 64:
+            self._heap = [(e.priority, k) for k, e in self._store.items()]
+            heapq.heapify(self._heap)
+
+    def _remove(self, key):
+        entry = self._store.pop(key)
+        self._bytes -= entry.size
+
+    def _evict(self, size):
+        expired = [key for key, e in self._store.items() if e.ttl_ts < self._now]
+        for key in expired:
+            self._remove(key)
+
+        while self._store and self._bytes + size > self.max_bytes:
+            priority, key = heapq.heappop(self._heap)
+            entry = self._store.get(key)
+
+            if entry is None or entry.priority != priority:
+                continue
+
+            self._inflation = priority
+            self._remove(key)
+            self._counters[endpoint_of(key)]["evictions"] += 1
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[str]]:
+        async with self._lock:
+            entry = self._get(key)
+            if entry:
+                return entry.ttl_ts - self._now, entry.data
+            return 0, None
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            entry = self._get(key)
+            if entry:
+                return entry.data
+
+    async def set(self, key: str, value: str, expire: int = None):
+        async with self._lock:
+            missed_at = self._misses_since.pop(key, None)
+            filters = self._pending_filters.pop(key, None)
+            cost = self._clock() - missed_at if missed_at is not None else 0.0
+            size = sys.getsizeof(value)
+
+            # computed from the data before it changed, see `invalidate`
+            if missed_at is not None and missed_at <= self._invalidated_at:
+                return
+
+            if key in self._store:
+                self._remove(key)
+
+            # a response that doesn't fit into the whole budget is not cached
+            if size > self.max_bytes:
+                return
+
+            self._evict(size)
+
+            entry = Entry(value, self._now + (expire or 0), size, cost, 0.0, filters)
+            self._store[key] = entry
+            self._bytes += size
+            self._prioritize(key, entry)
+
+    async def clear(self, namespace: str = None, key: str = None) -> int:
+        async with self._lock:
+            if namespace:
+                keys = [k for k in self._store if k.startswith(namespace)]
+            elif key:
+                keys = [key] if key in self._store else []
+            else:
+                keys = list(self._store)
+
+            for k in keys:
+                self._remove(k)
+
+            return len(keys)
+
+    def tag(self, key, filters):
+        """
+        Remember the compiled predicates of the query whose response is about to
+        be stored for `key`, None if it can't tell. Called by the key builder.
+        """
+        self._pending_filters[key] = filters
+
+        if len(self._pending_filters) > MAX_PENDING_MISSES:
+            del self._pending_filters[next(iter(self._pending_filters))]
+
+    async def invalidate(self, affected: Callable) -> int:
+        """
+        Remove the entries whose responses change with the data, those whose
+        filters are `affected`, which is asked once per distinct set of filters,
+        and those without any. Responses missed before and stored after are not
+        cached either, they may have been computed from the previous data.
+        Returns the number of entries removed.
+        """
+        async with self._lock:
+            self._invalidated_at = self._clock()
+            decided = {}
+
+            def changes(entry):
+                if entry.filters is None:
+                    return True
+                if entry.filters not in decided:
+                    decided[entry.filters] = affected(entry.filters)
+                return decided[entry.filters]
+
+            keys = [key for key, entry in self._store.items() if changes(entry)]
+            for key in keys:
+                self._remove(key)
+
+            return len(keys)
+
+    def stats(self):
+        """Size of the cache and hit, miss and eviction counts per endpoint."""
+        return {
+            "max_bytes": self.max_bytes,
+            "bytes": self._bytes,
+            "entries": len(self._store),
+            "endpoints": {
+                endpoint: dict(counters)
+                for endpoint, counters in self._counters.items()
+            },
+        }
+
+
+def single_flight(key_builder: Callable):
+    """
+    Coalesce concurrent calls of an endpoint with the same key, as built by
+    `key_builder` like for the `cache` decorator: only the first call runs, all
+    calls arriving while it does await its result, including the status code
+    and headers it set on its response.
+
+    Placed above `cache`, identical requests arriving at once cause one cache
+    lookup and, on a miss, one computation instead of one each.
+    """
+
+    def wrapper(func):
+        in_flight = {}
+
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            copy_kwargs = kwargs.copy()
+            request = copy_kwargs.pop("request", None)
+            response = copy_kwargs.pop("response", None)
+
+            # conditional requests may be answered with a 304 for their own ETag
+            if request is not None and request.headers.get("if-none-match"):
+                return await func(*args, **kwargs)
+
+            key = key_builder(
+                func,
+                "",
+                request=request,
+                response=response,
+                args=args,
+                kwargs=copy_kwargs,
+            )
+
+            if key in in_flight:
+                leader_response, future = in_flight[key]
+
+                try:
+                    result = await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the leading request was cancelled, not this one: retry
+                    if future.cancelled():
+                        return await inner(*args, **kwargs)
+                    raise
+
+                if response is not None and leader_response is not None:
+                    response.status_code = leader_response.status_code
+                    response.headers.update(leader_response.headers)
+
+                return result
+
+            future = asyncio.get_running_loop().create_future()
+            in_flight[key] = (response, future)
+
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as exc:
+                future.set_exception(exc)
+                # retrieve it, so it isn't logged as unhandled without followers
+                future.exception()
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                del in_flight[key]
+
+        return inner
+
+    return wrapper
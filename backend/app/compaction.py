@@ -0,0 +1,208 @@
+"""
+Compact column dtypes for the dataset.
+
+The pickled dataset keeps 64-bit numbers and strings as Python objects. Every
+column is stored in the narrowest dtype that still holds its values exactly:
+integers in the smallest integer type covering their range, ISO 8601 strings
+as datetimes and strings repeating a few distinct values as categoricals. With
+`float32`, floats are stored in single precision even though that rounds them
+to about 7 significant digits, otherwise only if they are exact in it.
+
+Report the bytes of every column before and after compaction with:
+python -m compaction ../../dataset.df.pickle
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# "none" keeps the dtypes of the dataset as they are
+MODES = ("none", "lossless", "float32")
+
+INTEGER_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+# parses the strings of Timestamp.isoformat, with and without a UTC offset
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+ISO_LENGTH = len("2022-01-01T00:00:00")
+ISO_OFFSET_LENGTH = len("+00:00")
+
+
+def check_mode(mode):
+    if mode not in MODES:
+        raise ValueError(f'Compaction must be one of {MODES}, got "{mode}" instead')
+
+
+def compact_column(values, float32=False):
+    """
+    `values`, a Series, in the narrowest dtype holding them, see the module
+    docstring. Returns `values` itself if there is none narrower.
+    """
+    dtype = values.dtype
+
+    if not isinstance(dtype, np.dtype) or not len(values):
+        compacted = values
+    elif dtype.kind in "iu":
+        compacted = _compact_integers(values)
+    elif dtype.kind == "f":
+        compacted = _compact_floats(values, float32)
+    elif dtype.kind == "O":
+        compacted = _compact_objects(values)
+    else:
+        compacted = values
+
+    return values if compacted.dtype == dtype else compacted
+
+
+def _compact_integers(values):
+    lowest, highest = values.min(), values.max()
+
+    for dtype in INTEGER_DTYPES:
+        limits = np.iinfo(dtype)
+        if limits.min <= lowest and highest <= limits.max:
+            break
+
+    if np.dtype(dtype).itemsize >= values.dtype.itemsize:
+        return values
+
+    return values.astype(dtype)
+
+
+def _compact_floats(values, float32):
+    if values.dtype.itemsize <= 4:
+        return values
+
+    wide = values.to_numpy()
+    with np.errstate(over="ignore"):
+        narrow = wide.astype(np.float32)
+
+    if float32:
+        # rounded, but no finite value may overflow to infinity
+        fits = np.array_equal(np.isinf(narrow), np.isinf(wide))
+    else:
+        fits = np.array_equal(narrow, wide, equal_nan=True)
+
+    return pd.Series(narrow, index=values.index, name=values.name) if fits else values
+
+
+def _compact_objects(values):
+    if pd.api.types.infer_dtype(values, skipna=False) != "string":
+        return values
+
+    try:
+        dates = pd.to_datetime(values, format=ISO_FORMAT)
+    except (TypeError, ValueError, OverflowError):
+        dates = None
+
+    # only strings laid out exactly like their isoformat come back unchanged,
+    # the format parses variations like a "Z" offset or fractional seconds as well
+    if dates is not None and pd.api.types.is_datetime64_any_dtype(dates):
+        tz = getattr(dates.dtype, "tz", None)
+        length = ISO_LENGTH if tz is None else ISO_LENGTH + ISO_OFFSET_LENGTH
+        if (tz is None or str(tz) == "UTC") and (values.str.len() == length).all():
+            return dates
+
+    if values.nunique(dropna=False) <= len(values) // 2:
+        return values.astype("category")
+
+    return values
+
+
+def compact_frame(df, float32=False, keep=()):
+    """
+    `df` with every column but the `keep` ones compacted, see `compact_column`.
+    Columns that are compact already are shared with `df`, not copied.
+    """
+    columns = {
+        name: compact_column(df[name], float32=float32)
+        for name in df.columns
+        if name not in keep
+    }
+    changed = {
+        name: values
+        for name, values in columns.items()
+        if values.dtype != df[name].dtype
+    }
+
+    return df.assign(**changed) if changed else df
+
+
+def wide_dtype(dtype):
+    """
+    The dtype to bring new values into before compacting them like a column of
+    `dtype`, so values outside its range widen the column instead of wrapping.
+    """
+    if isinstance(dtype, pd.CategoricalDtype):
+        return "category"
+    if isinstance(dtype, np.dtype) and dtype.kind in "iu":
+        return np.dtype(np.int64)
+    if isinstance(dtype, np.dtype) and dtype.kind == "f":
+        return np.dtype(np.float64)
+
+    return dtype
+
+
+def concat(frames):
+    """
+    Rows of all `frames` one after the other, dtypes widened as far as needed.
+    Categorical columns stay categorical with the union of all categories.
+    """
+    df = pd.concat(frames, ignore_index=True)
+
+    for name in df.columns:
+        parts = [frame[name] for frame in frames]
+        if df[name].dtype == object and all(
+            isinstance(part.dtype, pd.CategoricalDtype) for part in parts
+        ):
+            df[name] = pd.api.types.union_categoricals(parts)
+
+    return df
+
+
+def column_usage(df):
+    """Dtype and bytes of every column, including the objects of object columns."""
+    return pd.DataFrame(
+        {
+            "dtype": df.dtypes.astype(str),
+            "bytes": df.memory_usage(index=False, deep=True),
+        }
+    )
+
+
+def memory_report(before, after):
+    """
+    Side by side `column_usage` before and after compaction, with the totals as
+    the last row.
+    """
+    report = before.join(after, lsuffix="_before", rsuffix="_after", how="outer")
+    report.loc[("total", ""), :] = ["", before["bytes"].sum(), "", after["bytes"].sum()]
+    report["saved"] = 1 - report["bytes_after"] / report["bytes_before"]
+
+    return report
+
+
+if __name__ == "__main__":
+    from models import DataFrameDBClient
+
+    parser = argparse.ArgumentParser(
+        description="Report the bytes of every column before and after compaction"
+    )
+    parser.add_argument("dataset_path", help="gzipped pickle or columnar directory")
+    parser.add_argument("--compaction", choices=MODES[1:], default="lossless")
+    args = parser.parse_args()
+
+    # columnar datasets are loaded as they were written
+    db_client = DataFrameDBClient()
+    db_client.initialize_database_from_path(args.dataset_path, shared_directory=None)
+
+    report = memory_report(
+        db_client.memory_usage(),
+        db_client.compacted(args.compaction).memory_usage(),
+    )
+    for column in ("bytes_before", "bytes_after"):
+        report[column] = (report[column] / 2**20).round(2)
+
+    print(
+        report.rename(
+            columns={"bytes_before": "MB_before", "bytes_after": "MB_after"}
+        ).to_string(float_format=lambda value: f"{value:.2f}")
+    )
@@ -2,18 +2,40 @@ import os
 
 APP_PATH = os.path.dirname(os.path.realpath(__file__))
 DATASET_PATH = os.environ.get("DATASET_PATH", f"{APP_PATH}/../../dataset.df.pickle")
+# e.g. /dev/shm/gummistiefel, to share one copy of the dataset between workers
+SHARED_DATASET_DIR = os.environ.get("SHARED_DATASET_DIR")
+# "none", "lossless" or "float32", see `compaction`
+DATASET_COMPACTION = os.environ.get("DATASET_COMPACTION", "lossless")
 
 ONE_HOUR_IN_SECONDS = 3600
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+ROW_SET_CACHE_MAX_BYTES = int(
+    os.environ.get("ROW_SET_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", os.cpu_count() or 1))
+WORKER_QUEUE_SIZE = int(os.environ.get("WORKER_QUEUE_SIZE", 32))
+
+# bins of the overview histogram, see `aggregates.CountPyramid`
+HISTOGRAM_BINS = 200
+MAX_HISTOGRAM_BINS = 100_000
+# default size of the map cells in degrees, see `spatial.aggregate_cells`
+MAP_CELL_DEGREES = 1.0
+
+COLUMNAR_MEDIA_TYPE = "application/vnd.rainfalls.columns+json"
 
 AREA = "area"
 LENGTH = "length"
+LOCATION = "location"
 LAT = "latitude"
 LONG = "longitude"
 LAT_MAX = "latitude_max"
 LONG_MAX = "longitude_max"
 PREC_MAX = "precipitation_max"
 PREC_MEAN = "precipitation_mean"
+MEAN_LAT = "meanLat"
+MEAN_LON = "meanLon"
 SEV_INDEX = "severity_index"
 SIZE = "size"
 START_TIME = "start_time"
 STDV = "standard_deviation"
+TIMESERIES = "timeseries"
@@ -1,23 +1,29 @@
-from fastapi.openapi.utils import get_openapi
-from main import app
 import json
-import constants
 import re
 
-with open("../../frontend/src/client/openapi.json", "w+") as f:
-    json.dump(
-        get_openapi(
-            title=app.title,
-            version=app.version,
-            openapi_version=app.openapi_version,
-            description=app.description,
-            routes=app.routes,
-        ),
-        f,
-    )
+import constants
+
+
+def exported_constants():
+    """The uppercase names of `constants`, shared with the frontend."""
+    return {k: v for k, v in constants.__dict__.items() if re.match(r"^[A-Z_0-9]+$", k)}
+
+
+if __name__ == "__main__":
+    from fastapi.openapi.utils import get_openapi
+    from main import app
+
+    with open("../../frontend/src/client/openapi.json", "w+") as f:
+        json.dump(
+            get_openapi(
+                title=app.title,
+                version=app.version,
+                openapi_version=app.openapi_version,
+                description=app.description,
+                routes=app.routes,
+            ),
+            f,
+        )
 
-constants_dict = {
-    k: v for k, v in constants.__dict__.items() if re.match(r"^[A-Z_0-9]+$", k)
-}
-with open("../../frontend/src/client/_constants.json", "w+") as f:
-    json.dump(constants_dict, f, indent=2)
+    with open("../../frontend/src/client/_constants.json", "w+") as f:
+        json.dump(exported_constants(), f, indent=2)
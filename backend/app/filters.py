@@ -0,0 +1,131 @@
+import operator as op
+
+import pandas as pd
+from constants import AREA, LENGTH, LOCATION, SEV_INDEX, START_TIME
+from spatial import SPATIAL_OPERATORS, bounding_box, compile_location, contains
+from utils import datetime_to_posix_timestamp_seconds
+
+QUERYABLE_FIELDS = (AREA, LENGTH, SEV_INDEX, START_TIME)
+
+# the event location (meanLat, meanLon) is filtered by the SPATIAL_OPERATORS
+# instead, e.g. "location__within=47.3,5.9,55.0,15.0"
+FILTERABLE_FIELDS = QUERYABLE_FIELDS + (LOCATION,)
+
+# fmt: off
+OPERATOR_MAP = {
+    "lt":  op.lt,
+    "lte": op.le,
+    "gt":  op.gt,
+    "gte": op.ge,
+    "eq":  op.eq,
+    "neq": op.ne,
+}
+# fmt: on
+
+VALUE_TYPE_MAP = {
+    "start": lambda value: pd.to_datetime(value, format="%Y-%m-%dT%H:%M:%S"),
+    "start_time": lambda value: datetime_to_posix_timestamp_seconds(value),
+    "event_id": lambda value: int(value),
+}
+
+
+def check_query_filters(filters):
+    valid_fields = FILTERABLE_FIELDS
+
+    if not all([len(filter_) == 3 for filter_ in filters]):
+        raise ValueError(
+            "Invalid query filters provided. "
+            "Make sure your filters adhere to the following scheme: 'area__gte=1'"
+        )
+
+    for (field, operator, _) in filters:
+        if field not in valid_fields:
+            raise ValueError(
+                f"Attribute must be one of {valid_fields}, got {field} instead"
+            )
+
+        valid_operators = tuple(
+            SPATIAL_OPERATORS if field == LOCATION else OPERATOR_MAP
+        )
+        if operator not in valid_operators:
+            raise ValueError(
+                f'Operator must be one of {valid_operators}, got "{operator}" instead'
+            )
+
+
+def compile_filters(filters):
+    """
+    Validate raw `[field, operator, value]` filters and coerce every value to the
+    type of its column once, so the predicates can be compared directly against
+    the underlying arrays. Raises ValueError on invalid filters.
+
+    Example:
+    [["start_time", "gte", "2022-03-03T00:00:00+00:00"], ["area", "lt", "4"]]
+
+    Will compile to:
+    (("start_time", "gte", 1646265600), ("area", "lt", 4.0))
+    """
+    check_query_filters(filters)
+
+    compiled = []
+    for (field, operator, value) in filters:
+        if field == LOCATION:
+            compiled.append((field, operator, compile_location(operator, value)))
+            continue
+
+        # ensure proper value types, otherwise numpy won't do the comparisons
+        value_transformer = VALUE_TYPE_MAP.get(field, lambda value: float(value))
+        compiled.append((field, operator, value_transformer(value)))
+
+    return tuple(compiled)
+
+
+def canonical_predicates(predicates):
+    """
+    Compiled predicates sorted and without duplicates, so equivalent queries
+    compare and hash equal no matter in which order their filters were given.
+    """
+    return tuple(sorted(set(predicates)))
+
+
+def implies(predicate, other):
+    """
+    Whether every row satisfying the compiled `predicate` also satisfies `other`.
+    Conservative: False is returned whenever that can't be told from the two
+    predicates alone.
+    """
+    field, operator, value = predicate
+    other_field, other_operator, other_value = other
+
+    if field != other_field:
+        return False
+
+    if field == LOCATION:
+        # whatever lies within or near enough to a location lies in its
+        # bounding box, but not every point of that box is near the location
+        if other_operator == "within":
+            return contains(other_value, bounding_box(operator, value))
+        return predicate == other
+
+    if operator == "eq":
+        return bool(OPERATOR_MAP[other_operator](value, other_value))
+
+    if other_operator == "neq":
+        # rows without a value never satisfy `predicate` unless it's "neq" too
+        if operator == "neq":
+            return value == other_value
+        return not OPERATOR_MAP[operator](other_value, value)
+
+    for bounds, tighter in (({"gt", "gte"}, op.gt), ({"lt", "lte"}, op.lt)):
+        if operator in bounds and other_operator in bounds:
+            # a strict bound implies the non-strict one at the same value
+            if value == other_value:
+                return operator == other_operator or operator in ("gt", "lt")
+            return tighter(value, other_value)
+
+    return False
+
+
+def implies_all(predicates, others):
+    """Whether the conjunction of `predicates` implies every one of `others`."""
+    return all(any(implies(p, other) for p in predicates) for other in others)
@@ -0,0 +1,212 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from filters import implies_all
+
+
+class SortedIndex:
+    """
+    Secondary index over a single column: the permutation of row positions that
+    sorts the column ascending. Comparison predicates are resolved with a binary
+    search into that permutation, so they cost O(log n + k) instead of a full scan.
+
+    NaN values sort to the end and only ever match the "neq" operator, just like
+    the equivalent pandas comparisons.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        order: Optional[np.ndarray] = None,
+        sorted_values: Optional[np.ndarray] = None,
+    ):
+        self._order = np.argsort(values, kind="stable") if order is None else order
+        self._sorted_values = (
+            values[self._order] if sorted_values is None else sorted_values
+        )
+
+        if self._sorted_values.dtype.kind == "f":
+            self._valid_count = int(np.searchsorted(self._sorted_values, np.nan))
+        else:
+            self._valid_count = len(self._sorted_values)
+
+    def __len__(self):
+        return len(self._order)
+
+    @property
+    def order(self):
+        """The permutation of row positions that sorts the column."""
+        return self._order
+
+    @property
+    def sorted_values(self):
+        return self._sorted_values
+
+    def extended(self, values):
+        """
+        Index over the column with `values` appended, their sorted order merged
+        into this one in O(n + k log k) instead of sorting all rows again.
+        """
+        order = np.argsort(values, kind="stable")
+        sorted_values = values[order]
+
+        # values beyond the range of a compacted column widen the index as well,
+        # see `compaction`
+        dtype = np.result_type(self._sorted_values, sorted_values)
+
+        # behind the equal values already indexed, so the order stays stable
+        at = np.searchsorted(self._sorted_values, sorted_values, side="right")
+
+        return SortedIndex(
+            None,
+            order=np.insert(self._order, at, order + len(self)),
+            sorted_values=np.insert(
+                self._sorted_values.astype(dtype, copy=False), at, sorted_values
+            ),
+        )
+
+    def ranges(self, operator, value):
+        """
+        Slices into the sorted order whose rows satisfy `column <operator> value`.
+        Every operator but "neq" yields a single slice.
+        """
+        if value != value:
+            # like in pandas, NaN only ever satisfies "neq"
+            return [(0, len(self))] if operator == "neq" else [(0, 0)]
+
+        left, right = self._bounds(value)
+
+        # fmt: off
+        operator_ranges = {
+            "lt":  [(0, left)],
+            "lte": [(0, right)],
+            "gt":  [(right, self._valid_count)],
+            "gte": [(left, self._valid_count)],
+            "eq":  [(left, right)],
+            "neq": [(0, left), (right, len(self))],
+        }
+        # fmt: on
+
+        return operator_ranges[operator]
+
+    def _bounds(self, value):
+        # positions of the first valid value >= `value` and of the first one > it
+        sorted_values = self._sorted_values[: self._valid_count]
+        lower = upper = value
+
+        if sorted_values.dtype.kind in "iu":
+            # searching for a float or an out of range integer would cast the whole
+            # column first. The integers next to the value bound the same rows.
+            limits = np.iinfo(sorted_values.dtype)
+            if value < limits.min:
+                return 0, 0
+            if value > limits.max:
+                return self._valid_count, self._valid_count
+
+            lower = sorted_values.dtype.type(math.ceil(value))
+            upper = sorted_values.dtype.type(math.floor(value))
+
+        return (
+            int(np.searchsorted(sorted_values, lower, side="left")),
+            int(np.searchsorted(sorted_values, upper, side="right")),
+        )
+
+    def count(self, operator, value):
+        return sum(stop - start for start, stop in self.ranges(operator, value))
+
+    def count_all(self, conditions):
+        """
+        Number of rows satisfying all `(operator, value)` conditions at once, by
+        intersecting their slices into the sorted order.
+        """
+        ranges = [(0, len(self))]
+
+        for operator, value in conditions:
+            ranges = [
+                (max(start, other_start), min(stop, other_stop))
+                for start, stop in ranges
+                for other_start, other_stop in self.ranges(operator, value)
+                if max(start, other_start) < min(stop, other_stop)
+            ]
+
+        return sum(stop - start for start, stop in ranges)
+
+    def positions(self, operator, value):
+        """Row positions satisfying `column <operator> value`, in storage order."""
+        matches = [
+            self._order[start:stop] for start, stop in self.ranges(operator, value)
+        ]
+        return np.sort(np.concatenate(matches))
+
+
+class RowSetCache:
+    """
+    Row positions matching recently filtered predicate sets, least recently used
+    first, holding at most `max_entries` sets and `max_bytes` of positions.
+
+    Besides exact matches, `lookup` finds cached supersets of a narrower query,
+    so e.g. brushing a smaller range only has to filter the rows of the previous
+    range instead of the whole dataset.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = 256):
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, predicates):
+        """
+        The smallest cached `(predicates, positions)` whose predicates are all
+        implied by the given canonical `predicates`, None if there is none.
+        """
+        with self._lock:
+            if predicates in self._entries:
+                self._entries.move_to_end(predicates)
+                return predicates, self._entries[predicates]
+
+            supersets = [
+                (cached, positions)
+                for cached, positions in self._entries.items()
+                if implies_all(predicates, cached)
+            ]
+
+            if not supersets:
+                return None
+
+            cached, positions = min(supersets, key=lambda entry: len(entry[1]))
+            self._entries.move_to_end(cached)
+            return cached, positions
+
+    def put(self, predicates, positions):
+        # positions are shared between queries, nobody may write to them
+        positions.flags.writeable = False
+
+        with self._lock:
+            if predicates in self._entries:
+                self._bytes -= self._entries.pop(predicates).nbytes
+
+            if positions.nbytes > self._max_bytes:
+                return
+
+            self._entries[predicates] = positions
+            self._bytes += positions.nbytes
+
+            # lookups check every entry, so their number is bounded as well
+            while (
+                self._bytes > self._max_bytes or len(self._entries) > self._max_entries
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -1,36 +1,90 @@
+import asyncio
+import hmac
+import json
 import logging
-from datetime import datetime
+import os
 from typing import List, Optional
 from urllib.parse import parse_qs as parse_querystring
 
-import pandas as pd
-from constants import DATASET_PATH, ONE_HOUR_IN_SECONDS
-from fastapi import FastAPI, Query, Request, Response
+import numpy as np
+from aggregates import nest_day_counts
+from cache import BoundedInMemoryBackend, single_flight
+from constants import (
+    CACHE_MAX_BYTES,
+    DATASET_COMPACTION,
+    DATASET_PATH,
+    HISTOGRAM_BINS,
+    ONE_HOUR_IN_SECONDS,
+    SEV_INDEX,
+    WORKER_QUEUE_SIZE,
+    WORKER_THREADS,
+)
+from fastapi import Body, FastAPI, Header, Query, Request, Response
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
 from fastapi_cache.decorator import cache
+from metrics import (
+    ROW_SET_LOOKUPS,
+    Collector,
+    TimedRoute,
+    TimingMiddleware,
+    render,
+)
 from models import DataFrameDBClient
 from utils import (
     cache_key_with_query_params,
-    calc_days_in_interval,
-    datetime_to_posix_timestamp_seconds,
     extract_filters,
-    round_to_min_digits,
+    is_columnar_format,
+    isoformat,
+    spider_chart_values,
 )
+from workers import PoolSaturatedError, WorkerPool
 
 log = logging.getLogger(__name__)
+
+# bearer token for adding events and reloading the dataset, both are disabled
+# without one. Read here instead of in `constants`, which the exporter copies
+# into the frontend.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# worker processes uvicorn runs the app in, each with its own dataset and cache.
+# Set their number with WEB_CONCURRENCY instead of --workers, so it shows here.
+WORKER_PROCESSES = int(os.environ.get("WEB_CONCURRENCY", 1))
 app = FastAPI(title="Gummistiefel B")
+app.router.route_class = TimedRoute
 app.add_middleware(GZipMiddleware)
+# added last to wrap the others, so compressing is timed as well
+app.add_middleware(TimingMiddleware)
 
-db_client = DataFrameDBClient()
+db_client = DataFrameDBClient(compaction=DATASET_COMPACTION)
+
+# all filtering and aggregation runs here instead of on the event loop
+db_pool = WorkerPool(max_workers=WORKER_THREADS, max_queued=WORKER_QUEUE_SIZE)
+
+# changes of the dataset are published one after the other by replacing
+# `db_client`, queries that already started finish on the previous one
+dataset_lock = asyncio.Lock()
 
 
 @app.on_event("startup")
 async def startup_event():
     db_client.initialize_database_from_path(dataset_path=DATASET_PATH)
-    FastAPICache.init(InMemoryBackend(), prefix="cache")
+    FastAPICache.init(BoundedInMemoryBackend(max_bytes=CACHE_MAX_BYTES), prefix="cache")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    db_pool.shutdown()
+
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    log.warning(str(exc))
+    return JSONResponse(
+        {"error": "The server is busy, please try again shortly."},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
 
 
 @app.get("/")
@@ -38,6 +92,68 @@ async def hello_world():
     return {"Hello": "World"}
 
 
+@app.get("/cache-stats")
+async def cache_stats():
+    """
+    Size of the result cache and its hit, miss and eviction counts per endpoint.
+    """
+    return FastAPICache.get_backend().stats()
+
+
+def response_cache_endpoints():
+    # only BoundedInMemoryBackend counts hits and misses
+    backend = FastAPICache.get_backend()
+    return backend.stats()["endpoints"] if hasattr(backend, "stats") else {}
+
+
+def hit_ratio(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+Collector(
+    "response_cache_lookups_total",
+    "counter",
+    "Lookups in the response cache, by endpoint and result.",
+    lambda: [
+        ({"endpoint": endpoint, "result": result}, counters[key])
+        for endpoint, counters in response_cache_endpoints().items()
+        for result, key in (("hit", "hits"), ("miss", "misses"))
+    ],
+)
+Collector(
+    "response_cache_hit_ratio",
+    "gauge",
+    "Share of lookups in the response cache that were hits, by endpoint.",
+    lambda: [
+        ({"endpoint": endpoint}, hit_ratio(counters["hits"], counters["misses"]))
+        for endpoint, counters in response_cache_endpoints().items()
+    ],
+)
+Collector(
+    "row_set_cache_hit_ratio",
+    "gauge",
+    "Share of filtered queries answered from a cached row set.",
+    lambda: [
+        (
+            {},
+            hit_ratio(
+                ROW_SET_LOOKUPS.value(result="hit"),
+                ROW_SET_LOOKUPS.value(result="miss"),
+            ),
+        )
+    ],
+)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Request latencies, per-stage timings, cache hit ratios and the rows scanned
+    and returned, in the Prometheus text format.
+    """
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/detail/{id}")
 async def detail(id: int):
     data = db_client.get_event_by_id(event_id=id)
@@ -49,13 +165,18 @@ async def detail(id: int):
 
 
 @app.get("/query", response_class=JSONResponse)
+@single_flight(key_builder=cache_key_with_query_params)
 @cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
 async def query(
     request: Request,
     response: Response,
     filter_params: Optional[str] = "",
     fields: Optional[List[str]] = Query(None),
-    limit: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=0),
+    response_format: Optional[str] = Query(None, alias="format"),
+    sort_by: Optional[str] = None,
+    order: str = "asc",
+    cursor: Optional[str] = None,
 ):
     """
     Query the Database on the Fulltext Search index and return the specified fields
@@ -69,6 +190,24 @@ async def query(
     filters = [[length, lte, 1], [severity_index, gt, 0]]
     fields  = [area, length]
     limit   = 200
+
+
+    Events are filtered by location with a bounding box or a radius in km:
+    /query?location__within=<south>,<west>,<north>,<east>
+    /query?location__near=<latitude>,<longitude>,<radius_km>
+
+
+    The results are a list of records by default. Pass `format=columns` or accept
+    the columnar media type instead to get one list of values per field:
+    {count: 2, columns: {area: [1.5, 3], length: [2, 4]}}
+
+
+    Results are in storage order unless sorted by a queryable field, e.g. the top
+    100 events by severity index:
+    /query?sort_by=severity_index&order=desc&limit=100
+
+    Should more results follow, the response holds a `next_cursor`. Pass it as
+    `cursor` with otherwise unchanged parameters to get the next page.
     """
 
     query_string = filter_params or str(request.query_params)
@@ -76,25 +215,164 @@ async def query(
 
     query_params.pop("limit", None)
     query_params.pop("fields", None)
+    query_params.pop("format", None)
+    query_params.pop("sort_by", None)
+    query_params.pop("order", None)
+    query_params.pop("cursor", None)
 
     fields = fields or ["event_id", "area", "length", "severity_index", "start_time"]
     filters = extract_filters(query_params)
 
     try:
-        count, data = db_client.query_events(
+        columnar = is_columnar_format(response_format, request.headers.get("accept"))
+        count, data, next_cursor = await db_pool.run(
+            db_client.query_events,
             filters=filters,
             limit=limit,
             fields=fields,
+            columnar=columnar,
+            sort_by=sort_by,
+            order=order,
+            cursor=cursor,
+            return_cursor=True,
         )
+    except PoolSaturatedError:
+        raise
     except Exception as exc:
         log.error(str(exc))
         response.status_code = 400
         return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
 
-    return {"count": count, "results": data}
+    page = {"next_cursor": next_cursor} if next_cursor else {}
+
+    if columnar:
+        return {"count": count, "columns": data, **page}
+
+    return {"count": count, "results": data, **page}
+
+
+@app.get("/query-stream")
+async def query_stream(
+    request: Request,
+    response: Response,
+    filter_params: Optional[str] = "",
+    fields: Optional[List[str]] = Query(None),
+    limit: Optional[int] = Query(None, ge=0),
+    chunk_size: int = 10000,
+    sort_by: Optional[str] = None,
+    order: str = "asc",
+):
+    """
+    Like /query, but streams the results as newline delimited JSON while they are
+    being serialized: the first line holds the count, every following line one
+    result. Only `chunk_size` results are held in memory at a time.
+
+
+    Example URL:
+    /query-stream?severity_index__gt=0&fields=area&fields=length
+
+    Will stream:
+    {"count": 2}
+    {"area": 1.5, "length": 2}
+    {"area": 3, "length": 4}
+    """
+
+    query_string = filter_params or str(request.query_params)
+    query_params = parse_querystring(query_string)
+
+    query_params.pop("limit", None)
+    query_params.pop("fields", None)
+    query_params.pop("chunk_size", None)
+    query_params.pop("sort_by", None)
+    query_params.pop("order", None)
+
+    fields = fields or ["event_id", "area", "length", "severity_index", "start_time"]
+    filters = extract_filters(query_params)
+
+    try:
+        count, chunks = await db_pool.run(
+            db_client.stream_query_events,
+            filters=filters,
+            limit=limit,
+            fields=fields,
+            chunk_size=max(chunk_size, 1),
+            sort_by=sort_by,
+            order=order,
+        )
+    except PoolSaturatedError:
+        raise
+    except Exception as exc:
+        log.error(str(exc))
+        response.status_code = 400
+        return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
+
+    def next_lines():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return None
+
+        return "".join(json.dumps(result, default=isoformat) + "\n" for result in chunk)
+
+    # every chunk is filtered and serialized on the pool as well, a sync
+    # generator would run on the threadpool of starlette instead
+    async def lines():
+        yield json.dumps({"count": count}) + "\n"
+
+        while (text := await db_pool.run_admitted(next_lines)) is not None:
+            yield text
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/count")
+@single_flight(key_builder=cache_key_with_query_params)
+@cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
+async def count(
+    request: Request,
+    response: Response,
+    filter_params: Optional[str] = "",
+    approximate: bool = False,
+):
+    """
+    Number of events matching the filters, without returning any of them, e.g.
+    to preview the results while filters are being edited.
+
+    With `approximate`, the count is estimated from the number of events
+    matching the filters of every field on their own, as if the fields were
+    independent, with a few binary searches per field. On correlated fields the
+    estimate can be far off, the true count is only guaranteed to lie between
+    `lower` and `upper`.
+
+
+    Example URL:
+    /count?approximate=true&area__gte=100&severity_index__gt=2
+
+    Will return:
+    {count: 5120, lower: 0, upper: 10433}
+    """
+
+    query_string = filter_params or str(request.query_params)
+    query_params = parse_querystring(query_string)
+
+    query_params.pop("approximate", None)
+
+    filters = extract_filters(query_params)
+    try:
+        if approximate:
+            # a handful of binary searches, not worth a trip to the worker pool
+            return db_client.estimate_count(filters)
+
+        return {"count": await db_pool.run(db_client.count_events, filters)}
+    except PoolSaturatedError:
+        raise
+    except Exception as exc:
+        log.error(str(exc))
+        response.status_code = 400
+        return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
 
 
 @app.get("/spider")
+@single_flight(key_builder=cache_key_with_query_params)
 @cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
 async def spider(
     request: Request,
@@ -107,85 +385,296 @@ async def spider(
     query_string = filter_params or str(request.query_params)
     query_params = parse_querystring(query_string)
 
-    filters = [key.split("__") + value for key, value in query_params.items()]
+    query_params.pop("start", None)
+    query_params.pop("end", None)
+
+    filters = extract_filters(query_params)
 
     try:
-        _, data = db_client.query_events(
-            filters=filters,
-            limit=None,
-            fields=["start_time", "area", "length", "severity_index"],
+        [statistics] = await db_pool.run(
+            db_client.interval_statistics, filters, [(start, end)]
         )
+    except PoolSaturatedError:
+        raise
     except Exception as exc:
         log.error(str(exc))
         response.status_code = 400
         return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
 
-    df = pd.DataFrame(data)
+    return spider_chart_values(statistics, start, end)
+
+
+@app.get("/spider-batch")
+@single_flight(key_builder=cache_key_with_query_params)
+@cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
+async def spider_batch(
+    request: Request,
+    response: Response,
+    intervals: List[str] = Query(["/"]),
+    filter_params: Optional[str] = "",
+):
+    """
+    Spider chart values for several intervals at once, all sharing one set of
+    filters. Every interval is given as `<start>/<end>`, either side may be left
+    empty to use the range of the matching events instead.
+
 
-    start = start or datetime.fromtimestamp(df.iloc[0]["start_time"])
-    end = end or datetime.fromtimestamp(df.iloc[-1]["start_time"])
+    Example URL:
+    /spider-batch?intervals=/&intervals=2000-01-01T00:00:00Z/2001-01-01T00:00:00Z
+
+    Will return the values of all matching events and of those in the year 2000:
+    [{area: ..., length: ..., severity_index: ..., events_per_day: ...}, {...}]
+    """
+
+    query_string = filter_params or str(request.query_params)
+    query_params = parse_querystring(query_string)
 
-    df = df[df["start_time"] >= datetime_to_posix_timestamp_seconds(start)]
-    df = df[df["start_time"] < datetime_to_posix_timestamp_seconds(end)]
-    df = df.drop(columns=["start_time"])
-    df = df.mean(numeric_only=True).round(5)
-    df["events_per_day"] = round(len(df.index) / calc_days_in_interval([start, end]), 5)
-    df = df.apply(round_to_min_digits)
+    query_params.pop("intervals", None)
+
+    filters = extract_filters(query_params)
+    intervals = [interval.split("/", 1) for interval in intervals]
+
+    try:
+        statistics = await db_pool.run(
+            db_client.interval_statistics, filters, intervals
+        )
+    except PoolSaturatedError:
+        raise
+    except Exception as exc:
+        log.error(str(exc))
+        response.status_code = 400
+        return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
 
-    return df.to_dict()
+    return [
+        spider_chart_values(interval_statistics, start, end)
+        for interval_statistics, (start, end) in zip(statistics, intervals)
+    ]
 
 
 @app.get("/overview-histogram")
+@single_flight(key_builder=cache_key_with_query_params)
 @cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
-def overview_histogram(
+async def overview_histogram(
     request: Request,
     response: Response,
     filter_params: Optional[str] = "",
+    resolution: Optional[str] = None,
+    start: Optional[str] = "",
+    end: Optional[str] = "",
+    bins: int = HISTOGRAM_BINS,
 ):
+    """
+    Number of matching events per day, nested by year and month:
+    {1979: {1: {1: 0, 2: 3, ...}, ...}, ...}
+
+    Given a `resolution` (year, month, week, day or hour), the events are
+    counted per bin of that size instead, only for the bins overlapping the
+    interval from `start` to `end`, which default to the bounds of the dataset.
+    With `resolution=auto` the finest resolution giving at most about `bins`
+    bins is chosen, so zooming in on the timeline yields finer bins.
+
+
+    Example URL:
+    /overview-histogram?resolution=auto&start=2000-01-01T00:00:00Z&end=2000-03-01T00:00:00Z
+
+    Will return the counts per day of January and February 2000:
+    {resolution: "day", start_time: [946684800, 946771200, ...], count: [3, 0, ...]}
+    """
 
     # Query data based on filters, as we do in the other endpoints
     query_string = filter_params or str(request.query_params)
     query_params = parse_querystring(query_string)
 
+    query_params.pop("resolution", None)
+    query_params.pop("start", None)
+    query_params.pop("end", None)
+    query_params.pop("bins", None)
+
     filters = extract_filters(query_params)
-    fields = ["start"]
+    try:
+        if resolution is not None:
+            resolution, bin_starts, counts = await db_pool.run(
+                db_client.count_events_per_bin,
+                filters,
+                resolution=None if resolution == "auto" else resolution,
+                start=start,
+                end=end,
+                bins=bins,
+            )
+        else:
+            first_day, counts = await db_pool.run(
+                db_client.count_events_per_day, filters
+            )
+    except PoolSaturatedError:
+        raise
+    except Exception as exc:
+        log.error(str(exc))
+        response.status_code = 400
+        return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
+
+    if resolution is not None:
+        return {
+            "resolution": resolution,
+            "start_time": bin_starts.tolist(),
+            "count": counts.tolist(),
+        }
+
+    # nest the per-day counts, days without rain events within the covered
+    # years get a 0 column
+    return await db_pool.run(nest_day_counts, first_day, counts)
+
+
+@app.get("/map-cells")
+@single_flight(key_builder=cache_key_with_query_params)
+@cache(expire=ONE_HOUR_IN_SECONDS, key_builder=cache_key_with_query_params)
+async def map_cells(
+    request: Request,
+    response: Response,
+    filter_params: Optional[str] = "",
+    cell_size: Optional[float] = None,
+    geohash: Optional[int] = None,
+):
+    """
+    Matching events binned into the cells of a lat/lon grid, for heatmaps of
+    many events. The cells are either `cell_size` degrees square, aligned to
+    latitude -90 and longitude -180, or the geohash cells of precision `geohash`,
+    by default squares of one degree. Only cells holding any events are listed,
+    with the number of events, their mean severity_index and total area.
+    Combine with a `location__within` filter to only bin the events on screen.
+
+
+    Example URL:
+    /map-cells?geohash=3&location__within=47,5,55,15
+
+    Will return the geohash cells of precision 3 over Germany:
+    {cell_height: 1.40625, cell_width: 1.40625, south: [46.40625, ...],
+    west: [4.21875, ...], geohash: ["u07", ...], count: [12, ...],
+    severity_index: [1.7, ...], area: [3021.0, ...]}
+    """
+
+    query_string = filter_params or str(request.query_params)
+    query_params = parse_querystring(query_string)
+
+    query_params.pop("cell_size", None)
+    query_params.pop("geohash", None)
 
+    filters = extract_filters(query_params)
     try:
-        _, df = db_client.query_events(
-            filters=filters,
-            fields=fields,
-            limit=None,
-            return_df=True,
+        cells = await db_pool.run(
+            db_client.aggregate_locations, filters, cell_size=cell_size, geohash=geohash
         )
+    except PoolSaturatedError:
+        raise
     except Exception as exc:
         log.error(str(exc))
         response.status_code = 400
         return {"error": f"Invalid query. Check the console for details.\n{str(exc)}"}
 
-    from calendar import month_name, monthrange
-    from collections import defaultdict
+    # cells without any severity_index have no mean
+    cells[SEV_INDEX] = [
+        None if np.isnan(value) else value for value in cells[SEV_INDEX].tolist()
+    ]
+
+    return {
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in cells.items()
+    }
+
+
+def is_admin(authorization):
+    if not ADMIN_TOKEN or authorization is None:
+        return False
+    return hmac.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}")
 
-    # nested defaultdict, so we can do things like `time_counts[1979]["January"][12] += 1`
-    # without worrying about (nested) keys not existing yet
-    time_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
 
-    # initialize time_counts dict so days without rain events get a 0 column
-    first_event, last_event = df.iloc[0], df.iloc[-1]
+async def invalidate_responses(affected):
+    # only BoundedInMemoryBackend knows the filters of its cached responses
+    backend = FastAPICache.get_backend()
+    if hasattr(backend, "invalidate"):
+        return await backend.invalidate(affected)
+    return await FastAPICache.clear()
+
+
+@app.post("/events")
+async def add_events(
+    response: Response,
+    events: List[dict] = Body(...),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Append new events, given as records with the columns of the dataset and
+    optionally their timeseries. Requires the ADMIN_TOKEN as bearer token.
+
+    Only the new events are indexed, the extended dataset then replaces the
+    current one at once, queries running meanwhile finish on the previous one.
+    Only the cached responses of queries matching any of the new events are
+    dropped.
+
+    The events are only added in memory, reloading or restarting the app drops
+    them again. Other worker processes wouldn't see them, so with more than one
+    (WEB_CONCURRENCY) adding events is rejected.
+
+    Will return the number of events added, of all events and of the cached
+    responses dropped: {added: 120, events: 1000120, invalidated: 37}
+    """
+    global db_client
+
+    if not is_admin(authorization):
+        response.status_code = 403
+        return {"error": "Adding events requires the admin token."}
+
+    if WORKER_PROCESSES > 1:
+        response.status_code = 409
+        return {
+            "error": "Adding events requires a single worker process, "
+            f"{WORKER_PROCESSES} are running."
+        }
+
+    async with dataset_lock:
+        previous = db_client
+        try:
+            client = await db_pool.run(previous.with_events, events)
+        except PoolSaturatedError:
+            raise
+        except Exception as exc:
+            log.error(str(exc))
+            response.status_code = 400
+            return {"error": f"Invalid events. Check the console for details.\n{exc}"}
+
+        db_client = client
+        offset = len(previous)
+
+        def affected(filters):
+            try:
+                return client.matches_any(filters, start=offset)
+            except ValueError:
+                # answered with an error, which doesn't depend on the events
+                return False
+
+        invalidated = await invalidate_responses(affected)
+
+    log.info("Added %s events, invalidated %s responses", len(events), invalidated)
+    return {"added": len(events), "events": len(client), "invalidated": invalidated}
+
+
+@app.post("/reload")
+async def reload(response: Response, authorization: Optional[str] = Header(None)):
+    """
+    Load the dataset from DATASET_PATH again, e.g. after it was replaced, and
+    replace the current one with it like adding events does. All cached
+    responses are dropped. Requires the ADMIN_TOKEN as bearer token.
+    """
+    global db_client
 
-    for year in range(first_event.start.year, last_event.start.year + 1):
-        for month in range(1, 13):
-            _, max_day = monthrange(year, month)
-            for day in range(1, max_day + 1):
-                time_counts[year][month][day] = 0
+    if not is_admin(authorization):
+        response.status_code = 403
+        return {"error": "Reloading the dataset requires the admin token."}
 
-    # df.iterrows()   takes ~ 8 seconds on whole df
-    # df.itertuples() takes ~ 3 seconds on whole df
-    # df.to_dict()    takes ~ 1 seconds on whole df
-    for row in df.to_dict("records"):
-        year = row["start"].year
-        month = row["start"].month
-        day = row["start"].day
+    async with dataset_lock:
+        client = DataFrameDBClient(compaction=DATASET_COMPACTION)
+        await db_pool.run(client.initialize_database_from_path, DATASET_PATH)
 
-        time_counts[year][month][day] += 1
+        db_client = client
+        invalidated = await invalidate_responses(lambda filters: True)
 
-    return time_counts
+    return {"events": len(client), "invalidated": invalidated}
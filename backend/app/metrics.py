@@ -0,0 +1,334 @@
+"""
+Per-request stage timings and Prometheus metrics.
+
+Hot paths mark their stages with `timed`, e.g.
+
+    with timed("filter"):
+        positions = ...
+
+The durations add up per stage in the RequestTimings of the current request,
+which TimingMiddleware returns in the Server-Timing header of the response and
+observes in the stage histogram. `render` writes all metrics in the Prometheus
+text format, for the /metrics endpoint.
+"""
+import asyncio
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# every metric registers itself here, in the order it is rendered
+REGISTRY = []
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        # the first bucket whose upper bound holds the value, the last one is +Inf
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self._values[key]
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+
+        for key, counts, total in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    {**labels, "le": _format_value(bound)},
+                    cumulative,
+                )
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Collector:
+    """
+    Metric whose samples are only collected when rendering, e.g. from the
+    statistics of a cache. `collect` returns `(labels, value)` pairs.
+    """
+
+    def __init__(self, name, kind, help, collect):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self._collect = collect
+        REGISTRY.append(self)
+
+    def samples(self):
+        for labels, value in self._collect():
+            yield self.name, labels, value
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request until its response is sent completely.",
+    labelnames=("endpoint",),
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests answered, by endpoint and status code.",
+    labelnames=("endpoint", "status"),
+)
+STAGE_SECONDS = Histogram(
+    "request_stage_duration_seconds",
+    "Time spent per stage of a request, like filtering or serializing.",
+    labelnames=("endpoint", "stage"),
+)
+ROWS_SCANNED = Counter(
+    "db_rows_scanned_total",
+    "Candidate rows found through an index or cached row set and filtered.",
+    labelnames=("endpoint",),
+)
+ROWS_RETURNED = Counter(
+    "db_rows_returned_total",
+    "Rows materialized for query results.",
+    labelnames=("endpoint",),
+)
+ROW_SET_LOOKUPS = Counter(
+    "row_set_cache_lookups_total",
+    "Lookups of cached row sets to filter instead of an index range.",
+    labelnames=("result",),
+)
+
+
+class RequestTimings:
+    """Accumulated seconds per stage of one request, in the order they began."""
+
+    def __init__(self):
+        self.endpoint = ""
+        self.stages = {}
+        self.responded = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def header(self):
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.3f}"
+            for stage, seconds in self.stages.items()
+        )
+
+
+_current_timings = ContextVar("request_timings", default=None)
+
+
+def record(stage, seconds):
+    """Add `seconds` to `stage` of the current request, if there is one."""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def count_rows(scanned=0, returned=0):
+    timings = _current_timings.get()
+    endpoint = timings.endpoint if timings is not None else ""
+
+    if scanned:
+        ROWS_SCANNED.inc(scanned, endpoint=endpoint)
+    if returned:
+        ROWS_RETURNED.inc(returned, endpoint=endpoint)
+
+
+class TimedRoute(APIRoute):
+    """
+    Route timing its endpoint function as the `endpoint` stage and the rest of
+    the route, mostly validating the parameters and serializing the response,
+    as the `serialize` stage.
+    """
+
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+
+        if asyncio.iscoroutinefunction(endpoint):
+
+            @wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                with timed("endpoint"):
+                    return await endpoint(*args, **kwargs)
+
+            self.dependant.call = timed_endpoint
+
+        route_handler = super().get_route_handler()
+        path = self.path
+
+        async def timed_route_handler(request):
+            timings = _current_timings.get()
+            if timings is None:
+                return await route_handler(request)
+
+            timings.endpoint = path
+            started = time.perf_counter()
+            response = await route_handler(request)
+
+            timings.responded = time.perf_counter()
+            timings.add(
+                "serialize",
+                timings.responded - started - timings.stages.get("endpoint", 0.0),
+            )
+            return response
+
+        return timed_route_handler
+
+
+class TimingMiddleware:
+    """
+    Times every request and adds the Server-Timing header to its response.
+
+    Added last, so it wraps all other middleware: the `compress` stage is the
+    time from the route returning its response until the headers go out, which
+    is spent in GZipMiddleware, and `total` is the time until then. The latency
+    histogram observes the time until the last byte of the body instead, which
+    differs for streamed responses.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                now = time.perf_counter()
+                if timings.responded is not None:
+                    timings.add("compress", now - timings.responded)
+                timings.add("total", now - started)
+
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.header())
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _current_timings.reset(token)
+
+            endpoint = timings.endpoint or "unmatched"
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=str(status))
+            for stage, seconds in timings.stages.items():
+                STAGE_SECONDS.observe(seconds, endpoint=endpoint, stage=stage)
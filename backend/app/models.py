@@ -1,30 +1,142 @@
+import copy
+import functools
 import json
 import logging
+import os
 from typing import Optional
 
+import numpy as np
 import pandas as pd
-from constants import AREA, DATASET_PATH, LENGTH, SEV_INDEX, START_TIME
-from utils import datetime_to_posix_timestamp_seconds
+from aggregates import (
+    RESOLUTION_SECONDS,
+    RESOLUTIONS,
+    AggregateCube,
+    CountPyramid,
+    bin_edges,
+    choose_resolution,
+    count_per_bin,
+    count_per_day,
+    day_ordinals,
+)
+from compaction import check_mode, column_usage, compact_frame, concat, wide_dtype
+from constants import (
+    AREA,
+    DATASET_PATH,
+    HISTOGRAM_BINS,
+    LENGTH,
+    LOCATION,
+    MAP_CELL_DEGREES,
+    MAX_HISTOGRAM_BINS,
+    MEAN_LAT,
+    MEAN_LON,
+    ROW_SET_CACHE_MAX_BYTES,
+    SEV_INDEX,
+    SHARED_DATASET_DIR,
+    START_TIME,
+    TIMESERIES,
+)
+from filters import (
+    OPERATOR_MAP,
+    QUERYABLE_FIELDS,
+    VALUE_TYPE_MAP,
+    canonical_predicates,
+    compile_filters,
+)
+from indexes import RowSetCache, SortedIndex
+from metrics import ROW_SET_LOOKUPS, count_rows, timed
+from pagination import ORDERS, decode_cursor, encode_cursor, sort_page
+from spatial import (
+    GridIndex,
+    aggregate_cells,
+    cell_dimensions,
+    geohash_names,
+    location_mask,
+)
+from storage import (
+    columnar_attributes,
+    is_columnar,
+    load_columnar,
+    save_columnar,
+    share_columnar,
+)
+from timeseries import TimeseriesStore
 
 log = logging.getLogger(__name__)
 
 
 class DataFrameDBClient:
-    def __init__(self, df: Optional[pd.DataFrame] = None):
+    def __init__(
+        self,
+        df: Optional[pd.DataFrame] = None,
+        timeseries: Optional[TimeseriesStore] = None,
+        compaction: str = "none",
+    ):
+        check_mode(compaction)
+
+        # never written to, changes to the dataset build a new client instead, see
+        # `with_events`, so queries read it directly
         self._df = df
+        self._compaction = compaction
+        self._event_id_index = None
+        self._event_id_positions = None
+        self._columns = {}
+        self._sorted_indexes = {}
+        self._locations = None
+        self._location_index = None
+        self._start_time_sorted = False
+        self._days = None
+        self._aggregates = None
+        self._timeseries = timeseries
+        self._row_sets = RowSetCache(max_bytes=ROW_SET_CACHE_MAX_BYTES)
+
+        if df is not None:
+            self._build_indexes()
 
     @property
     def df(self):
+        """
+        Read-only snapshot of the dataset, its columns share their memory with
+        the loaded ones, but writing to them raises a ValueError. Callers that
+        want to modify it make a copy first.
+        """
+        self._check_loaded()
+        return pd.DataFrame(
+            {name: _read_only(values) for name, values in self._df.items()},
+            index=self._df.index,
+            copy=False,
+        )
+
+    def __len__(self):
+        """Number of events in the dataset."""
+        self._check_loaded()
+        return len(self._df)
+
+    def clear_caches(self):
+        """Forget the row sets of previous queries, see `indexes.RowSetCache`."""
+        self._row_sets.clear()
+
+    def _check_loaded(self):
         assert self._df is not None, (
             "Dataset has not been loaded yet, "
             "please run 'initialize_database_from_path() first'"
         )
 
-        return self._df.copy(deep=True)
-
     def get_event_by_id(self, event_id: int):
-        matches = self.df.loc[self.df["event_id"] == event_id].to_dict("records")
-        return matches[0] if matches else None
+        self._check_loaded()
+        df = self._df
+        (index_position,) = self._event_id_index.get_indexer([event_id])
+
+        if index_position == -1:
+            return None
+
+        # materialize only the matching row and its slice of the timeseries
+        row_position = self._event_id_positions[index_position]
+        event = df.iloc[row_position : row_position + 1].to_dict("records")[0]
+
+        if self._timeseries is not None:
+            event[TIMESERIES] = self._timeseries.records(row_position)
+
+        return event
 
     def query_events(
         self,
@@ -38,75 +150,848 @@ class DataFrameDBClient:
             "start_time",
         ),
         return_df=False,
+        columnar=False,
+        sort_by=None,
+        order="asc",
+        cursor=None,
+        return_cursor=False,
+    ):
+        """
+        Count and results of the events matching the filters, by default in
+        storage order, or sorted by the `sort_by` field in ascending or descending
+        `order`. Results start behind `cursor`, as returned with `return_cursor`
+        for the previous page, and hold at most `limit` events.
+
+        With `return_cursor`, the cursor to the next page is returned as a third
+        value, None on the last page.
+        """
+        df, count_before_limit, rows, columns, next_cursor = self._query_rows(
+            filters, limit, fields, sort_by, order, cursor
+        )
+
+        with timed("materialize"):
+            # gather the matching rows once, and only for the relevant result fields
+            filtered_df = df.iloc[rows, columns]
+
+            if return_df:
+                return_value = filtered_df
+            elif columnar:
+                # one list of values per field, without repeating the field names
+                return_value = {
+                    field: filtered_df.iloc[:, i].tolist()
+                    for i, field in enumerate(fields)
+                }
+            else:
+                return_value = filtered_df.to_dict("records")
+
+        count_rows(returned=len(filtered_df.index))
+
+        if return_cursor:
+            return count_before_limit, return_value, next_cursor
+
+        return count_before_limit, return_value
+
+    def stream_query_events(
+        self,
+        filters,
+        limit,
+        fields=(
+            "event_id",
+            "area",
+            "length",
+            "severity_index",
+            "start_time",
+        ),
+        chunk_size=10000,
+        sort_by=None,
+        order="asc",
     ):
-        self._check_query_filters(filters)  # raises ValueError on invalid filters
-
-        # make a copy of the DataFrame for manipulation
-        filtered_df = self.df
-
-        # fmt: off
-        operator_map = {
-            "lt":  lambda df, field, value: df[df[field] <  value],
-            "lte": lambda df, field, value: df[df[field] <= value],
-            "gt":  lambda df, field, value: df[df[field] >  value],
-            "gte": lambda df, field, value: df[df[field] >= value],
-            "eq":  lambda df, field, value: df[df[field] == value],
-            "neq": lambda df, field, value: df[df[field] != value],
+        """
+        Like `query_events`, but instead of all records at once this returns a
+        generator yielding them in chunks of at most `chunk_size` records, so only
+        a single chunk is materialized at any time.
+        """
+        df, count_before_limit, rows, columns, _ = self._query_rows(
+            filters, limit, fields, sort_by, order
+        )
+
+        if isinstance(rows, slice):
+            rows = range(len(df.index))[rows]
+
+        def chunks():
+            for start in range(0, len(rows), chunk_size):
+                chunk_rows = rows[start : start + chunk_size]
+                count_rows(returned=len(chunk_rows))
+                yield df.iloc[chunk_rows, columns].to_dict("records")
+
+        return count_before_limit, chunks()
+
+    def _query_rows(
+        self, filters, limit, fields, sort_by=None, order="asc", cursor=None
+    ):
+        """
+        Snapshot, count before limit, the row and column positions of the results
+        of a query and the cursor to the next page, see `query_events`.
+        """
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        if order not in ORDERS:
+            raise ValueError(f'Order must be one of {ORDERS}, got "{order}" instead')
+
+        if sort_by is not None and sort_by not in self._columns:
+            raise ValueError(
+                f"Can only sort by one of {QUERYABLE_FIELDS}, got {sort_by} instead"
+            )
+
+        after = None if cursor is None else decode_cursor(cursor, sort_by, order)
+
+        self._check_loaded()
+        df = self._df
+        positions = self._filter_positions(predicates)
+        count_before_limit = len(df.index) if positions is None else len(positions)
+
+        if sort_by is not None:
+            if positions is None:
+                positions = np.arange(len(df.index))
+
+            with timed("sort"):
+                values = self._columns[sort_by][positions]
+                positions, remaining = sort_page(
+                    positions, values, order == "desc", limit, after
+                )
+        else:
+            # in storage order, a page starts right behind the cursor's row
+            start = 0 if after is None else after[1] + 1
+
+            if positions is None:
+                remaining = max(len(df.index) - start, 0)
+                positions = slice(start, None if limit is None else start + limit)
+            else:
+                start = int(np.searchsorted(positions, start))
+                remaining = len(positions) - start
+                positions = positions[start:][:limit]
+
+        next_cursor = None
+        if limit and remaining > limit:
+            last = positions.stop - 1 if isinstance(positions, slice) else positions[-1]
+            value = None if sort_by is None else self._columns[sort_by][last].item()
+            next_cursor = encode_cursor(
+                sort_by, order, None if value != value else value, last
+            )
+
+        # raises KeyError on unknown fields
+        field_positions = [df.columns.get_loc(field) for field in fields]
+
+        return df, count_before_limit, positions, field_positions, next_cursor
+
+    def count_events(self, filters):
+        """
+        Number of events matching the filters, without materializing any of them.
+        Filters on a single field are counted on its sorted index alone.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        conditions = self._conditions_per_field(predicates)
+        if len(conditions) == 1 and LOCATION not in conditions:
+            [(field, field_conditions)] = conditions.items()
+            return self._sorted_indexes[field].count_all(field_conditions)
+
+        with timed("aggregate"):
+            statistics = self._aggregates.statistics(predicates)
+        if statistics is not None:
+            return statistics["count"]
+
+        positions = self._filter_positions(predicates)
+        return len(self._columns[START_TIME]) if positions is None else len(positions)
+
+    def estimate_count(self, filters):
+        """
+        Estimate of the number of events matching the filters and bounds it is
+        guaranteed to lie within, from the number of events matching the filters
+        of every field on their own. Those come from the sorted indexes in
+        O(log n), or for locations as an upper bound from the spatial index.
+
+        Assuming the fields are independent, the estimate is the share of events
+        matching every field multiplied. The bounds hold for any dependence: no
+        more events match than for the most selective field, and at least those
+        that can't miss any field given how many events each field excludes.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+        total = len(self._columns[START_TIME])
+
+        estimate, lower, upper = float(total), total, total
+        for field, conditions in self._conditions_per_field(predicates).items():
+            if field == LOCATION:
+                field_lower, field_upper = 0, min(
+                    self._location_index.count(*condition) for condition in conditions
+                )
+            else:
+                field_lower = field_upper = self._sorted_indexes[field].count_all(
+                    conditions
+                )
+
+            estimate *= field_upper / total if total else 0
+            lower -= total - field_lower
+            upper = min(upper, field_upper)
+
+        lower = max(lower, 0)
+        return {
+            "count": int(np.clip(round(estimate), lower, upper)),
+            "lower": lower,
+            "upper": upper,
+        }
+
+    def _conditions_per_field(self, predicates):
+        conditions = {}
+        for (field, operator, value) in predicates:
+            if field == LOCATION:
+                self._check_locations()
+            conditions.setdefault(field, []).append((operator, value))
+
+        return conditions
+
+    def count_events_per_day(self, filters):
+        """
+        Number of events matching the filters per calendar day, spanning the whole
+        years with matching events. Returns the day ordinal of the first day and
+        the counts, see `aggregates.count_per_day`.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        with timed("aggregate"):
+            day_counts = self._aggregates.day_counts(predicates)
+        if day_counts is not None:
+            return day_counts
+
+        # the filters don't align with the aggregates, count the matching rows
+        positions = self._filter_positions(predicates)
+        with timed("aggregate"):
+            return count_per_day(
+                self._days if positions is None else self._days[positions]
+            )
+
+    def count_events_per_bin(
+        self, filters, resolution=None, start=None, end=None, bins=HISTOGRAM_BINS
+    ):
+        """
+        Number of events matching the filters per calendar bin of `resolution`,
+        one of `aggregates.RESOLUTIONS`, for all bins overlapping the start time
+        interval [start, end). Either bound may be None to use that of the whole
+        dataset. Without a resolution, the finest one splitting the interval
+        into at most about `bins` bins is chosen.
+
+        Returns the resolution, the start times of the bins and their counts.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        span = self._pyramid.span or (0, 1)
+        to_start_time = VALUE_TYPE_MAP[START_TIME]
+        start = to_start_time(start) if start else span[0]
+        end = to_start_time(end) if end else span[1]
+
+        if end <= start:
+            raise ValueError(
+                f"The interval must end after it starts, got {start}/{end}"
+            )
+
+        if resolution is None:
+            resolution = choose_resolution(start, end, bins)
+        elif resolution not in RESOLUTIONS:
+            raise ValueError(
+                f'Resolution must be one of {RESOLUTIONS}, got "{resolution}" instead'
+            )
+
+        if (end - start) / RESOLUTION_SECONDS[resolution] > MAX_HISTOGRAM_BINS:
+            raise ValueError(
+                f"The interval spans more than {MAX_HISTOGRAM_BINS} bins of one "
+                f"{resolution}, choose a coarser resolution or a shorter interval"
+            )
+
+        edges = bin_edges(resolution, start, end)
+
+        with timed("aggregate"):
+            if not predicates:
+                return resolution, edges[:-1], self._pyramid.counts(resolution, edges)
+
+            # days and all coarser bins can be summed up from the per-day aggregates
+            day_counts = None
+            if resolution != "hour":
+                day_counts = self._aggregates.day_counts(predicates)
+
+            if day_counts is not None:
+                first_day, counts = day_counts
+                day_starts = (first_day + np.arange(len(counts))) * 86400
+                return resolution, edges[:-1], count_per_bin(day_starts, edges, counts)
+
+        # the filters don't align with the aggregates, count the matching rows
+        positions = self._filter_positions(predicates)
+        start_time = self._columns[START_TIME]
+
+        with timed("aggregate"):
+            counts = count_per_bin(
+                start_time if positions is None else start_time[positions], edges
+            )
+
+        return resolution, edges[:-1], counts
+
+    def aggregate_locations(self, filters, cell_size=None, geohash=None):
+        """
+        Number, mean severity_index and total area of the events matching the
+        filters per cell of a lat/lon grid, only for cells holding any. Cells are
+        either `cell_size` degrees square or the geohash cells of precision
+        `geohash`, by default squares of `MAP_CELL_DEGREES`. Events without a
+        location are left out.
+
+        Returns the size of the cells and the south west corner, number of events
+        and the aggregates of every cell, plus its geohash given a precision.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        if cell_size is None and geohash is None:
+            cell_size = MAP_CELL_DEGREES
+        cell_height, cell_width = cell_dimensions(cell_size, geohash)
+        latitude, longitude = self._check_locations()
+
+        positions = self._filter_positions(predicates)
+        severity_index, area = self._columns[SEV_INDEX], self._columns[AREA]
+
+        with timed("aggregate"):
+            if positions is not None:
+                latitude, longitude = latitude[positions], longitude[positions]
+                severity_index, area = severity_index[positions], area[positions]
+
+            rows, columns, counts, sums = aggregate_cells(
+                latitude, longitude, cell_height, cell_width, (severity_index, area)
+            )
+            (severity_sums, severity_counts), (area_sums, _) = sums
+
+            cells = {
+                "cell_height": cell_height,
+                "cell_width": cell_width,
+                "south": rows * cell_height - 90,
+                "west": columns * cell_width - 180,
+                "count": counts,
+                # cells without any severity_index get NaN, like in pandas
+                SEV_INDEX: np.divide(
+                    severity_sums,
+                    severity_counts,
+                    out=np.full(len(counts), np.nan),
+                    where=severity_counts > 0,
+                ),
+                AREA: area_sums,
+            }
+            if geohash is not None:
+                cells["geohash"] = geohash_names(rows, columns, geohash)
+
+        return cells
+
+    def event_statistics(self, filters):
+        """
+        Count, first and last start_time and the mean area, length and
+        severity_index of the events matching the filters.
+        """
+        return self.interval_statistics(filters, intervals=[(None, None)])[0]
+
+    def interval_statistics(self, filters, intervals):
+        """
+        Like `event_statistics`, once for every `(start, end)` interval on the start
+        time, where start is inclusive and end exclusive. Either bound may be None
+        to leave that side of the interval open.
+
+        The filters are applied only once for all intervals.
+        """
+        self._check_loaded()
+        predicates = compile_filters(filters)  # raises ValueError on invalid filters
+
+        to_start_time = VALUE_TYPE_MAP[START_TIME]
+        bounds = [
+            (
+                to_start_time(start) if start else None,
+                to_start_time(end) if end else None,
+            )
+            for (start, end) in intervals
+        ]
+
+        statistics = []
+        for (start_time, end_time) in bounds:
+            interval_predicates = list(predicates)
+            if start_time is not None:
+                interval_predicates.append((START_TIME, "gte", start_time))
+            if end_time is not None:
+                interval_predicates.append((START_TIME, "lt", end_time))
+
+            with timed("aggregate"):
+                statistics.append(self._aggregates.statistics(interval_predicates))
+
+        if any(interval is None for interval in statistics):
+            # some intervals don't align with the aggregates, filter the rows once
+            # and look up all those intervals in them by start time
+            row_statistics = self._time_sorted_statistics(predicates)
+            statistics = [
+                interval if interval is not None else row_statistics(*interval_bounds)
+                for interval, interval_bounds in zip(statistics, bounds)
+            ]
+
+        return statistics
+
+    def _time_sorted_statistics(self, predicates):
+        """
+        Sort the rows matching the predicates by start time and build prefix sums
+        over them. Returns a function computing the statistics of any start time
+        interval of those rows with two binary searches.
+        """
+        positions = self._filter_positions(predicates)
+        if positions is None:
+            positions = np.arange(len(self._columns[START_TIME]))
+
+        with timed("aggregate"):
+            start_time = self._columns[START_TIME][positions]
+            if not self._start_time_sorted:
+                order = np.argsort(start_time, kind="stable")
+                positions, start_time = positions[order], start_time[order]
+
+            sums, counts = {}, {}
+            for field in (AREA, LENGTH, SEV_INDEX):
+                values = self._columns[field][positions].astype(np.float64)
+                valid = ~np.isnan(values)
+
+                # rows without a value don't count towards the mean, like in pandas
+                sums[field] = np.concatenate(
+                    [[0], np.cumsum(np.where(valid, values, 0))]
+                )
+                counts[field] = np.concatenate([[0], np.cumsum(valid)])
+
+        def mean(field, lower, upper):
+            valid_count = counts[field][upper] - counts[field][lower]
+            if not valid_count:
+                return np.nan
+            return (sums[field][upper] - sums[field][lower]) / valid_count
+
+        def statistics(start, end):
+            lower = 0 if start is None else np.searchsorted(start_time, start)
+            upper = len(start_time) if end is None else np.searchsorted(start_time, end)
+            upper = max(lower, upper)
+            count = int(upper - lower)
+
+            return {
+                "count": count,
+                "first_start_time": start_time[lower] if count else None,
+                "last_start_time": start_time[upper - 1] if count else None,
+                **{
+                    field: mean(field, lower, upper)
+                    for field in (AREA, LENGTH, SEV_INDEX)
+                },
+            }
+
+        return statistics
+
+    @timed("filter")
+    def _filter_positions(self, predicates):
+        """
+        Row positions (in storage order) matching all compiled predicates, or None
+        if there is nothing to filter.
+
+        The most selective predicate is resolved through its sorted index, or the
+        spatial index for location filters, the remaining ones are combined into
+        a single mask over those candidates.
+        Should a cached result of a broader query hold fewer candidates, those
+        are filtered instead.
+        """
+        if not predicates:
+            return None
+
+        predicates = canonical_predicates(predicates)
+        superset = self._row_sets.lookup(predicates)
+
+        match_counts = [
+            self._index(field).count(operator, value)
+            for (field, operator, value) in predicates
+        ]
+        seed = int(np.argmin(match_counts))
+
+        if superset is not None and len(superset[1]) <= match_counts[seed]:
+            ROW_SET_LOOKUPS.inc(result="hit")
+            cached_predicates, positions = superset
+            remaining = [p for p in predicates if p not in cached_predicates]
+        else:
+            ROW_SET_LOOKUPS.inc(result="miss")
+            field, operator, value = predicates[seed]
+            positions = self._index(field).positions(operator, value)
+            remaining = [p for i, p in enumerate(predicates) if i != seed]
+
+        count_rows(scanned=len(positions))
+
+        if remaining and len(positions):
+            positions = positions[self._predicates_mask(remaining, positions)]
+
+        self._row_sets.put(predicates, positions)
+        return positions
+
+    def _predicates_mask(self, predicates, positions):
+        """Which of the rows at `positions` match all compiled predicates."""
+        mask = np.ones(len(positions), dtype=bool)
+        candidate_values = {}
+
+        for (field, operator, value) in predicates:
+            if field == LOCATION:
+                if field not in candidate_values:
+                    candidate_values[field] = [
+                        values[positions] for values in self._check_locations()
+                    ]
+
+                matches = location_mask(operator, value, *candidate_values[field])
+            else:
+                if field not in candidate_values:
+                    candidate_values[field] = self._columns[field][positions]
+
+                matches = OPERATOR_MAP[operator](candidate_values[field], value)
+
+            np.logical_and(mask, matches, out=mask)
+
+        return mask
+
+    def matches_any(self, predicates, start=0):
+        """
+        Whether any row from position `start` on matches all compiled predicates,
+        e.g. whether appending events changed the results of a query.
+        """
+        self._check_loaded()
+        positions = np.arange(start, len(self._columns[START_TIME]))
+        return bool(self._predicates_mask(predicates, positions).any())
+
+    def _index(self, field):
+        if field != LOCATION:
+            return self._sorted_indexes[field]
+
+        self._check_locations()
+        return self._location_index
+
+    def _check_locations(self):
+        """The latitudes and longitudes of all rows. Raises ValueError without."""
+        if self._locations is None:
+            raise ValueError(
+                f"The dataset has no {MEAN_LAT} and {MEAN_LON} columns to locate "
+                f"events with"
+            )
+
+        return self._locations
+
+    def _build_indexes(self, prebuilt=None, compact=True):
+        # indexes stored with the dataset, see `save`, are reused instead of rebuilt
+        prebuilt = prebuilt or {}
+
+        # the nested timeseries make up most of the dataset but are only needed
+        # for single events, so they are kept out of the frame queries work on
+        if TIMESERIES in self._df.columns:
+            self._timeseries = TimeseriesStore.from_lists(self._df[TIMESERIES])
+            self._df = self._df.drop(columns=TIMESERIES)
+
+        # memory-mapped datasets are compacted when written, see `save`, compacting
+        # them again would copy every column into memory
+        if self._compaction != "none" and compact:
+            self._compact()
+
+        # hash index from event_id to row position, so single events can be looked
+        # up in constant time. Should an id occur twice, its first row wins.
+        event_ids = pd.Index(self._df["event_id"])
+        first_occurrence = ~event_ids.duplicated()
+        self._event_id_index = event_ids[first_occurrence]
+        self._event_id_positions = np.flatnonzero(first_occurrence)
+
+        # sorted secondary indexes for range filters on the queryable fields, plus
+        # the underlying arrays the remaining predicates are evaluated against
+        self._columns = {
+            field: self._df[field].to_numpy() for field in QUERYABLE_FIELDS
+        }
+        self._sorted_indexes = {
+            field: SortedIndex(
+                values,
+                order=prebuilt.get(f"{field}_order"),
+                sorted_values=prebuilt.get(f"{field}_sorted"),
+            )
+            for field, values in self._columns.items()
         }
-        # fmt: on
 
-        value_type_map = {
-            "start": lambda value: pd.to_datetime(value, format="%Y-%m-%dT%H:%M:%S"),
-            "start_time": lambda value: datetime_to_posix_timestamp_seconds(value),
-            "event_id": lambda value: int(value),
+        # uniform grid over the event locations for bounding box and radius
+        # filters, which are checked against the locations themselves
+        self._locations = self._location_index = None
+        if MEAN_LAT in self._df.columns and MEAN_LON in self._df.columns:
+            self._locations = (
+                self._df[MEAN_LAT].to_numpy(dtype=np.float64),
+                self._df[MEAN_LON].to_numpy(dtype=np.float64),
+            )
+            self._location_index = prebuilt.get(LOCATION) or GridIndex(*self._locations)
+
+        # cached row sets refer to the rows of the previous dataset
+        self._row_sets.clear()
+
+        start_time = self._columns[START_TIME]
+        self._start_time_sorted = bool((start_time[1:] >= start_time[:-1]).all())
+
+        # per-day aggregates, answering unfiltered and coarsely filtered
+        # histogram and statistics queries without touching the rows
+        self._days = prebuilt.get("days")
+        if self._days is None:
+            self._days = day_ordinals(self._df["start"])
+
+        self._aggregates = prebuilt.get("aggregates") or AggregateCube(
+            self._days,
+            self._columns[START_TIME],
+            {field: self._columns[field] for field in (AREA, LENGTH, SEV_INDEX)},
+        )
+        self._pyramid = prebuilt.get("pyramid") or CountPyramid(
+            self._columns[START_TIME]
+        )
+
+    def compacted(self, compaction):
+        """New client over the events of this one, compacted with `compaction`."""
+        self._check_loaded()
+        return DataFrameDBClient(
+            df=self._df,
+            timeseries=self._timeseries,
+            compaction=compaction,
+        )
+
+    def _compact(self):
+        # filter values are compared against the queryable floats and locations in
+        # float64 and start times are converted to nanoseconds, so those columns
+        # keep their width, see `compaction`
+        keep = [START_TIME, MEAN_LAT, MEAN_LON] + [
+            field for field in QUERYABLE_FIELDS if self._df[field].dtype.kind == "f"
+        ]
+        float32 = self._compaction == "float32"
+
+        self._df = compact_frame(self._df, float32=float32, keep=keep)
+        if self._timeseries is not None:
+            self._timeseries = self._timeseries.compacted(float32=float32)
+
+    def with_events(self, events):
+        """
+        New client over the events of this one followed by `events`, a frame or
+        records with the columns of the dataset (the timeseries are optional).
+
+        Only the new events are indexed and aggregated, all indexes and
+        aggregates are extended by them into new ones, so this client stays
+        unchanged and can keep answering queries meanwhile. Raises ValueError if
+        the events don't fit the dataset.
+        """
+        self._check_loaded()
+        events = self._conform(events)
+        offset = len(self._df)
+
+        timeseries = [[] for _ in range(len(events))]
+        if TIMESERIES in events:
+            timeseries = events.pop(TIMESERIES)
+
+        client = copy.copy(self)
+        client._df = concat([self._df, events])
+        client._row_sets = RowSetCache(max_bytes=ROW_SET_CACHE_MAX_BYTES)
+        if self._timeseries is not None:
+            client._timeseries = self._timeseries.extended(timeseries)
+        if self._compaction != "none":
+            client._compact()
+
+        client._event_id_index = self._event_id_index.append(
+            pd.Index(events["event_id"])
+        )
+        client._event_id_positions = np.concatenate(
+            [self._event_id_positions, np.arange(offset, len(client._df))]
+        )
+
+        client._columns = {
+            field: client._df[field].to_numpy() for field in QUERYABLE_FIELDS
+        }
+        client._sorted_indexes = {
+            field: index.extended(client._columns[field][offset:])
+            for field, index in self._sorted_indexes.items()
         }
 
-        for (field, operator, value) in filters:
+        if self._locations is not None:
+            client._locations = (
+                client._df[MEAN_LAT].to_numpy(dtype=np.float64),
+                client._df[MEAN_LON].to_numpy(dtype=np.float64),
+            )
+            client._location_index = self._location_index.extended(
+                *(values[offset:] for values in client._locations), offset=offset
+            )
 
-            # ensure proper value types, otherwise pandas won't do the comparisons
-            value_transformer = value_type_map.get(field, lambda value: float(value))
-            value = value_transformer(value)
+        # still sorted if the new start times continue the previous ones in order
+        start_time = client._columns[START_TIME]
+        tail = start_time[max(offset - 1, 0) :]
+        client._start_time_sorted = self._start_time_sorted and bool(
+            (tail[1:] >= tail[:-1]).all()
+        )
 
-            # filter the DataFrame
-            filter_func = operator_map[operator]
-            filtered_df = filter_func(filtered_df, field, value)
+        days = day_ordinals(events["start"])
+        client._days = np.concatenate([self._days, days])
 
-        count_before_limit = len(filtered_df.index)
+        fields = {field: client._columns[field] for field in (AREA, LENGTH, SEV_INDEX)}
+        client._aggregates = self._aggregates.extended(
+            days,
+            start_time[offset:],
+            {field: values[offset:] for field, values in fields.items()},
+        ) or AggregateCube(client._days, start_time, fields)
+        client._pyramid = self._pyramid.extended(start_time[offset:])
 
-        if limit is not None:
-            filtered_df = filtered_df.iloc[:limit]
+        return client
 
-        # apply fields filter so we only return relevant result fields
-        filtered_df = filtered_df[[*fields]]
-        return_value = filtered_df if return_df else filtered_df.to_dict("records")
+    def _conform(self, events):
+        # the events as a frame with exactly the columns and dtypes of the dataset,
+        # or wider ones where they don't fit the compacted dtypes
+        events = pd.DataFrame(events)
+        columns = list(self._df.columns)
 
-        return count_before_limit, return_value
+        missing = [column for column in columns if column not in events]
+        unknown = [
+            column
+            for column in events.columns
+            if column not in columns and column != TIMESERIES
+        ]
+        if missing or unknown:
+            raise ValueError(
+                f"Events must have the columns {columns}, they lack {missing} and "
+                f"have the unknown columns {unknown}"
+            )
 
-    @staticmethod
-    def _check_query_filters(filters):
-        valid_fields = (AREA, LENGTH, SEV_INDEX, START_TIME)
-        valid_operators = ("lt", "lte", "gt", "gte", "eq", "neq")
+        try:
+            conformed = pd.DataFrame(
+                {
+                    column: events[column].astype(wide_dtype(self._df[column].dtype))
+                    for column in columns
+                }
+            )
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"Events don't match the types of the dataset: {exc}")
 
-        if not all([len(filter_) == 3 for filter_ in filters]):
+        if TIMESERIES in events:
+            conformed[TIMESERIES] = events[TIMESERIES]
+
+        event_ids = pd.Index(conformed["event_id"])
+        duplicates = event_ids[
+            event_ids.duplicated() | (self._event_id_index.get_indexer(event_ids) != -1)
+        ]
+        if len(duplicates):
             raise ValueError(
-                "Invalid query filters provided. "
-                "Make sure your filters adhere to the following scheme: 'area__gte=1'"
+                f"Events with the ids {duplicates.unique().tolist()} exist already"
             )
 
-        for (field, operator, _) in filters:
-            if field not in valid_fields:
-                raise ValueError(
-                    f"Attribute must be one of {valid_fields}, got {field} instead"
+        return conformed
+
+    def initialize_database_from_path(
+        self, dataset_path=DATASET_PATH, shared_directory=SHARED_DATASET_DIR
+    ):
+        """
+        Load the dataset, either a gzipped pickle or the columnar format written
+        by `save`. Given a `shared_directory`, a pickle is converted into the
+        columnar format there once, by whichever process gets to it first, and
+        every process then maps that one copy, see `storage.share_columnar`.
+        """
+        if self._df is None:
+            if shared_directory and not is_columnar(dataset_path):
+                dataset_path = share_columnar(
+                    dataset_path,
+                    shared_directory,
+                    convert=functools.partial(
+                        _convert_to_columnar, compaction=self._compaction
+                    ),
+                    attributes={"compaction": self._compaction},
                 )
 
-            if operator not in valid_operators:
-                raise ValueError(
-                    f'Operator must be one of {valid_operators}, got "{operator}" instead'
+            if is_columnar(dataset_path):
+                stored = columnar_attributes(dataset_path).get("compaction", "none")
+                if stored != self._compaction:
+                    log.warning(
+                        "%s is stored with compaction %s instead of %s, convert it "
+                        "again with `python -m storage` to change that",
+                        dataset_path,
+                        stored,
+                        self._compaction,
+                    )
+                    self._compaction = stored
+
+                self._df, indexes = load_columnar(dataset_path)
+                self._timeseries = TimeseriesStore.load(
+                    os.path.join(dataset_path, TIMESERIES)
                 )
+                self._build_indexes(prebuilt=indexes, compact=False)
+                return
 
-    def initialize_database_from_path(self, dataset_path=DATASET_PATH):
-        if self._df is None:
             self._df = pd.read_pickle(
                 dataset_path,
                 compression={"method": "gzip", "compresslevel": 1},
             )
+            self._build_indexes()
+
+    def save(self, directory):
+        """
+        Store the dataset and its indexes in the memory-mappable columnar format,
+        see `storage`. Load it again with `initialize_database_from_path`.
+        """
+        self._check_loaded()
+
+        indexes = {
+            "days": self._days,
+            "aggregates": self._aggregates,
+            "pyramid": self._pyramid,
+        }
+        if self._location_index is not None:
+            indexes[LOCATION] = self._location_index
+        for field, index in self._sorted_indexes.items():
+            indexes[f"{field}_order"] = index.order
+            indexes[f"{field}_sorted"] = index.sorted_values
+
+        save_columnar(
+            self._df,
+            directory,
+            indexes=indexes,
+            attributes={"compaction": self._compaction},
+        )
+
+        if self._timeseries is not None:
+            self._timeseries.save(os.path.join(directory, TIMESERIES))
+
+    def memory_usage(self):
+        """
+        Dtype and bytes of every column of the events and of the records of their
+        timeseries, see `compaction.memory_report`.
+        """
+        self._check_loaded()
+
+        usages = {"events": column_usage(self._df)}
+        if self._timeseries is not None:
+            usages[TIMESERIES] = self._timeseries.memory_usage()
+
+        return pd.concat(usages)
+
+
+def _convert_to_columnar(pickle_path, directory, compaction="none"):
+    db_client = DataFrameDBClient(compaction=compaction)
+    db_client.initialize_database_from_path(pickle_path, shared_directory=None)
+    db_client.save(directory)
+
+
+def _read_only(values):
+    """`values`, a Series, sharing its memory but with writes to it raising."""
+    array = values.array
+
+    if isinstance(array, pd.Categorical):
+        array = pd.Categorical.from_codes(_locked(array.codes), dtype=array.dtype)
+    elif isinstance(array, pd.arrays.DatetimeArray):
+        array = pd.arrays.DatetimeArray(
+            _locked(array.asi8.view("M8[ns]")), dtype=array.dtype
+        )
+    elif isinstance(values.dtype, np.dtype):
+        array = _locked(values.to_numpy())
+
+    return pd.Series(array, index=values.index, name=values.name, copy=False)
+
+
+def _locked(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
@@ -0,0 +1,90 @@
+import base64
+import json
+
+import numpy as np
+
+ORDERS = ("asc", "desc")
+
+
+def encode_cursor(sort_by, order, value, position):
+    """
+    Opaque cursor pointing behind the row at `position` with the sort `value`,
+    e.g. the last row of a page. It is only valid for the same sort.
+    """
+    state = [sort_by, order, value, int(position)]
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+
+def decode_cursor(cursor, sort_by, order):
+    """The `(value, position)` a cursor points behind. Raises ValueError."""
+    try:
+        cursor_sort_by, cursor_order, value, position = json.loads(
+            base64.urlsafe_b64decode(cursor.encode())
+        )
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError(f'Invalid cursor "{cursor}"')
+
+    if (cursor_sort_by, cursor_order) != (sort_by, order):
+        raise ValueError(
+            f'Cursor was created for sort_by="{cursor_sort_by}" and '
+            f'order="{cursor_order}", not for sort_by="{sort_by}" and order="{order}"'
+        )
+
+    return (np.nan if value is None else value), int(position)
+
+
+def sort_page(positions, values, descending=False, limit=None, after=None):
+    """
+    One page of rows ordered by their values, ties broken by row position and
+    rows without a value last, like pandas sorts them.
+
+    `positions` are the ascending positions of the matching rows and `values`
+    their values to sort by. The page starts behind the `(value, position)`
+    `after` and holds at most `limit` rows. With a limit only the candidates
+    for the page are sorted, found with a partial sort (introselect) instead of
+    a full one.
+
+    Returns the positions of the page in order and the number of rows behind
+    `after`.
+    """
+    keys = values.astype(np.float64)
+    if descending:
+        keys = -keys
+    missing = np.isnan(keys)
+
+    if after is not None:
+        after_key, after_position = after
+        after_key = -after_key if descending else after_key
+
+        if np.isnan(after_key):
+            remaining = missing & (positions > after_position)
+        else:
+            remaining = (
+                missing
+                | (keys > after_key)
+                | ((keys == after_key) & (positions > after_position))
+            )
+
+        positions, keys, missing = (
+            positions[remaining],
+            keys[remaining],
+            missing[remaining],
+        )
+
+    candidates = np.flatnonzero(~missing)
+
+    # the rows up to the limit-th smallest key, plus its ties, are the only
+    # ones that can make it onto the page
+    if limit is not None and 0 < limit < len(candidates):
+        kth_key = np.partition(keys[candidates], limit - 1)[limit - 1]
+        candidates = candidates[keys[candidates] <= kth_key]
+    elif limit == 0:
+        candidates = candidates[:0]
+
+    ordered = candidates[np.lexsort((positions[candidates], keys[candidates]))]
+    page = positions[ordered][:limit]
+
+    if limit is None or len(page) < limit:
+        page = np.concatenate([page, positions[missing]])[:limit]
+
+    return page, len(positions)
@@ -0,0 +1,381 @@
+import copy
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# number of values of the location filters, e.g. "location__within=47,5,55,15"
+# fmt: off
+SPATIAL_OPERATORS = {
+    "within": ("south", "west", "north", "east"),
+    "near":   ("latitude", "longitude", "radius_km"),
+}
+# fmt: on
+
+
+def compile_location(operator, value):
+    """
+    Parse the comma separated value of a location filter into a tuple of floats
+    and check it. Raises ValueError.
+    """
+    names = SPATIAL_OPERATORS[operator]
+
+    try:
+        values = tuple(float(part) for part in str(value).split(","))
+    except ValueError:
+        values = ()
+
+    if len(values) != len(names) or np.isnan(values).any():
+        raise ValueError(
+            f'Location filter "{operator}" takes {",".join(names)}, got "{value}"'
+        )
+
+    if operator == "within":
+        south, west, north, east = values
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+            raise ValueError(
+                f"Bounding box must lie within -90 <= south <= north <= 90 and "
+                f"-180 <= west <= east <= 180, got {values}"
+            )
+    else:
+        latitude, longitude, radius_km = values
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and radius_km >= 0):
+            raise ValueError(
+                f"Center must lie within -90 <= latitude <= 90 and "
+                f"-180 <= longitude <= 180 with radius_km >= 0, got {values}"
+            )
+
+    return values
+
+
+def distance_km(latitude, longitude, center_latitude, center_longitude):
+    """Great-circle distance of points to a center, with the haversine formula."""
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    center_latitude, center_longitude = np.radians([center_latitude, center_longitude])
+
+    a = (
+        np.sin((latitude - center_latitude) / 2) ** 2
+        + np.cos(latitude)
+        * np.cos(center_latitude)
+        * np.sin((longitude - center_longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def bounding_box(operator, value):
+    """`(south, west, north, east)` holding every location matching the filter."""
+    if operator == "within":
+        return value
+
+    latitude, longitude, radius_km = value
+    angle = radius_km / EARTH_RADIUS_KM
+    # widened a little, so no location on the circle is lost to rounding
+    delta_latitude = np.degrees(angle) + 1e-9
+
+    south = latitude - delta_latitude
+    north = latitude + delta_latitude
+
+    # circles holding a pole or reaching past a hemisphere span every longitude
+    if angle >= np.pi / 2 or south <= -90.0 or north >= 90.0:
+        return (max(south, -90.0), -180.0, min(north, 90.0), 180.0)
+
+    # the widest point of the circle is off its center's latitude, this is
+    # where its longitude differs the most from the center's
+    delta_longitude = (
+        np.degrees(np.arcsin(np.sin(angle) / np.cos(np.radians(latitude)))) + 1e-9
+    )
+    west = longitude - delta_longitude
+    east = longitude + delta_longitude
+
+    # boxes don't wrap around the antimeridian, circles crossing it span every
+    # longitude as well
+    if west < -180.0 or east > 180.0:
+        return (south, -180.0, north, 180.0)
+
+    return (south, west, north, east)
+
+
+def location_mask(operator, value, latitude, longitude):
+    """Which of the locations match `location <operator> value`."""
+    if operator == "within":
+        south, west, north, east = value
+        return (
+            (latitude >= south)
+            & (latitude <= north)
+            & (longitude >= west)
+            & (longitude <= east)
+        )
+
+    center_latitude, center_longitude, radius_km = value
+    return distance_km(latitude, longitude, center_latitude, center_longitude) <= (
+        radius_km
+    )
+
+
+def contains(box, other):
+    """Whether the `(south, west, north, east)` box contains the other one."""
+    return (
+        box[0] <= other[0]
+        and box[1] <= other[1]
+        and box[2] >= other[2]
+        and box[3] >= other[3]
+    )
+
+
+class GridIndex:
+    """
+    Spatial index over point locations: a uniform grid of cells spanning their
+    bounding box, holding about `rows_per_cell` locations each. The row
+    positions are stored ordered by cell, so the rows of a run of cells next to
+    each other are a single slice, with copies of their latitudes and longitudes
+    in the same order to check them without gathering.
+
+    A location filter takes the rows of all cells overlapping its bounding box
+    and checks them exactly. Prefix sums over the cells count those candidates
+    in constant time. Rows without a location are not indexed and never match.
+    Bounding boxes crossing the antimeridian are not supported.
+    """
+
+    def __init__(self, latitude, longitude, rows_per_cell=64):
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        (positions,) = np.nonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+
+        side = max(1, int(np.sqrt(len(positions) / rows_per_cell)))
+        self._shape = (side, side)
+
+        if len(positions):
+            self._south = latitude[positions].min()
+            self._west = longitude[positions].min()
+            north = latitude[positions].max()
+            east = longitude[positions].max()
+        else:
+            self._south = self._west = north = east = 0.0
+
+        # cells of a zero extent still need a positive size
+        self._cell_height = (north - self._south) / side or 1.0
+        self._cell_width = (east - self._west) / side or 1.0
+
+        rows = self._cell_rows(latitude[positions])
+        columns = self._cell_columns(longitude[positions])
+        cells = rows * side + columns
+
+        order = np.argsort(cells, kind="stable")
+        self._positions = positions[order]
+        self._latitude = latitude[self._positions]
+        self._longitude = longitude[self._positions]
+
+        self._count_cells(np.bincount(cells, minlength=side * side))
+
+    def _count_cells(self, counts):
+        self._starts = np.concatenate([[0], np.cumsum(counts)])
+        self._prefix = np.zeros((self._shape[0] + 1, self._shape[1] + 1), np.int64)
+        self._prefix[1:, 1:] = counts.reshape(self._shape).cumsum(0).cumsum(1)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def extended(self, latitude, longitude, offset):
+        """
+        Index with the locations of the rows from position `offset` on added,
+        inserted into the cells of this grid. Locations beyond it go to its
+        outermost cells, which every bounding box beyond it overlaps as well.
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        (positions,) = np.nonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+
+        rows = self._cell_rows(latitude[positions])
+        columns = self._cell_columns(longitude[positions])
+        cells = rows * self._shape[1] + columns
+
+        # behind the rows of the same cell, which all come before them
+        order = np.argsort(cells, kind="stable")
+        cells, positions = cells[order], positions[order]
+        at = self._starts[cells + 1]
+
+        index = copy.copy(self)
+        index._positions = np.insert(self._positions, at, positions + offset)
+        index._latitude = np.insert(self._latitude, at, latitude[positions])
+        index._longitude = np.insert(self._longitude, at, longitude[positions])
+        index._count_cells(
+            np.diff(self._starts) + np.bincount(cells, minlength=len(self._starts) - 1)
+        )
+        return index
+
+    def _cell_rows(self, latitude):
+        rows = np.floor((latitude - self._south) / self._cell_height)
+        return np.clip(rows, 0, self._shape[0] - 1).astype(np.int64)
+
+    def _cell_columns(self, longitude):
+        columns = np.floor((longitude - self._west) / self._cell_width)
+        return np.clip(columns, 0, self._shape[1] - 1).astype(np.int64)
+
+    def _cell_range(self, operator, value):
+        # rows [row_start, row_stop) and columns [column_start, column_stop) of
+        # the cells overlapping the bounding box of the filter
+        south, west, north, east = bounding_box(operator, value)
+        row_start, row_stop = self._cell_rows(np.array([south, north]))
+        column_start, column_stop = self._cell_columns(np.array([west, east]))
+
+        # boxes beyond the grid are clipped onto its outermost cells, whose
+        # locations are then all rejected by the exact check
+        return row_start, row_stop + 1, column_start, column_stop + 1
+
+    def count(self, operator, value):
+        """
+        Number of candidate rows for the filter, an upper bound of its matches.
+        """
+        row_start, row_stop, column_start, column_stop = self._cell_range(
+            operator, value
+        )
+        prefix = self._prefix
+        return int(
+            prefix[row_stop, column_stop]
+            - prefix[row_start, column_stop]
+            - prefix[row_stop, column_start]
+            + prefix[row_start, column_start]
+        )
+
+    def positions(self, operator, value):
+        """Row positions whose location matches the filter, in storage order."""
+        row_start, row_stop, column_start, column_stop = self._cell_range(
+            operator, value
+        )
+
+        # the cells of one grid row are consecutive in the order of the rows
+        side = self._shape[1]
+        slices = [
+            slice(
+                self._starts[row * side + column_start],
+                self._starts[row * side + column_stop],
+            )
+            for row in range(row_start, row_stop)
+        ]
+
+        matches = []
+        for cells in slices:
+            mask = location_mask(
+                operator, value, self._latitude[cells], self._longitude[cells]
+            )
+            matches.append(self._positions[cells][mask])
+
+        return np.sort(np.concatenate(matches)) if matches else self._positions[:0]
+
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# 60 bits, the most a cell key of `aggregate_cells` can hold
+MAX_GEOHASH_PRECISION = 12
+# about 11m, so the cell keys of the finest grid still fit into 64 bits
+MIN_CELL_DEGREES = 1e-4
+
+
+def cell_dimensions(cell_size=None, geohash=None):
+    """
+    Height and width in degrees of the cells of a square grid of `cell_size`
+    degrees, or of the geohash cells of precision `geohash`. Raises ValueError.
+    """
+    if (cell_size is None) == (geohash is None):
+        raise ValueError("Give either a cell size or a geohash precision")
+
+    if geohash is not None:
+        if not 1 <= geohash <= MAX_GEOHASH_PRECISION:
+            raise ValueError(
+                f"Geohash precision must lie within 1 and {MAX_GEOHASH_PRECISION}, "
+                f"got {geohash}"
+            )
+
+        # geohashes alternate between longitude and latitude bits, starting with
+        # longitude, so that gets the extra bit of odd bit counts
+        latitude_bits = 5 * geohash // 2
+        longitude_bits = 5 * geohash - latitude_bits
+        return 180 / 2**latitude_bits, 360 / 2**longitude_bits
+
+    if not MIN_CELL_DEGREES <= cell_size <= 180:
+        raise ValueError(
+            f"Cell size must lie within {MIN_CELL_DEGREES} and 180 degrees, "
+            f"got {cell_size}"
+        )
+
+    return cell_size, cell_size
+
+
+def aggregate_cells(latitude, longitude, cell_height, cell_width, values=()):
+    """
+    Bin locations into the cells of a grid with cells of the given size in
+    degrees, starting at latitude -90 and longitude -180.
+
+    Returns the row and column of every cell holding a location, the number of
+    locations in it and, for every array of `values` by the same locations, the
+    sum and number of its non-NaN values per cell. Locations with a NaN
+    coordinate are left out.
+    """
+    row_count = int(np.ceil(180 / cell_height))
+    column_count = int(np.ceil(360 / cell_width))
+
+    valid = ~(np.isnan(latitude) | np.isnan(longitude))
+    if not valid.all():
+        latitude, longitude = latitude[valid], longitude[valid]
+        values = [value[valid] for value in values]
+
+    rows = np.clip(np.floor((latitude + 90) / cell_height), 0, row_count - 1)
+    columns = np.clip(np.floor((longitude + 180) / cell_width), 0, column_count - 1)
+    keys = rows.astype(np.int64) * column_count + columns.astype(np.int64)
+
+    # cells spanning a range not much larger than the number of locations are
+    # counted directly by key, sparser ones by their position among the keys
+    low = int(keys.min()) if len(keys) else 0
+    span = int(keys.max()) - low + 1 if len(keys) else 0
+    if span <= 4 * len(keys) + 1024:
+        cell_keys, inverse = None, keys - low
+    else:
+        cell_keys, inverse = np.unique(keys, return_inverse=True)
+        span = len(cell_keys)
+
+    counts = np.bincount(inverse, minlength=span)
+    occupied = np.flatnonzero(counts)
+    cell_keys = occupied + low if cell_keys is None else cell_keys
+
+    sums = []
+    for value in values:
+        value = np.asarray(value, dtype=np.float64)
+        value_valid = ~np.isnan(value)
+        sums.append(
+            (
+                np.bincount(
+                    inverse, weights=np.where(value_valid, value, 0), minlength=span
+                )[occupied],
+                np.bincount(inverse, weights=value_valid, minlength=span)[occupied],
+            )
+        )
+
+    return (
+        cell_keys // column_count,
+        cell_keys % column_count,
+        counts[occupied],
+        sums,
+    )
+
+
+def geohash_names(rows, columns, precision):
+    """Geohashes of the cells of `aggregate_cells` binned at that precision."""
+    bits = 5 * precision
+    latitude_bits = bits // 2
+    rows, columns = np.asarray(rows, np.int64), np.asarray(columns, np.int64)
+
+    # interleave the bits of the column and the row, most significant first
+    codes = np.zeros(len(rows), dtype=np.int64)
+    for bit in range(bits):
+        if bit % 2 == 0:
+            source, shift = columns, bits - latitude_bits - 1 - bit // 2
+        else:
+            source, shift = rows, latitude_bits - 1 - bit // 2
+        codes = (codes << 1) | ((source >> shift) & 1)
+
+    # one character per 5 bits, viewed as one string of `precision` characters
+    # per cell instead of joining them one by one
+    alphabet = np.array(list(GEOHASH_ALPHABET))
+    shifts = 5 * np.arange(precision - 1, -1, -1)
+    characters = alphabet[(codes[:, None] >> shifts) & 31]
+
+    return characters.view(f"<U{precision}").ravel().tolist()
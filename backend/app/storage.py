@@ -0,0 +1,260 @@
+"""
+Columnar on-disk format for the dataset.
+
+Every column with a fixed width dtype is stored as its own `.npy` file, which is
+memory-mapped when loading: startup doesn't decompress or unpickle anything, pages
+are only read once they are accessed and processes loading the same dataset share
+them through the page cache. Columns of Python objects are pickled. Prebuilt
+indexes are stored the same way, so they don't have to be rebuilt on every start.
+Other objects are pickled with their numpy arrays written out of band, so those
+are memory-mapped as well.
+
+Convert an existing pickled dataset with:
+python -m storage ../../dataset.df.pickle ../../dataset.columns
+"""
+import argparse
+import fcntl
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+METADATA_FILE = "columns.json"
+SOURCE_FILE = "source.json"
+
+# increase whenever the layout of the pickled index objects changes, indexes of
+# other versions are rebuilt instead of loaded
+FORMAT_VERSION = 2
+
+# offsets of out-of-band buffers are aligned like numpy aligns its allocations
+BUFFER_ALIGNMENT = 64
+
+
+def _save_values(directory, name, values):
+    entry = {"file": name}
+
+    if not hasattr(values, "dtype"):
+        return _save_object(directory, entry, values)
+
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        # tz-aware datetimes are stored as UTC and localized again when loading
+        entry["tz"] = str(values.dtype.tz)
+        values = values.tz_convert("UTC").tz_localize(None)
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # the codes are stored like any other column, the categories next to them
+        entry["categories"] = _save_values(
+            directory, f"{name}_categories", values.categories.array
+        )
+        entry["ordered"] = bool(values.ordered)
+        values = values.codes
+
+    values = np.asarray(values)
+
+    if values.dtype.hasobject:
+        entry["file"] += ".pickle"
+        with open(os.path.join(directory, entry["file"]), "wb") as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        entry["file"] += ".npy"
+        np.save(os.path.join(directory, entry["file"]), values)
+
+    return entry
+
+
+def _save_object(directory, entry, value):
+    # pickle protocol 5 hands out the buffers of numpy arrays, which are written
+    # to a separate file instead of being copied into the pickle
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+
+    entry["file"] += ".pickle"
+    entry["buffers"] = []
+    with open(os.path.join(directory, entry["file"]), "wb") as f:
+        f.write(data)
+
+    with open(os.path.join(directory, entry["file"] + ".buffers"), "wb") as f:
+        for buffer in buffers:
+            f.write(b"\0" * (-f.tell() % BUFFER_ALIGNMENT))
+            raw = buffer.raw()
+            entry["buffers"].append([f.tell(), raw.nbytes])
+            f.write(raw)
+
+    return entry
+
+
+def _load_object(path, entry, mmap_mode):
+    buffers = []
+    if entry["buffers"]:
+        mapped = np.memmap(path + ".buffers", mode=mmap_mode or "r")
+        buffers = [mapped[offset : offset + size] for offset, size in entry["buffers"]]
+
+    with open(path, "rb") as f:
+        return pickle.load(f, buffers=buffers)
+
+
+def _load_values(directory, entry, mmap_mode):
+    path = os.path.join(directory, entry["file"])
+
+    if "buffers" in entry:
+        return _load_object(path, entry, mmap_mode)
+
+    if entry["file"].endswith(".pickle"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    values = np.load(path, mmap_mode=mmap_mode)
+
+    if "tz" in entry:
+        values = pd.arrays.DatetimeArray(
+            values, dtype=pd.DatetimeTZDtype(tz=entry["tz"])
+        )
+
+    if "categories" in entry:
+        categories = _load_values(directory, entry["categories"], mmap_mode)
+        values = pd.Categorical.from_codes(
+            values,
+            dtype=pd.CategoricalDtype(categories, ordered=entry["ordered"]),
+        )
+
+    return values
+
+
+def save_columnar(df, directory, indexes=None, attributes=None):
+    """
+    Write `df` and optionally prebuilt indexes to `directory`. Indexes are given
+    as a mapping of names to arrays, which are memory-mapped again when loading,
+    or to any other picklable objects. `attributes` are JSON-serializable facts
+    about the dataset, see `columnar_attributes`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    indexes = indexes or {}
+
+    metadata = {
+        "format_version": FORMAT_VERSION,
+        "attributes": attributes or {},
+        "index": _save_values(directory, "row_index", df.index.array),
+        "columns": [
+            {"name": name, **_save_values(directory, f"column_{i}", df[name].array)}
+            for i, name in enumerate(df.columns)
+        ],
+        "indexes": {
+            name: _save_values(directory, f"index_{i}", index)
+            for i, (name, index) in enumerate(indexes.items())
+        },
+    }
+
+    with open(os.path.join(directory, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def load_columnar(directory, mmap_mode="r"):
+    """
+    Load a dataset written by `save_columnar`. Returns the DataFrame, backed by
+    memory-mapped columns wherever possible, and the stored indexes. Indexes
+    pickled by another format version are left out, only their arrays are kept.
+    """
+    metadata = _load_metadata(directory)
+
+    columns = {
+        entry["name"]: _load_values(directory, entry, mmap_mode)
+        for entry in metadata["columns"]
+    }
+    index = _load_values(directory, metadata["index"], mmap_mode)
+
+    # copy=False keeps every column in its own block backed by its own file,
+    # instead of consolidating (and thereby copying) them into memory
+    df = pd.DataFrame(columns, index=pd.Index(index, copy=False), copy=False)
+
+    current = metadata.get("format_version") == FORMAT_VERSION
+    indexes = {
+        name: _load_values(directory, entry, mmap_mode)
+        for name, entry in metadata["indexes"].items()
+        if current or entry["file"].endswith(".npy")
+    }
+
+    return df, indexes
+
+
+def columnar_attributes(directory):
+    """The `attributes` a dataset was written with by `save_columnar`."""
+    return _load_metadata(directory).get("attributes", {})
+
+
+def _load_metadata(directory):
+    with open(os.path.join(directory, METADATA_FILE)) as f:
+        return json.load(f)
+
+
+def is_columnar(dataset_path):
+    return os.path.isfile(os.path.join(dataset_path, METADATA_FILE))
+
+
+def share_columnar(source_path, directory, convert, attributes=None):
+    """
+    Make sure `directory` holds a columnar copy of the dataset at `source_path`,
+    written by `convert(source_path, directory)`, and return `directory`.
+    `attributes` are whatever else the copy depends on, e.g. how it is compacted.
+
+    Meant for several processes loading the same dataset at once, with
+    `directory` on a tmpfs like /dev/shm: a file lock lets the first process
+    convert the dataset while the others wait, after which all of them map the
+    same files, i.e. the same shared memory, instead of holding private copies.
+    The copy is converted again once the source file, the attributes or the
+    format version change.
+    """
+    stat = os.stat(source_path)
+    source = {"path": os.path.abspath(source_path), "mtime_ns": stat.st_mtime_ns}
+    source["size"] = stat.st_size
+    source["format_version"] = FORMAT_VERSION
+    source["attributes"] = attributes or {}
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+
+    with open(f"{directory}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(os.path.join(directory, SOURCE_FILE)) as f:
+                if json.load(f) == source and is_columnar(directory):
+                    return directory
+        except FileNotFoundError:
+            pass
+
+        # convert next to the target and swap it in, processes still mapping
+        # the files of an outdated copy keep them until they unmap them
+        converting = f"{directory}.{os.getpid()}"
+        shutil.rmtree(converting, ignore_errors=True)
+        convert(source_path, converting)
+        with open(os.path.join(converting, SOURCE_FILE), "w") as f:
+            json.dump(source, f)
+
+        outdated = f"{converting}.outdated"
+        if os.path.exists(directory):
+            os.rename(directory, outdated)
+        os.rename(converting, directory)
+        shutil.rmtree(outdated, ignore_errors=True)
+
+    return directory
+
+
+if __name__ == "__main__":
+    from compaction import MODES
+    from constants import DATASET_COMPACTION
+    from models import DataFrameDBClient
+
+    parser = argparse.ArgumentParser(
+        description="Convert a pickled dataset to the memory-mappable columnar format"
+    )
+    parser.add_argument("pickle_path", help="path of the gzipped dataset pickle")
+    parser.add_argument("directory", help="directory to write the columnar dataset to")
+    parser.add_argument("--compaction", choices=MODES, default=DATASET_COMPACTION)
+    args = parser.parse_args()
+
+    db_client = DataFrameDBClient(compaction=args.compaction)
+    db_client.initialize_database_from_path(dataset_path=args.pickle_path)
+    db_client.save(args.directory)
@@ -0,0 +1,140 @@
+"""
+Synthetic rain events with the columns, value ranges and timeseries shape of
+the real dataset, to test and benchmark the query engine at any size.
+
+Write a columnar dataset of a million events, see `storage`, with:
+python -m synthetic 1000000 ../../dataset.synthetic.columns
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from timeseries import TimeseriesStore
+
+FIRST_START = pd.Timestamp("1979-01-01", tz="UTC")
+LAST_START = pd.Timestamp("2018-01-01", tz="UTC")
+
+
+def generate_events(rows, seed=0):
+    """
+    Event frame of `rows` rain events in start order, without the timeseries.
+    Most events are short, small and mild, few are long-lasting, wide-spread
+    and severe, and more of them happen in summer than in winter.
+    """
+    rng = np.random.default_rng(seed)
+
+    # starts are uniform over the years, thinned out towards winter
+    first, last = FIRST_START.value // 10**9, LAST_START.value // 10**9
+    start_time = np.zeros(0, dtype=np.int64)
+    while len(start_time) < rows:
+        candidates = rng.integers(first, last, size=2 * rows + 100)
+        day_of_year = (candidates - first) / 86400 % 365.25
+        summer = 0.6 - 0.4 * np.cos(2 * np.pi * (day_of_year - 15) / 365.25)
+        accepted = candidates[rng.random(len(candidates)) < summer]
+        start_time = np.concatenate([start_time, accepted])
+    start_time = np.sort(start_time[:rows])
+
+    length = np.minimum(rng.geometric(0.15, size=rows), 240)
+    area = np.round(rng.lognormal(3.5, 1.2, size=rows) * np.sqrt(length), 2)
+    severity_index = np.round(rng.gamma(1.2, 1.5, size=rows) * np.log1p(length), 2)
+    mean_prec = np.round(rng.gamma(2.0, 1.5, size=rows), 2)
+
+    return pd.DataFrame(
+        {
+            "event_id": np.arange(1, rows + 1),
+            "area": area,
+            "length": length,
+            "severity_index": severity_index,
+            "start": pd.to_datetime(start_time, unit="s", utc=True),
+            "start_time": start_time,
+            "meanLat": np.round(rng.uniform(47.3, 55.0, size=rows), 4),
+            "meanLon": np.round(rng.uniform(5.9, 15.0, size=rows), 4),
+            "meanPrec": mean_prec,
+            "maxPrec": np.round(mean_prec * rng.uniform(1.0, 4.0, size=rows), 2),
+        }
+    )
+
+
+def generate_timeseries(events, seed=0):
+    """
+    Hourly records of every event, one per hour of its length, drifting from
+    around its mean position like a rain field moving across the country.
+    """
+    rng = np.random.default_rng(seed + 1)
+    length = events["length"].to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(length)])
+    event = np.repeat(np.arange(len(length)), length)
+    hour = np.arange(offsets[-1]) - offsets[event]
+
+    def drift(scale):
+        # random walk per event, centered on its mean position
+        steps = rng.normal(0, scale, size=len(event))
+        walk = np.cumsum(steps)
+        walk -= np.repeat(np.add.reduceat(walk, offsets[:-1]) / length, length)
+        return walk
+
+    latitude = events["meanLat"].to_numpy()[event] + drift(0.05)
+    longitude = events["meanLon"].to_numpy()[event] + drift(0.08)
+
+    # the area and severity of the rain field swell and shrink over its life
+    swell = np.sin(np.pi * (hour + 0.5) / length[event])
+    area = events["area"].to_numpy()[event] / np.sqrt(length[event]) * swell
+    severity_index = events["severity_index"].to_numpy()[event] * swell / length[event]
+
+    date = events["start_time"].to_numpy()[event] + hour * 3600
+
+    records = pd.DataFrame(
+        {
+            "latitude": np.round(latitude, 4),
+            "longitude": np.round(longitude, 4),
+            "area": np.round(area, 2),
+            "severity_index": np.round(severity_index, 3),
+            "date": pd.to_datetime(date, unit="s"),
+            "index": hour,
+        }
+    )
+
+    return TimeseriesStore(records, offsets)
+
+
+def generate_dataset(rows, seed=0, nested_timeseries=False):
+    """
+    Events and their timeseries. The timeseries are returned as a separate
+    TimeseriesStore, or with `nested_timeseries` as a `timeseries` column of
+    record lists like in the pickled dataset, which only suits small sizes.
+    """
+    events = generate_events(rows, seed=seed)
+    timeseries = generate_timeseries(events, seed=seed)
+
+    if nested_timeseries:
+        events["timeseries"] = [timeseries.records(i) for i in range(rows)]
+        return events, None
+
+    return events, timeseries
+
+
+if __name__ == "__main__":
+    from compaction import MODES
+    from constants import DATASET_COMPACTION
+    from models import DataFrameDBClient
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset")
+    parser.add_argument("rows", type=int, help="number of events")
+    parser.add_argument("path", help="columnar directory or, with --pickle, file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--pickle", action="store_true", help="write a gzipped pickle instead"
+    )
+    parser.add_argument("--compaction", choices=MODES, default=DATASET_COMPACTION)
+    args = parser.parse_args()
+
+    events, timeseries = generate_dataset(
+        args.rows, seed=args.seed, nested_timeseries=args.pickle
+    )
+
+    if args.pickle:
+        events.to_pickle(args.path, compression={"method": "gzip", "compresslevel": 1})
+    else:
+        DataFrameDBClient(
+            df=events, timeseries=timeseries, compaction=args.compaction
+        ).save(args.path)
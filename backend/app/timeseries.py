@@ -0,0 +1,91 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+from compaction import column_usage, compact_frame
+from storage import is_columnar, load_columnar, save_columnar
+
+
+class TimeseriesStore:
+    """
+    The hourly timeseries of all events, stored out of line of the event rows.
+
+    The records of all events are concatenated into one flat frame with a column
+    per record key (latitude, longitude, area, severity_index, date, index), and
+    `offsets[i]:offsets[i + 1]` are the records of the event in row position `i`.
+    """
+
+    def __init__(self, records: pd.DataFrame, offsets: np.ndarray):
+        self._records = records
+        self._offsets = offsets
+
+        # slicing the column arrays directly is much cheaper than going through
+        # the frame for the handful of records of a single event. Numbers come
+        # from plain numpy arrays, whose `tolist` yields builtin ints and floats,
+        # dates from the pandas arrays, whose `tolist` yields Timestamps.
+        self._arrays = {
+            name: (
+                records[name].to_numpy()
+                if records[name].dtype.kind in "biuf"
+                else records[name].array
+            )
+            for name in records.columns
+        }
+
+    @classmethod
+    def from_lists(cls, timeseries):
+        """Flatten a column holding one list of record dicts per event."""
+        lengths = np.fromiter(
+            map(len, timeseries), dtype=np.int64, count=len(timeseries)
+        )
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        records = pd.DataFrame.from_records(
+            list(itertools.chain.from_iterable(timeseries))
+        )
+
+        return cls(records, offsets)
+
+    def extended(self, timeseries):
+        """Store with the timeseries of further events appended."""
+        appended = TimeseriesStore.from_lists(timeseries)
+
+        records = self._records
+        if len(appended._records):
+            records = pd.concat([records, appended._records], ignore_index=True)
+
+        offsets = np.concatenate(
+            [self._offsets, appended._offsets[1:] + self._offsets[-1]]
+        )
+        return TimeseriesStore(records, offsets)
+
+    def compacted(self, float32=False):
+        """Store with the records in compact dtypes, see `compaction`."""
+        return TimeseriesStore(
+            compact_frame(self._records, float32=float32), self._offsets
+        )
+
+    def memory_usage(self):
+        """Dtype and bytes of every record column, see `compaction.column_usage`."""
+        return column_usage(self._records)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def records(self, position):
+        """The timeseries records of the event in row position `position`."""
+        start, stop = self._offsets[position], self._offsets[position + 1]
+        columns = [values[start:stop].tolist() for values in self._arrays.values()]
+
+        return [dict(zip(self._arrays, values)) for values in zip(*columns)]
+
+    def save(self, directory):
+        save_columnar(self._records, directory, indexes={"offsets": self._offsets})
+
+    @classmethod
+    def load(cls, directory):
+        """Load a store written by `save`, None if `directory` doesn't hold one."""
+        if not is_columnar(directory):
+            return None
+
+        records, indexes = load_columnar(directory)
+        return cls(records, indexes["offsets"])
@@ -1,10 +1,15 @@
+import logging
 from datetime import datetime
 from math import log10, isnan
 from typing import Optional
+from urllib.parse import parse_qs as parse_querystring
 
+from constants import COLUMNAR_MEDIA_TYPE
 from fastapi import Request, Response
 from fastapi_cache import FastAPICache
 
+log = logging.getLogger(__name__)
+
 
 def cache_key_with_query_params(
     func,
@@ -15,13 +20,66 @@ def cache_key_with_query_params(
     **kwargs,
 ):
     prefix = FastAPICache.get_prefix()
-    cache_key = f"{prefix}:{namespace}:{func.__module__}:{func.__name__}:{args}:{kwargs}:{request._query_params if request else ''}"
 
-    print(f"{cache_key=}")
+    # the endpoint arguments, without the raw filter string, plus the filters in
+    # canonical form, so equivalent queries share one cache entry
+    endpoint_kwargs = dict(kwargs.get("kwargs", {}))
+    filter_params = endpoint_kwargs.pop("filter_params", "")
+    query_string = filter_params or (str(request.query_params) if request else "")
+
+    cache_key = f"{prefix}:{namespace}:{func.__module__}:{func.__name__}:{kwargs.get('args', args)}:{sorted(endpoint_kwargs.items())}:{canonical_query(query_string)}:{request.headers.get('accept') if request else ''}"
+
+    log.debug("cache_key=%s", cache_key)
+
+    # so adding events only invalidates the responses of queries they match,
+    # see `cache.BoundedInMemoryBackend.invalidate`
+    backend = FastAPICache.get_backend()
+    if hasattr(backend, "tag"):
+        # estimates depend on every event, not only the matching ones
+        approximate = endpoint_kwargs.get("approximate")
+        backend.tag(cache_key, None if approximate else query_predicates(query_string))
 
     return cache_key
 
 
+def query_predicates(query_string):
+    """
+    The filters in a query string as canonical compiled predicates, None if they
+    are invalid.
+    """
+    # filters imports this module, so it can't be imported at the top
+    from filters import canonical_predicates, compile_filters
+
+    query_params = parse_querystring(query_string)
+    filter_params = {key: value for key, value in query_params.items() if "__" in key}
+
+    try:
+        return canonical_predicates(compile_filters(extract_filters(filter_params)))
+    except ValueError:
+        return None
+
+
+def canonical_query(query_string):
+    """
+    Canonical form of the filters in a query string, e.g. both
+    "length__lt=5&area__gt=1" and "area__gt=1.0&length__lt=5&area__gt=1"
+    become (('area', 'gt', 1.0), ('length', 'lt', 5.0)). Parameters that are no
+    filters are kept as they are, in the order of their names.
+    """
+    query_params = parse_querystring(query_string)
+    filter_params = {key: value for key, value in query_params.items() if "__" in key}
+    other_params = sorted(
+        (key, value) for key, value in query_params.items() if "__" not in key
+    )
+
+    filters = query_predicates(query_string)
+    if filters is None:
+        # invalid filters are answered with an error, which is cached as is
+        filters = sorted(map(tuple, extract_filters(filter_params)))
+
+    return filters, other_params
+
+
 def remove_tz(datestring):
     if datestring[-1].lower() == "z":
         datestring = datestring[:-1]
@@ -37,6 +95,14 @@ def datetime_to_posix_timestamp_seconds(dt):
     return int(dt.timestamp())
 
 
+def isoformat(value):
+    # `default` for json.dumps, serializing datetimes like FastAPI does
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 def calc_days_in_interval(interval):
     if len(interval) < 2:
         return 1
@@ -52,11 +118,55 @@ def calc_days_in_interval(interval):
 
 
 def round_to_min_digits(n, min=1):
-    if (isnan(n)):
+    if (isnan(n) or n == 0):
         return 0
     k = 1 - int(log10(n))
     return round(n, min if k < min else k)
 
 
+def spider_chart_values(statistics, start="", end=""):
+    events_per_day = 0
+
+    # without an interval, the range of the matching events is the reference
+    if statistics["count"]:
+        start = start or datetime.fromtimestamp(statistics["first_start_time"])
+        end = end or datetime.fromtimestamp(statistics["last_start_time"])
+        events_per_day = statistics["count"] / calc_days_in_interval([start, end])
+
+    values = {
+        "area": statistics["area"],
+        "length": statistics["length"],
+        "severity_index": statistics["severity_index"],
+        "events_per_day": events_per_day,
+    }
+
+    return {
+        key: round_to_min_digits(round(float(value), 5))
+        for key, value in values.items()
+    }
+
+
+def is_columnar_format(response_format=None, accept=None):
+    """
+    Whether query results should be returned column-oriented, either because the
+    `format` parameter asks for it or, without one, the Accept header does.
+    """
+    if response_format is None:
+        return COLUMNAR_MEDIA_TYPE in (accept or "")
+
+    if response_format not in ("records", "columns"):
+        raise ValueError(
+            f'Format must be one of ("records", "columns"), got "{response_format}" instead'
+        )
+
+    return response_format == "columns"
+
+
 def extract_filters(query_params):
-    return [key.split("__") + value for key, value in query_params.items()]
+    # a parameter given several times, e.g. "area__gt=1&area__gt=2", yields one
+    # filter per value
+    return [
+        key.split("__") + [value]
+        for key, values in query_params.items()
+        for value in values
+    ]
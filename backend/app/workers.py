@@ -0,0 +1,74 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import record
+
+
+class PoolSaturatedError(RuntimeError):
+    pass
+
+
+class WorkerPool:
+    """
+    Runs blocking work, like filtering and aggregating the dataset, on a pool of
+    worker threads so the event loop stays free to answer cheap requests. Most
+    of that work happens in numpy and pandas, which release the GIL for it.
+
+    At most `max_workers` calls run at once and at most `max_queued` more wait
+    for a worker. Beyond that `run` raises PoolSaturatedError right away instead
+    of letting the backlog grow.
+
+    A call `run` admitted can hand out follow-up work with `run_admitted`, which
+    waits for a worker however long the queue is but still counts as pending.
+
+    Calls run in a copy of the caller's context, so their stage timings count
+    towards the request, plus the time they waited for a worker as `queue`.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="db-worker"
+        )
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Number of calls running or waiting for a worker."""
+        return self._pending
+
+    async def run(self, func, *args, **kwargs):
+        if self._pending >= self.max_workers + self.max_queued:
+            raise PoolSaturatedError(
+                f"All {self.max_workers} workers are busy and "
+                f"{self.max_queued} requests are already waiting"
+            )
+
+        return await self.run_admitted(func, *args, **kwargs)
+
+    async def run_admitted(self, func, *args, **kwargs):
+        """
+        Like `run`, but never raises PoolSaturatedError. For work continuing a
+        call that was admitted already, like the chunks of a streamed response,
+        which can't be turned away once its status is sent.
+        """
+        submitted = time.perf_counter()
+
+        def call():
+            record("queue", time.perf_counter() - submitted)
+            return func(*args, **kwargs)
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, contextvars.copy_context().run, call
+            )
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
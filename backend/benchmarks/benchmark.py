@@ -0,0 +1,238 @@
+"""
+Throughput, latency percentiles and peak memory of the endpoints on synthetic
+datasets, see `synthetic`, for a mix of filters. The response cache and the
+cached row sets of the client are bypassed, so every request does the work.
+
+Run from the repository root with:
+PYTHONPATH=./backend/app python backend/benchmarks/benchmark.py --rows 100000 1000000
+
+Save the results with `--output results.json` and compare later runs against
+them with `--baseline results.json`, which exits with 1 if any case got slower
+by more than `--tolerance`.
+"""
+import argparse
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+import main
+import numpy as np
+from compaction import MODES
+from fastapi.testclient import TestClient
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from models import DataFrameDBClient
+from synthetic import generate_dataset
+
+FILTER_MIXES = {
+    "none": "",
+    "selective": "severity_index__gt=20&length__gt=48",
+    "range": "area__gte=50&area__lt=500",
+    "time_range": (
+        "start_time__gte=2000-01-01T00:00:00Z&start_time__lt=2001-01-01T00:00:00Z"
+    ),
+    "combined": (
+        "start_time__gte=1990-01-01T00:00:00Z&start_time__lt=2010-01-01T00:00:00Z"
+        "&length__gte=6&severity_index__gt=2"
+    ),
+    "bbox": "location__within=50.0,8.0,51.5,10.0",
+    "radius": "location__near=52.52,13.40,50&severity_index__gt=1",
+    # not on day boundaries, so the per-day aggregates only cover the inner days
+    "unaligned": (
+        "start_time__gte=1995-03-14T07:30:00Z&start_time__lt=1996-11-02T18:45:00Z"
+    ),
+}
+
+
+def monthly_intervals(year=2000):
+    starts = [f"{year}-{month:02d}-01T00:00:00Z" for month in range(1, 13)]
+    ends = starts[1:] + [f"{year + 1}-01-01T00:00:00Z"]
+    return [f"{start}/{end}" for start, end in zip(starts, ends)]
+
+
+def query_cases(filter_params):
+    yield "query", "/query", {"filter_params": filter_params, "limit": 1000}
+    yield "query_columns", "/query", {
+        "filter_params": filter_params,
+        "limit": 1000,
+        "format": "columns",
+    }
+    yield "query_top_100", "/query", {
+        "filter_params": filter_params,
+        "limit": 100,
+        "sort_by": "severity_index",
+        "order": "desc",
+    }
+    yield "count", "/count", {"filter_params": filter_params}
+    yield "count_approximate", "/count", {
+        "filter_params": filter_params,
+        "approximate": True,
+    }
+    yield "overview_histogram", "/overview-histogram", {"filter_params": filter_params}
+    yield "histogram_auto", "/overview-histogram", {
+        "filter_params": filter_params,
+        "resolution": "auto",
+    }
+    yield "histogram_zoomed", "/overview-histogram", {
+        "filter_params": filter_params,
+        "resolution": "auto",
+        "start": "2000-03-01T00:00:00Z",
+        "end": "2000-03-08T00:00:00Z",
+    }
+    yield "map_cells", "/map-cells", {"filter_params": filter_params}
+    yield "map_cells_geohash", "/map-cells", {
+        "filter_params": filter_params,
+        "geohash": 4,
+    }
+    yield "spider", "/spider", {"filter_params": filter_params}
+    yield "spider_batch", "/spider-batch", {
+        "filter_params": filter_params,
+        "intervals": monthly_intervals(),
+    }
+
+
+def measure(client, db_client, path, params, repeat):
+    """Seconds per request, after one request to warm up."""
+    assert client.get(path, params=params).status_code == 200
+
+    durations = []
+    for _ in range(repeat):
+        db_client.clear_caches()
+        started = time.perf_counter()
+        response = client.get(path, params=params)
+        durations.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+
+    return np.array(durations)
+
+
+def peak_memory(client, db_client, path, params):
+    """Peak bytes allocated by one request, measured apart from its latency."""
+    db_client.clear_caches()
+    tracemalloc.start()
+    try:
+        client.get(path, params=params)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(durations, peak_bytes):
+    return {
+        "requests_per_second": round(len(durations) / durations.sum(), 2),
+        "p50_ms": round(np.percentile(durations, 50) * 1000, 3),
+        "p95_ms": round(np.percentile(durations, 95) * 1000, 3),
+        "p99_ms": round(np.percentile(durations, 99) * 1000, 3),
+        "peak_memory_mb": round(peak_bytes / 2**20, 2),
+    }
+
+
+def benchmark(rows, repeat, seed=0, compaction="none"):
+    started = time.perf_counter()
+    events, timeseries = generate_dataset(rows, seed=seed)
+    generated = time.perf_counter() - started
+
+    started = time.perf_counter()
+    db_client = DataFrameDBClient(
+        df=events, timeseries=timeseries, compaction=compaction
+    )
+    built = time.perf_counter() - started
+
+    main.db_client = db_client
+    client = TestClient(main.app)
+    results = {
+        "rows": rows,
+        "generate_seconds": round(generated, 3),
+        "build_seconds": round(built, 3),
+        "cases": {},
+    }
+
+    for mix, filter_params in FILTER_MIXES.items():
+        for name, path, params in query_cases(filter_params):
+            durations = measure(client, db_client, path, params, repeat)
+            peak = peak_memory(client, db_client, path, params)
+            results["cases"][f"{name}/{mix}"] = summarize(durations, peak)
+
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(1, rows + 1, size=repeat)
+    durations = np.array(
+        [measure(client, db_client, f"/detail/{id}", {}, 1)[0] for id in ids]
+    )
+    peak = peak_memory(client, db_client, f"/detail/{ids[0]}", {})
+    results["cases"]["detail/random"] = summarize(durations, peak)
+
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Cases whose median latency grew by more than `tolerance` over baseline."""
+    baseline_runs = {run["rows"]: run["cases"] for run in baseline["runs"]}
+
+    for run in results["runs"]:
+        for case, summary in run["cases"].items():
+            before = baseline_runs.get(run["rows"], {}).get(case)
+            if before and summary["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+                yield run["rows"], case, before["p50_ms"], summary["p50_ms"]
+
+
+def print_run(run):
+    print(
+        f"\n{run['rows']} rows, generated in {run['generate_seconds']}s, "
+        f"client built in {run['build_seconds']}s"
+    )
+    print(
+        f"{'case':<32}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+    )
+    for case, summary in run["cases"].items():
+        print(
+            f"{case:<32}{summary['requests_per_second']:>10}{summary['p50_ms']:>10}"
+            f"{summary['p95_ms']:>10}{summary['p99_ms']:>10}{summary['peak_memory_mb']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the query engine")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--repeat", type=int, default=20, help="requests per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compaction", choices=MODES, default="none")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown of the median against the baseline",
+    )
+    args = parser.parse_args()
+
+    # every request should hit the client, not the response cache
+    FastAPICache.init(InMemoryBackend(), prefix="benchmark", enable=False)
+
+    results = {"runs": []}
+    for rows in args.rows:
+        run = benchmark(rows, args.repeat, seed=args.seed, compaction=args.compaction)
+        print_run(run)
+        results["runs"].append(run)
+
+    # kilobytes on Linux
+    results["max_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    print(f"\nmax RSS {results['max_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        slower = list(regressions(results, baseline, args.tolerance))
+        for rows, case, before, after in slower:
+            print(f"REGRESSION {rows} rows {case}: p50 {before} ms -> {after} ms")
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,287 @@
+from calendar import monthrange
+
+import numpy as np
+import pandas as pd
+import pytest
+from app.aggregates import (
+    RESOLUTIONS,
+    AggregateCube,
+    CountPyramid,
+    bin_edges,
+    choose_resolution,
+    count_per_bin,
+    count_per_day,
+    day_ordinals,
+    nest_day_counts,
+)
+from app.filters import OPERATOR_MAP
+
+
+def day_histogram(start):
+    first_day, counts = count_per_day(day_ordinals(start))
+    return nest_day_counts(first_day, counts)
+
+
+def test_day_ordinals_use_wall_clock_date():
+    start = pd.Series(["1970-01-02T00:30:00+02:00", "1970-01-02T23:30:00+02:00"])
+    assert day_ordinals(start).tolist() == [1, 1]
+
+
+def test_histogram_zero_fills_whole_years():
+    histogram = day_histogram(pd.Series(["2022-02-02T00:00:00+00:00"]))
+
+    assert list(histogram) == [2022]
+    assert list(histogram[2022]) == list(range(1, 13))
+    assert [len(histogram[2022][month]) for month in range(1, 13)] == [
+        monthrange(2022, month)[1] for month in range(1, 13)
+    ]
+    assert histogram[2022][2][2] == 1
+    assert sum(sum(days.values()) for days in histogram[2022].values()) == 1
+
+
+def test_histogram_matches_per_row_count():
+    rng = np.random.default_rng(0)
+    seconds = rng.integers(0, 20 * 365 * 86400, 1000)
+    start = pd.Series(pd.to_datetime(seconds, unit="s")).sort_values()
+
+    expected = {
+        year: {
+            month: {day: 0 for day in range(1, monthrange(year, month)[1] + 1)}
+            for month in range(1, 13)
+        }
+        for year in range(start.iloc[0].year, start.iloc[-1].year + 1)
+    }
+    for timestamp in start:
+        expected[timestamp.year][timestamp.month][timestamp.day] += 1
+
+    assert day_histogram(start) == expected
+
+
+def test_histogram_empty():
+    assert day_histogram(pd.Series([], dtype="datetime64[ns]")) == {}
+
+
+def posix(timestamp):
+    return int(pd.Timestamp(timestamp, tz="UTC").timestamp())
+
+
+@pytest.mark.parametrize(
+    "resolution, first, second, last",
+    [
+        ("year", "2000-01-01", "2001-01-01", "2001-01-01"),
+        ("month", "2000-03-01", "2000-04-01", "2000-05-01"),
+        ("week", "2000-03-13", "2000-03-20", "2000-05-01"),
+        ("day", "2000-03-14", "2000-03-15", "2000-05-01"),
+        ("hour", "2000-03-14 07:00", "2000-03-14 08:00", "2000-05-01"),
+    ],
+)
+def test_bin_edges_cover_interval(resolution, first, second, last):
+    edges = bin_edges(resolution, posix("2000-03-14 07:30"), posix("2000-05-01"))
+
+    assert edges[:2].tolist() == [posix(first), posix(second)]
+    assert edges[-1] == posix(last)
+
+
+def test_choose_resolution():
+    start = posix("2000-01-01")
+
+    assert choose_resolution(start, posix("2040-01-01"), 200) == "year"
+    assert choose_resolution(start, posix("2010-01-01"), 200) == "month"
+    assert choose_resolution(start, posix("2001-01-01"), 200) == "week"
+    assert choose_resolution(start, posix("2000-03-01"), 200) == "day"
+    assert choose_resolution(start, posix("2000-01-05"), 200) == "hour"
+
+
+@pytest.mark.parametrize("resolution", RESOLUTIONS)
+def test_count_pyramid_matches_per_row_count(resolution):
+    rng = np.random.default_rng(2)
+    start_time = np.sort(rng.integers(posix("1999-06-01"), posix("2001-06-01"), 2000))
+    pyramid = CountPyramid(start_time)
+
+    for start, end in [
+        ("1999-01-01", "2002-01-01"),
+        ("2000-02-10 13:20", "2000-04-02"),
+        ("2030-01-01", "2030-01-02"),
+    ]:
+        edges = bin_edges(resolution, posix(start), posix(end))
+        expected = count_per_bin(start_time, edges)
+
+        assert pyramid.counts(resolution, edges).tolist() == expected.tolist()
+
+
+def test_extended_count_pyramid_matches_per_row_count():
+    rng = np.random.default_rng(3)
+    start_time = rng.integers(posix("1999-06-01"), posix("2001-06-01"), 3000)
+    pyramid = (
+        CountPyramid(np.zeros(0, dtype=np.int64))
+        .extended(start_time[:1000])
+        .extended(start_time[1000:2000] + 86400 * 365)
+        .extended(start_time[2000:] - 86400 * 365)
+    )
+    start_time[1000:2000] += 86400 * 365
+    start_time[2000:] -= 86400 * 365
+
+    for resolution in RESOLUTIONS:
+        edges = bin_edges(resolution, posix("1998-01-01"), posix("2003-01-01"))
+        expected = count_per_bin(start_time, edges)
+
+        assert pyramid.counts(resolution, edges).tolist() == expected.tolist()
+
+
+def test_count_pyramid_empty():
+    pyramid = CountPyramid(np.zeros(0, dtype=np.int64))
+    edges = bin_edges("month", posix("2000-01-01"), posix("2000-03-01"))
+
+    assert pyramid.span is None
+    assert pyramid.counts("month", edges).tolist() == [0, 0]
+
+
+@pytest.fixture()
+def events():
+    rng = np.random.default_rng(1)
+    size = 5000
+    start_time = np.sort(rng.integers(10 * 365 * 86400, 13 * 365 * 86400, size))
+
+    return pd.DataFrame(
+        {
+            "event_id": np.arange(size),
+            "area": rng.integers(1, 500, size).astype(float),
+            "length": rng.integers(1, 72, size),
+            "severity_index": rng.gamma(1.5, 1.0, size).round(2),
+            "start": pd.to_datetime(start_time, unit="s", utc=True),
+            "start_time": start_time,
+        }
+    )
+
+
+def cube_over(events):
+    return AggregateCube(
+        day_ordinals(events["start"]),
+        events["start_time"].to_numpy(),
+        {
+            field: events[field].to_numpy()
+            for field in ("area", "length", "severity_index")
+        },
+    )
+
+
+@pytest.fixture()
+def cube(events):
+    return cube_over(events)
+
+
+def filter_rows(events, predicates):
+    mask = np.ones(len(events), dtype=bool)
+    for (field, operator, value) in predicates:
+        mask &= OPERATOR_MAP[operator](events[field], value)
+    return events[mask]
+
+
+@pytest.mark.parametrize(
+    "predicates",
+    [
+        (),
+        (
+            ("start_time", "gte", 11 * 365 * 86400),
+            ("start_time", "lt", 12 * 365 * 86400),
+        ),
+        (("area", "gte", 0),),
+        (("length", "lt", 1000), ("severity_index", "neq", -1)),
+    ],
+)
+def test_cube_answers_aligned_filters(events, cube, predicates):
+    rows = filter_rows(events, predicates)
+
+    first_day, counts = count_per_day(day_ordinals(rows["start"]))
+    cube_first_day, cube_counts = cube.day_counts(predicates)
+    assert cube_first_day == first_day
+    assert cube_counts.tolist() == counts.tolist()
+
+    statistics = cube.statistics(predicates)
+    assert statistics["count"] == len(rows)
+    assert statistics["first_start_time"] == rows["start_time"].min()
+    assert statistics["last_start_time"] == rows["start_time"].max()
+    for field in ("area", "length", "severity_index"):
+        assert statistics[field] == pytest.approx(rows[field].mean())
+
+
+def test_cube_answers_filters_on_bucket_bounds(events, cube):
+    edge = cube._bounds["area"][0][1]
+    predicates = (("area", "gte", edge),)
+
+    assert cube.statistics(predicates)["count"] == len(filter_rows(events, predicates))
+
+
+def test_cube_rejects_unaligned_filters(events, cube):
+    # a start time in the middle of a day with several events
+    days = day_ordinals(events["start"])
+    (same_day,) = np.nonzero(days[1:] == days[:-1])
+    start_time = events["start_time"].iloc[same_day[0] + 1]
+
+    assert cube.day_counts((("start_time", "gte", start_time),)) is None
+    assert cube.statistics((("area", "gt", 250.5),)) is None
+
+
+def test_cube_means_skip_nan(events):
+    events.loc[::2, "area"] = np.nan
+    cube = AggregateCube(
+        day_ordinals(events["start"]),
+        events["start_time"].to_numpy(),
+        {"area": events["area"].to_numpy()},
+    )
+
+    assert cube.statistics(())["area"] == pytest.approx(events["area"].mean())
+    assert cube.statistics((("area", "neq", -1),))["count"] == len(
+        filter_rows(events, (("area", "neq", -1),))
+    )
+
+
+def extend_cube(cube, events):
+    return cube.extended(
+        day_ordinals(events["start"]),
+        events["start_time"].to_numpy(),
+        {
+            field: events[field].to_numpy()
+            for field in ("area", "length", "severity_index")
+        },
+    )
+
+
+@pytest.mark.parametrize(
+    "predicates",
+    [
+        (),
+        (("start_time", "gte", 11 * 365 * 86400),),
+        (("area", "gte", 0), ("length", "lt", 1000)),
+    ],
+)
+def test_extended_cube_matches_rows(events, predicates):
+    # the later events span more years, the earlier ones move all days
+    later = events.iloc[3000:].copy()
+    later["start_time"] += 3 * 365 * 86400
+    later["start"] += pd.Timedelta(days=3 * 365)
+    earlier = events.iloc[:500].copy()
+    earlier["start_time"] -= 2 * 365 * 86400
+    earlier["start"] -= pd.Timedelta(days=2 * 365)
+
+    cube = extend_cube(extend_cube(cube_over(events.iloc[:3000]), later), earlier)
+    rows = filter_rows(pd.concat([events.iloc[:3000], later, earlier]), predicates)
+
+    first_day, counts = count_per_day(day_ordinals(rows["start"]))
+    cube_first_day, cube_counts = cube.day_counts(predicates)
+    assert cube_first_day == first_day
+    assert cube_counts.tolist() == counts.tolist()
+
+    statistics = cube.statistics(predicates)
+    assert statistics["count"] == len(rows)
+    assert statistics["first_start_time"] == rows["start_time"].min()
+    assert statistics["last_start_time"] == rows["start_time"].max()
+    for field in ("area", "length", "severity_index"):
+        assert statistics[field] == pytest.approx(rows[field].mean())
+
+
+def test_extended_cube_needs_nan_bucket(events):
+    later = events.iloc[3000:].copy()
+    later["area"] = np.nan
+
+    assert extend_cube(cube_over(events.iloc[:3000]), later) is None
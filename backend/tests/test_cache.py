@@ -0,0 +1,174 @@
+import asyncio
+import sys
+
+import pytest
+from app.cache import BoundedInMemoryBackend, single_flight
+from fastapi import Response
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def key(endpoint, params):
+    return f"cache::main:{endpoint}:():{{}}:{params}:None"
+
+
+async def compute(backend, clock, key, value, seconds):
+    # what the `cache` decorator does on a miss
+    assert await backend.get(key) is None
+    clock.now += seconds
+    await backend.set(key, value, expire=3600)
+
+
+@pytest.mark.asyncio
+async def test_cache_stays_within_budget():
+    clock = FakeClock()
+    value = "x" * 100
+    backend = BoundedInMemoryBackend(max_bytes=3 * sys.getsizeof(value), clock=clock)
+
+    for i in range(5):
+        await compute(backend, clock, key("query", i), value, seconds=1)
+
+    stats = backend.stats()
+    assert stats["entries"] == 3
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert stats["endpoints"]["query"] == {"hits": 0, "misses": 5, "evictions": 2}
+
+
+@pytest.mark.asyncio
+async def test_cache_evicts_cheap_entries_first():
+    clock = FakeClock()
+    value = "x" * 100
+    backend = BoundedInMemoryBackend(max_bytes=2 * sys.getsizeof(value), clock=clock)
+
+    await compute(backend, clock, key("query", "expensive"), value, seconds=10)
+    await compute(backend, clock, key("spider", "cheap"), value, seconds=0.1)
+    await compute(backend, clock, key("query", "new"), value, seconds=1)
+
+    assert await backend.get(key("query", "expensive")) == value
+    assert await backend.get(key("spider", "cheap")) is None
+    assert backend.stats()["endpoints"]["spider"]["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_hits_keep_entries():
+    clock = FakeClock()
+    value = "x" * 100
+    backend = BoundedInMemoryBackend(max_bytes=2 * sys.getsizeof(value), clock=clock)
+
+    await compute(backend, clock, key("query", 1), value, seconds=1)
+    await compute(backend, clock, key("query", 2), value, seconds=1)
+
+    await compute(backend, clock, key("query", 3), value, seconds=1)
+    assert await backend.get(key("query", 1)) is None
+
+    # the hit makes the third entry worth more than the untouched second one
+    assert await backend.get(key("query", 3)) == value
+    await compute(backend, clock, key("query", 4), value, seconds=1)
+    assert await backend.get(key("query", 3)) == value
+    assert backend.stats()["endpoints"]["query"]["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_skips_responses_larger_than_budget():
+    backend = BoundedInMemoryBackend(max_bytes=10)
+
+    await backend.set(key("query", 1), "x" * 100)
+
+    assert backend.stats()["entries"] == 0
+    assert await backend.get(key("query", 1)) is None
+
+
+def key_of_query(func, namespace, request=None, response=None, args=(), kwargs=None):
+    return kwargs["query"]
+
+
+@pytest.mark.asyncio
+async def test_cache_invalidates_affected_entries():
+    clock = FakeClock()
+    backend = BoundedInMemoryBackend(max_bytes=1024 * 1024, clock=clock)
+
+    for name, filters in [
+        ("small", (("area", "lt", 5.0),)),
+        ("large", (("area", "gt", 100.0),)),
+        ("all", ()),
+    ]:
+        backend.tag(key("query", name), filters)
+        await compute(backend, clock, key("query", name), name, seconds=1)
+    # never tagged, so it can't tell what the response depends on
+    await compute(backend, clock, key("query", "untagged"), "untagged", seconds=1)
+
+    asked = []
+
+    def affected(filters):
+        asked.append(filters)
+        return filters != (("area", "lt", 5.0),)
+
+    assert await backend.invalidate(affected) == 3
+    assert len(asked) == 3
+    assert await backend.get(key("query", "small")) == "small"
+    assert backend.stats()["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_skips_responses_computed_before_invalidation():
+    clock = FakeClock()
+    backend = BoundedInMemoryBackend(max_bytes=1024 * 1024, clock=clock)
+
+    assert await backend.get(key("query", "slow")) is None
+    clock.now += 1
+    await backend.invalidate(lambda filters: True)
+    await backend.set(key("query", "slow"), "outdated", expire=3600)
+
+    assert await backend.get(key("query", "slow")) is None
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    @single_flight(key_builder=key_of_query)
+    async def endpoint(query, response=None):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        response.status_code = 400
+        return {"query": query}
+
+    responses = [Response() for _ in range(4)]
+    results = await asyncio.gather(
+        *(
+            endpoint(query=query, response=response)
+            for query, response in zip(["a", "a", "b", "a"], responses)
+        )
+    )
+
+    assert sorted(calls) == ["a", "b"]
+    assert results == [{"query": "a"}, {"query": "a"}, {"query": "b"}, {"query": "a"}]
+    assert [response.status_code for response in responses] == [400] * 4
+
+    # once finished, the same key is computed again
+    await endpoint(query="a", response=Response())
+    assert sorted(calls) == ["a", "a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_exceptions():
+    calls = []
+
+    @single_flight(key_builder=key_of_query)
+    async def endpoint(query):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        raise ValueError(query)
+
+    results = await asyncio.gather(
+        endpoint(query="a"), endpoint(query="a"), return_exceptions=True
+    )
+
+    assert len(calls) == 1
+    assert [str(result) for result in results] == ["a", "a"]
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.compaction import (
+    check_mode,
+    column_usage,
+    compact_column,
+    compact_frame,
+    concat,
+    memory_report,
+    wide_dtype,
+)
+
+
+@pytest.mark.parametrize(
+    "values, dtype",
+    [
+        ([1, 2, 127], np.int8),
+        ([-1, 240], np.int16),
+        ([0, 2**31], np.int64),
+        ([0.5, 1.25, np.nan], np.float32),
+        ([0.1, 1.25], np.float64),
+        (
+            ["2022-01-01T00:00:00+00:00", "2022-02-01T12:00:00+00:00"],
+            "datetime64[ns, UTC]",
+        ),
+        (["2022-01-01T00:00:00", "2022-02-01T12:00:00"], "datetime64[ns]"),
+        (["a", "b", "a", "a"], "category"),
+    ],
+)
+def test_compact_column(values, dtype):
+    compacted = compact_column(pd.Series(values))
+
+    pd.testing.assert_series_equal(compacted, pd.Series(values).astype(dtype))
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        # the strings would not come back like this from the datetimes
+        ["2022-01-01T00:00:00Z", "2022-02-01T12:00:00Z"],
+        ["2022-01-01T00:00:00.5+00:00", "2022-02-01T12:00:00+00:00"],
+        ["2022-01-01T00:00:00+01:00", "2022-02-01T12:00:00+01:00"],
+        # as many categories as values
+        ["a", "b", "c"],
+        [["a"], ["b"], ["a"]],
+    ],
+)
+def test_compact_column_keeps_objects(values):
+    series = pd.Series(values)
+
+    assert compact_column(series) is series
+
+
+def test_compact_column_dates_roundtrip():
+    values = pd.Series(["2022-01-01T00:00:00+00:00", "2022-02-01T12:00:00+00:00"])
+
+    dates = compact_column(values)
+
+    assert dates.map(pd.Timestamp.isoformat).tolist() == values.tolist()
+
+
+def test_compact_column_float32():
+    values = pd.Series([0.1, 52.5123, np.nan])
+
+    assert compact_column(values) is values
+
+    compacted = compact_column(values, float32=True)
+    assert compacted.dtype == np.float32
+    assert np.allclose(compacted, values, equal_nan=True)
+
+    # would overflow to infinity
+    assert compact_column(pd.Series([1e300]), float32=True).dtype == np.float64
+
+
+def test_compact_frame():
+    df = pd.DataFrame({"a": [1, 2], "b": [1.5, 2.5], "c": [3, 4]})
+
+    compacted = compact_frame(df, keep=["c"])
+
+    assert compacted.dtypes.tolist() == [np.int8, np.float32, np.int64]
+    assert compact_frame(compacted, keep=["c"]) is compacted
+
+
+def test_wide_dtype():
+    assert wide_dtype(np.dtype(np.int8)) == np.int64
+    assert wide_dtype(np.dtype(np.float32)) == np.float64
+    assert wide_dtype(pd.CategoricalDtype(["a"])) == "category"
+    assert wide_dtype(np.dtype(object)) == object
+
+
+def test_concat_unions_categories():
+    first = pd.DataFrame({"kind": pd.Categorical(["a", "b"]), "n": np.int8([1, 2])})
+    second = pd.DataFrame({"kind": pd.Categorical(["c"]), "n": [300]})
+
+    df = concat([first, second])
+
+    assert df["kind"].dtype == "category"
+    assert df["kind"].tolist() == ["a", "b", "c"]
+    assert df["n"].tolist() == [1, 2, 300]
+
+
+def test_memory_report():
+    df = pd.DataFrame({"a": np.arange(100), "b": ["x"] * 100})
+    before = pd.concat({"events": column_usage(df)})
+    after = pd.concat({"events": column_usage(compact_frame(df))})
+
+    report = memory_report(before, after)
+
+    assert report.loc[("events", "a"), "bytes_before"] == 800
+    assert report.loc[("events", "a"), "bytes_after"] == 100
+    assert report.loc[("events", "b"), "dtype_after"] == "category"
+    assert report.loc[("total", ""), "bytes_before"] == before["bytes"].sum()
+    assert 0.5 < report.loc[("total", ""), "saved"] < 1
+
+
+def test_check_mode():
+    check_mode("lossless")
+
+    with pytest.raises(ValueError):
+        check_mode("float16")
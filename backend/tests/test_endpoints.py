@@ -0,0 +1,442 @@
+import json
+
+import pandas as pd
+import pytest
+from app import main
+from app.cache import BoundedInMemoryBackend
+from app.constants import COLUMNAR_MEDIA_TYPE
+from app.models import DataFrameDBClient
+from fastapi.testclient import TestClient
+from fastapi_cache import FastAPICache
+
+
+@pytest.fixture()
+def data_frame():
+    start = pd.date_range("2022-01-01", periods=10, freq="10D", tz="UTC")
+
+    return pd.DataFrame(
+        {
+            "event_id": range(1, 11),
+            "area": [float(i) for i in range(1, 11)],
+            "length": range(1, 11),
+            "severity_index": [i / 10 for i in range(1, 11)],
+            "start": start,
+            "start_time": start.asi8 // 10**9,
+            "timeseries": [[] for _ in range(10)],
+        }
+    )
+
+
+@pytest.fixture()
+def mock_app(data_frame, monkeypatch):
+    monkeypatch.setattr(main, "db_client", DataFrameDBClient(df=data_frame))
+    # FastAPICache only initializes once, start every test with a fresh cache
+    monkeypatch.setattr(FastAPICache, "_init", False)
+    FastAPICache.init(BoundedInMemoryBackend(max_bytes=1024 * 1024), prefix="cache")
+
+    return TestClient(main.app)
+
+
+def test_spider(mock_app):
+    response = mock_app.get(
+        "/spider",
+        params={"start": "2022-01-01T00:00:00Z", "end": "2022-02-01T00:00:00Z"},
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "area": 2.5,
+        "length": 2.5,
+        "severity_index": 0.2,
+        "events_per_day": 0.1,
+    }
+
+
+def test_spider_invalid_filter(mock_app):
+    response = mock_app.get("/spider", params={"filter_params": "meanLat__gt=1"})
+
+    assert response.status_code == 400
+
+
+def test_spider_batch_matches_spider(mock_app):
+    intervals = [
+        ("", ""),
+        ("2022-01-05T00:00:00Z", "2022-03-01T00:00:00Z"),
+        ("2023-01-01T00:00:00Z", "2024-01-01T00:00:00Z"),
+    ]
+    filter_params = "area__gt=2.5"
+
+    response = mock_app.get(
+        "/spider-batch",
+        params={
+            "intervals": [f"{start}/{end}" for start, end in intervals],
+            "filter_params": filter_params,
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.json() == [
+        mock_app.get(
+            "/spider",
+            params={"start": start, "end": end, "filter_params": filter_params},
+        ).json()
+        for start, end in intervals
+    ]
+
+
+def test_overview_histogram_resolution(mock_app):
+    response = mock_app.get(
+        "/overview-histogram",
+        params={
+            "resolution": "auto",
+            "start": "2022-01-01T00:00:00Z",
+            "end": "2022-04-01T00:00:00Z",
+            "bins": 20,
+            "filter_params": "area__gt=2",
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "resolution": "week",
+        # weeks start on Mondays, 2021-12-27 is the Monday before
+        "start_time": [1640563200 + week * 7 * 86400 for week in range(14)],
+        "count": [0, 0, 0, 1, 0, 1, 1, 1, 0, 1, 1, 0, 1, 1],
+    }
+
+
+def test_overview_histogram_invalid_resolution(mock_app):
+    response = mock_app.get("/overview-histogram", params={"resolution": "decade"})
+
+    assert response.status_code == 400
+
+
+def test_query_columnar_format(mock_app):
+    params = {"filter_params": "area__gt=8", "fields": ["event_id", "length"]}
+
+    records = mock_app.get("/query", params=params)
+    columns = mock_app.get("/query", params={**params, "format": "columns"})
+    accepted = mock_app.get(
+        "/query", params=params, headers={"Accept": COLUMNAR_MEDIA_TYPE}
+    )
+
+    assert records.json() == {
+        "count": 2,
+        "results": [{"event_id": 9, "length": 9}, {"event_id": 10, "length": 10}],
+    }
+    assert columns.json() == {
+        "count": 2,
+        "columns": {"event_id": [9, 10], "length": [9, 10]},
+    }
+    assert accepted.json() == columns.json()
+
+
+@pytest.mark.parametrize("path", ["/query", "/query-stream"])
+def test_query_negative_limit(mock_app, path):
+    response = mock_app.get(path, params={"limit": -1, "area__gt": 10000})
+
+    assert response.status_code == 422
+    assert mock_app.get(path, params={"limit": 0}).status_code == 200
+
+
+def test_query_unknown_format(mock_app):
+    response = mock_app.get("/query", params={"format": "xml"})
+
+    assert response.status_code == 400
+
+
+def test_query_stream(mock_app):
+    response = mock_app.get(
+        "/query-stream",
+        params={
+            "filter_params": "area__gt=6",
+            "fields": ["event_id", "start"],
+            "limit": 3,
+            "chunk_size": 2,
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"count": 4},
+        {"event_id": 7, "start": "2022-03-02T00:00:00+00:00"},
+        {"event_id": 8, "start": "2022-03-12T00:00:00+00:00"},
+        {"event_id": 9, "start": "2022-03-22T00:00:00+00:00"},
+    ]
+
+
+def test_query_stream_serializes_chunks_on_worker_pool(mock_app, monkeypatch):
+    calls = []
+    run_admitted = main.db_pool.run_admitted
+
+    async def counting(func, *args, **kwargs):
+        calls.append(func)
+        return await run_admitted(func, *args, **kwargs)
+
+    monkeypatch.setattr(main.db_pool, "run_admitted", counting)
+
+    response = mock_app.get(
+        "/query-stream",
+        params={"filter_params": "area__gt=6", "fields": ["event_id"], "chunk_size": 2},
+    )
+
+    assert [json.loads(line) for line in response.text.splitlines()][1:] == [
+        {"event_id": event_id} for event_id in (7, 8, 9, 10)
+    ]
+    # the query, two chunks of two results and the call finding no more
+    assert [func.__name__ for func in calls] == [
+        "stream_query_events",
+        "next_lines",
+        "next_lines",
+        "next_lines",
+    ]
+
+
+def test_query_stream_invalid_filter(mock_app):
+    response = mock_app.get("/query-stream", params={"filter_params": "foo__gt=6"})
+
+    assert response.status_code == 400
+
+
+def test_cache_stats(mock_app):
+    mock_app.get("/spider")
+    mock_app.get("/spider")
+
+    response = mock_app.get("/cache-stats")
+
+    assert response.status_code == 200
+    assert response.json()["endpoints"]["spider"] == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+def test_equivalent_queries_share_cache_entry(mock_app):
+    first = mock_app.get("/query?length__lt=5&area__gt=1")
+    second = mock_app.get("/query?area__gt=1.0&length__lt=5&area__gt=1")
+    third = mock_app.get("/query", params={"filter_params": "area__gt=1&length__lt=5"})
+
+    assert first.json()["count"] == 3
+    assert second.json() == third.json() == first.json()
+    assert mock_app.get("/cache-stats").json()["endpoints"]["query"] == {
+        "hits": 2,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+def test_saturated_worker_pool(mock_app, monkeypatch):
+    async def saturated(*args, **kwargs):
+        raise main.PoolSaturatedError("busy")
+
+    monkeypatch.setattr(main.db_pool, "run", saturated)
+
+    response = mock_app.get("/overview-histogram")
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert mock_app.get("/detail/1").status_code == 200
+
+
+def test_query_sorted_pages(mock_app):
+    params = {
+        "filter_params": "area__gt=3",
+        "fields": ["event_id"],
+        "sort_by": "severity_index",
+        "order": "desc",
+        "limit": 3,
+    }
+
+    first = mock_app.get("/query", params=params).json()
+    second = mock_app.get(
+        "/query", params={**params, "cursor": first["next_cursor"]}
+    ).json()
+    third = mock_app.get(
+        "/query", params={**params, "cursor": second["next_cursor"]}
+    ).json()
+
+    assert first["count"] == 7
+    assert [r["event_id"] for r in first["results"]] == [10, 9, 8]
+    assert [r["event_id"] for r in second["results"]] == [7, 6, 5]
+    assert third == {"count": 7, "results": [{"event_id": 4}]}
+
+
+def test_query_cursor_for_other_sort(mock_app):
+    params = {"sort_by": "area", "limit": 3}
+    first = mock_app.get("/query", params=params).json()
+
+    response = mock_app.get(
+        "/query", params={**params, "order": "desc", "cursor": first["next_cursor"]}
+    )
+
+    assert response.status_code == 400
+
+
+def test_server_timing_header(mock_app):
+    response = mock_app.get("/query", params={"filter_params": "area__gt=3"})
+
+    stages = [
+        timing.split(";")[0] for timing in response.headers["server-timing"].split(", ")
+    ]
+
+    assert stages[-1] == "total"
+    assert {"queue", "filter", "materialize", "endpoint", "serialize"} <= set(stages)
+
+
+def test_metrics(mock_app):
+    mock_app.get("/query", params={"filter_params": "area__gt=3", "limit": 2})
+    mock_app.get("/query", params={"filter_params": "area__gt=3", "limit": 2})
+
+    response = mock_app.get("/metrics")
+    lines = response.text.splitlines()
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert any(
+        line.startswith('http_request_duration_seconds_count{endpoint="/query"}')
+        for line in lines
+    )
+    assert any(
+        line.startswith(
+            'request_stage_duration_seconds_count{endpoint="/query",stage="filter"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith('db_rows_returned_total{endpoint="/query"}') for line in lines
+    )
+    assert 'response_cache_hit_ratio{endpoint="query"} 0.5' in lines
+
+
+def test_query_location_without_locations(mock_app):
+    response = mock_app.get("/query?location__within=47,5,55,15")
+
+    assert response.status_code == 400
+
+
+def test_map_cells(mock_app, data_frame, monkeypatch):
+    data_frame["meanLat"] = [50.5] * 5 + [10.5] * 5
+    data_frame["meanLon"] = [8.5] * 5 + [float("nan")] * 4 + [20.5]
+    data_frame.loc[0, "severity_index"] = float("nan")
+    monkeypatch.setattr(main, "db_client", DataFrameDBClient(df=data_frame))
+
+    response = mock_app.get("/map-cells?area__lte=9")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "cell_height": 1.0,
+        "cell_width": 1.0,
+        "south": [50.0],
+        "west": [8.0],
+        "count": [5],
+        "severity_index": [0.35],
+        "area": [15.0],
+    }
+
+    response = mock_app.get("/map-cells?geohash=2&location__within=0,0,20,30")
+
+    assert response.status_code == 200
+    assert response.json()["geohash"] == ["s3"]
+    assert response.json()["severity_index"] == [1.0]
+
+
+def test_map_cells_invalid(mock_app):
+    assert mock_app.get("/map-cells").status_code == 400
+    assert mock_app.get("/map-cells?cell_size=1&geohash=3").status_code == 400
+
+
+def test_count(mock_app):
+    response = mock_app.get("/count?area__gt=3&length__lte=8")
+
+    assert response.status_code == 200
+    assert response.json() == {"count": 5}
+
+    response = mock_app.get("/count?approximate=true&area__gt=3&length__lte=8")
+
+    assert response.status_code == 200
+    assert response.json() == {"count": 6, "lower": 5, "upper": 7}
+
+    assert mock_app.get("/count?area__between=3").status_code == 400
+    assert mock_app.get("/count?approximate=true&area__between=3").status_code == 400
+
+
+def test_add_events(mock_app, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    event = {
+        "event_id": 11,
+        "area": 20.0,
+        "length": 11,
+        "severity_index": 1.1,
+        "start": "2022-05-01T00:00:00+00:00",
+        "start_time": 1651363200,
+    }
+
+    assert mock_app.get("/query?area__lt=3").json()["count"] == 2
+    assert mock_app.get("/query?area__gt=9").json()["count"] == 1
+
+    assert mock_app.post("/events", json=[event]).status_code == 403
+    response = mock_app.post(
+        "/events", json=[event], headers={"Authorization": "Bearer secret"}
+    )
+
+    assert response.status_code == 200
+    assert response.json() == {"added": 1, "events": 11, "invalidated": 1}
+    assert mock_app.get("/query?area__gt=9").json()["count"] == 2
+    assert mock_app.get("/query?area__lt=3").json()["count"] == 2
+    assert mock_app.get("/cache-stats").json()["endpoints"]["query"]["hits"] == 1
+    assert mock_app.get("/detail/11").json()["area"] == 20.0
+
+    response = mock_app.post(
+        "/events", json=[event], headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 400
+
+
+def test_add_events_invalidates_estimates(mock_app, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    event = {
+        "event_id": 11,
+        "area": 1.0,
+        "length": 11,
+        "severity_index": 1.1,
+        "start": "2022-05-01T00:00:00+00:00",
+        "start_time": 1651363200,
+    }
+
+    mock_app.get("/count?area__gt=9")
+    mock_app.get("/count?approximate=true&area__gt=9&length__gt=5")
+    response = mock_app.post(
+        "/events", json=[event], headers={"Authorization": "Bearer secret"}
+    )
+
+    # the estimate scales with the number of events, matching the filters or not
+    assert response.json()["invalidated"] == 1
+    assert mock_app.get("/count?area__gt=9").json() == {"count": 1}
+    assert mock_app.get("/cache-stats").json()["endpoints"]["count"]["hits"] == 1
+
+
+def test_add_events_with_several_workers(mock_app, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main, "WORKER_PROCESSES", 4)
+
+    response = mock_app.post(
+        "/events", json=[{"event_id": 11}], headers={"Authorization": "Bearer secret"}
+    )
+
+    assert response.status_code == 409
+    assert mock_app.get("/query").json()["count"] == 10
+
+
+def test_reload(mock_app, data_frame, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    DataFrameDBClient(df=data_frame.iloc[:4]).save(str(tmp_path / "dataset"))
+    monkeypatch.setattr(main, "DATASET_PATH", str(tmp_path / "dataset"))
+
+    assert mock_app.get("/query").json()["count"] == 10
+    assert mock_app.post("/reload").status_code == 403
+    response = mock_app.post("/reload", headers={"Authorization": "Bearer secret"})
+
+    assert response.json() == {"events": 4, "invalidated": 1}
+    assert mock_app.get("/query").json()["count"] == 4
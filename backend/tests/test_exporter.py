@@ -0,0 +1,15 @@
+import importlib
+import json
+
+from app import exporter
+
+
+def test_exported_constants_hold_no_admin_token(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "s3cret")
+    importlib.reload(exporter.constants)
+
+    exported = exporter.exported_constants()
+
+    assert "AREA" in exported
+    assert "ADMIN_TOKEN" not in exported
+    assert "s3cret" not in json.dumps(exported)
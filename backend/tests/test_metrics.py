@@ -0,0 +1,47 @@
+from app.metrics import REGISTRY, Counter, Histogram, RequestTimings, render, timed
+from app.metrics import _current_timings
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram(
+        "test_latency_seconds", "Test latencies.", ("endpoint",), buckets=(0.1, 1.0)
+    )
+    counter = Counter("test_requests_total", "Test requests.", ("endpoint",))
+    try:
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, endpoint="/query")
+        counter.inc(endpoint='/say "hi"')
+
+        lines = render().splitlines()
+    finally:
+        REGISTRY.remove(histogram)
+        REGISTRY.remove(counter)
+
+    assert "# TYPE test_latency_seconds histogram" in lines
+    assert 'test_latency_seconds_bucket{endpoint="/query",le="0.1"} 2.0' in lines
+    assert 'test_latency_seconds_bucket{endpoint="/query",le="1.0"} 3.0' in lines
+    assert 'test_latency_seconds_bucket{endpoint="/query",le="+Inf"} 4.0' in lines
+    assert 'test_latency_seconds_sum{endpoint="/query"} 3.65' in lines
+    assert 'test_latency_seconds_count{endpoint="/query"} 4.0' in lines
+    assert 'test_requests_total{endpoint="/say \\"hi\\""} 1.0' in lines
+
+
+def test_timed_stages_add_up_per_request():
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        with timed("filter"):
+            pass
+        with timed("sort"):
+            pass
+        with timed("filter"):
+            pass
+    finally:
+        _current_timings.reset(token)
+
+    # outside of a request, stages are not recorded anywhere
+    with timed("filter"):
+        pass
+
+    assert list(timings.stages) == ["filter", "sort"]
+    assert timings.header().startswith("filter;dur=")
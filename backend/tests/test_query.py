@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 import pytest
+from app.filters import OPERATOR_MAP, compile_filters, implies
 from app.models import DataFrameDBClient
 
 
@@ -101,6 +103,43 @@ def test_db_client(db_client):
     }
 
 
+def test_get_event_by_id_unknown_id(db_client):
+    assert db_client.get_event_by_id(42) is None
+
+
+def test_get_event_by_id_duplicate_id_returns_first_row(data_frame):
+    data_frame.loc[5, "event_id"] = 3
+    db_client = DataFrameDBClient(df=data_frame)
+
+    assert db_client.get_event_by_id(3)["start_time"] == 1646265600
+
+
+@pytest.mark.parametrize("compaction", ["none", "lossless"])
+def test_db_client_snapshot_is_read_only(data_frame, compaction):
+    db_client = DataFrameDBClient(df=data_frame, compaction=compaction)
+    snapshot = db_client.df
+    assert np.shares_memory(snapshot["area"].values, db_client._df["area"].values)
+
+    for name in ("area", "start", "event_id"):
+        with pytest.raises(ValueError):
+            snapshot[name].values[2] = snapshot[name].values[0]
+
+    # copies can be modified as usual
+    copied = snapshot.copy()
+    copied.loc[copied["event_id"] == 3, "area"] = 99
+    assert copied["area"].tolist() == [1, 2, 99, 4, 5]
+    assert db_client.df["area"].tolist() == [1, 2, 3, 4, 5]
+    assert len(db_client) == 5
+
+
+def test_db_client_leaves_pandas_options_alone(data_frame):
+    copy_on_write = pd.get_option("mode.copy_on_write")
+
+    DataFrameDBClient(df=data_frame).df
+
+    assert pd.get_option("mode.copy_on_write") == copy_on_write
+
+
 def test_query_no_filters(db_client, json_data):
 
     count, result = db_client.query_events(
@@ -445,3 +484,506 @@ def test_query_multi_filter_datetime(db_client):
         {"event_id": 3},
         {"event_id": 4},
     ]
+
+
+def test_query_multi_filter_neq_and_range(db_client):
+
+    count, result = db_client.query_events(
+        filters=[["area", "neq", 3], ["length", "gte", 2], ["severity_index", "lt", 5]],
+        limit=9999,
+        fields=["event_id"],
+    )
+
+    assert count == 2
+
+    assert result == [
+        {"event_id": 2},
+        {"event_id": 4},
+    ]
+
+
+def test_query_filter_skips_nan_values(data_frame):
+    data_frame["area"] = data_frame["area"].astype(float)
+    data_frame.loc[2, "area"] = np.nan
+    db_client = DataFrameDBClient(df=data_frame)
+
+    _, result = db_client.query_events(
+        filters=[["area", "gte", 0]], limit=None, fields=["event_id"]
+    )
+    assert result == [
+        {"event_id": 1},
+        {"event_id": 3},
+        {"event_id": 4},
+        {"event_id": 5},
+    ]
+
+    _, result = db_client.query_events(
+        filters=[["area", "neq", 1]], limit=None, fields=["event_id"]
+    )
+    assert result == [
+        {"event_id": 2},
+        {"event_id": 3},
+        {"event_id": 4},
+        {"event_id": 5},
+    ]
+
+
+def test_compile_filters_coerces_values():
+    assert compile_filters(
+        [["start_time", "gte", "2022-03-03T00:00:00+00:00"], ["area", "lt", "4"]]
+    ) == (("start_time", "gte", 1646265600), ("area", "lt", 4.0))
+
+
+@pytest.mark.parametrize(
+    "predicate,other,expected",
+    [
+        (("area", "gt", 3.0), ("area", "gt", 1.0), True),
+        (("area", "gt", 1.0), ("area", "gte", 1.0), True),
+        (("area", "gte", 1.0), ("area", "gt", 1.0), False),
+        (("area", "lte", 2.0), ("area", "lt", 3.0), True),
+        (("area", "eq", 2.0), ("area", "lt", 3.0), True),
+        (("area", "gt", 3.0), ("area", "neq", 2.0), True),
+        (("area", "gt", 3.0), ("area", "neq", 4.0), False),
+        (("area", "gt", 1.0), ("area", "lt", 5.0), False),
+        (("area", "gt", 3.0), ("length", "gt", 1.0), False),
+        (
+            ("location", "within", (48.0, 8.0, 49.0, 9.0)),
+            ("location", "within", (47.0, 7.0, 50.0, 9.0)),
+            True,
+        ),
+        (
+            ("location", "within", (47.0, 7.0, 50.0, 9.0)),
+            ("location", "within", (48.0, 8.0, 49.0, 9.0)),
+            False,
+        ),
+        (
+            ("location", "near", (48.5, 8.5, 10.0)),
+            ("location", "within", (48.0, 8.0, 49.0, 9.0)),
+            True,
+        ),
+        (
+            ("location", "within", (48.4, 8.4, 48.6, 8.6)),
+            ("location", "near", (48.5, 8.5, 10.0)),
+            False,
+        ),
+        # circles beyond a hemisphere or around a pole span every longitude
+        (
+            ("location", "near", (50.0, 8.0, 20000.0)),
+            ("location", "within", (-90.0, 7.0, 90.0, 9.0)),
+            False,
+        ),
+        (
+            ("location", "near", (80.0, 8.0, 2000.0)),
+            ("location", "within", (60.0, -172.0, 90.0, 180.0)),
+            False,
+        ),
+    ],
+)
+def test_implies(predicate, other, expected):
+    assert implies(predicate, other) == expected
+
+
+def test_query_narrower_filters_use_cached_superset(db_client):
+    db_client.query_events(filters=[["area", "gte", "2"]], limit=None)
+
+    count, results = db_client.query_events(
+        filters=[["length", "lt", "5"], ["area", "gte", "3"], ["area", "gte", "2"]],
+        limit=None,
+        fields=["event_id"],
+    )
+
+    assert (count, results) == (2, [{"event_id": 3}, {"event_id": 4}])
+
+    # the narrowest cached superset of an even narrower query is the last one
+    cached, positions = db_client._row_sets.lookup(
+        (("area", "gte", 4.0), ("length", "lt", 5.0))
+    )
+    assert cached == (("area", "gte", 2.0), ("area", "gte", 3.0), ("length", "lt", 5.0))
+    assert positions.tolist() == [2, 3]
+
+
+def test_query_location_filters(db_client):
+    def event_ids(filters):
+        _, results = db_client.query_events(
+            filters=filters, limit=None, fields=["event_id"], columnar=True
+        )
+        return results["event_id"]
+
+    assert event_ids([["location", "within", "1.5,1.5,3.5,3.5"]]) == [2, 3]
+    # (2, 2) and (4, 4) are about 157km from (3, 3)
+    assert event_ids([["location", "near", "3,3,160"]]) == [2, 3, 4]
+    assert event_ids([["location", "near", "3,3,160"], ["area", "gt", "2"]]) == [3, 4]
+    assert event_ids(
+        [["location", "within", "0,0,3,3"], ["location", "near", "3,3,160"]]
+    ) == [2, 3]
+
+
+@pytest.mark.parametrize(
+    "operator,value",
+    [
+        ("within", "1,1,2"),
+        ("within", "3,1,2,2"),
+        ("within", "1,1,2,200"),
+        ("near", "1,1,-5"),
+        ("near", "a,b,c"),
+        ("lt", "1"),
+    ],
+)
+def test_query_invalid_location_filter(db_client, operator, value):
+    with pytest.raises(ValueError):
+        db_client.query_events(filters=[["location", operator, value]], limit=None)
+
+
+def test_aggregate_locations(db_client):
+    cells = db_client.aggregate_locations([], cell_size=2.0)
+
+    assert cells["south"].tolist() == [0.0, 2.0, 4.0]
+    assert cells["west"].tolist() == [0.0, 2.0, 4.0]
+    assert cells["count"].tolist() == [1, 2, 2]
+    assert cells["severity_index"].tolist() == [1.0, 2.5, 4.5]
+    assert cells["area"].tolist() == [1.0, 5.0, 9.0]
+
+    cells = db_client.aggregate_locations([["area", "gt", "2"]], cell_size=2.0)
+
+    assert cells["count"].tolist() == [1, 2]
+    assert cells["area"].tolist() == [3.0, 9.0]
+
+
+def test_aggregate_locations_geohash(db_client):
+    cells = db_client.aggregate_locations([["location", "near", "3,3,160"]], geohash=1)
+
+    assert cells["geohash"] == ["s"]
+    assert cells["count"].tolist() == [3]
+    assert cells["cell_height"] == 45.0
+    assert cells["cell_width"] == 45.0
+
+
+def new_events(json_data, event_ids):
+    return [
+        {**json_data[event_id - 5], "event_id": event_id, "area": event_id}
+        for event_id in event_ids
+    ]
+
+
+def test_with_events(db_client, json_data):
+    events = new_events(json_data, [6, 7])
+    events[0]["start"] = "2021-12-31T00:00:00+00:00"
+    events[0]["start_time"] = 1640908800
+
+    client = db_client.with_events(events)
+
+    def event_ids(client, filters):
+        _, results = client.query_events(
+            filters=filters, limit=None, fields=["event_id"], columnar=True
+        )
+        return results["event_id"]
+
+    assert event_ids(client, [["area", "gt", "4"]]) == [5, 6, 7]
+    assert event_ids(client, [["location", "near", "2,2,10"]]) == [2, 7]
+    assert event_ids(db_client, [["area", "gt", "4"]]) == [5]
+    assert client.get_event_by_id(7)["area"] == 7
+    assert db_client.get_event_by_id(7) is None
+
+    statistics = client.event_statistics([["area", "gte", "6"]])
+    assert statistics["count"] == 2
+    assert statistics["first_start_time"] == 1640908800
+    first_day, counts = client.count_events_per_day([])
+    assert counts.sum() == 7
+
+    assert client.matches_any((("area", "gt", 6.0),), start=5)
+    assert not client.matches_any((("area", "lt", 6.0),), start=5)
+
+
+def test_compacted_db_client(data_frame, json_data):
+    db_client = DataFrameDBClient(df=data_frame, compaction="float32")
+
+    usage = db_client.memory_usage()
+    assert usage.loc[("events", "length"), "dtype"] == "int8"
+    assert usage.loc[("events", "start"), "dtype"] == "datetime64[ns, UTC]"
+    assert usage.loc[("events", "start_time"), "dtype"] == "int64"
+    assert db_client.query_events(
+        filters=[["length", "gte", "2.5"]], limit=None, fields=["event_id"]
+    ) == (3, [{"event_id": 3}, {"event_id": 4}, {"event_id": 5}])
+    assert db_client.get_event_by_id(3)["start"].isoformat() == json_data[3]["start"]
+
+    # lengths beyond int8 widen the column
+    events = new_events(json_data, [6, 7])
+    events[1]["length"] = 1000
+    client = db_client.with_events(events)
+
+    assert client.df["length"].dtype == np.int16
+    _, results = client.query_events(
+        filters=[["length", "gt", "200"]], limit=None, fields=["event_id", "length"]
+    )
+    assert results == [{"event_id": 7, "length": 1000}]
+    assert db_client.df["length"].dtype == np.int8
+
+
+@pytest.mark.parametrize("compaction", ["none", "lossless"])
+@pytest.mark.parametrize("operator", ["lt", "lte", "gt", "gte", "eq", "neq"])
+@pytest.mark.parametrize("value", ["2.5", "3", "-1000.5", "1000", "nan"])
+def test_query_integer_column_by_float(data_frame, compaction, operator, value):
+    db_client = DataFrameDBClient(df=data_frame, compaction=compaction)
+    expected = data_frame[OPERATOR_MAP[operator](data_frame["length"], float(value))]
+
+    count, results = db_client.query_events(
+        filters=[["length", operator, value]], limit=None, fields=["event_id"]
+    )
+
+    assert results == expected[["event_id"]].to_dict("records")
+    assert db_client.count_events([["length", operator, value]]) == count
+
+
+def test_db_client_invalid_compaction(data_frame):
+    with pytest.raises(ValueError):
+        DataFrameDBClient(df=data_frame, compaction="int4")
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"event_id": 3},
+        {"area": "large"},
+        {"unknown": 1},
+    ],
+)
+def test_with_events_invalid(db_client, json_data, change):
+    [event] = new_events(json_data, [6])
+
+    with pytest.raises(ValueError):
+        db_client.with_events([{**event, **change}])
+
+    with pytest.raises(ValueError):
+        db_client.with_events([{k: v for k, v in event.items() if k != "area"}])
+
+
+def test_query_invalid_filter(db_client):
+    with pytest.raises(ValueError):
+        db_client.query_events(filters=[["meanLat", "gt", 1]], limit=None)
+
+    with pytest.raises(ValueError):
+        db_client.query_events(filters=[["area", "between", 1]], limit=None)
+
+
+def test_query_unknown_field(db_client):
+    with pytest.raises(KeyError):
+        db_client.query_events(filters=[], limit=None, fields=["unknown"])
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        [],
+        [["area", "gt", "2"]],
+        [["area", "gt", "2"], ["area", "neq", "4"]],
+        [["area", "gte", "2"], ["severity_index", "lt", "5"]],
+        [["length", "eq", "9"]],
+        [["location", "near", "2,2,200"], ["area", "lt", "4"]],
+    ],
+)
+def test_count_events(db_client, filters):
+    count, _ = db_client.query_events(filters=filters, limit=None)
+    estimate = db_client.estimate_count(filters)
+
+    assert db_client.count_events(filters) == count
+    assert estimate["lower"] <= count <= estimate["upper"]
+    assert estimate["lower"] <= estimate["count"] <= estimate["upper"]
+
+
+def test_estimate_count(db_client):
+    # exact for a single field
+    assert db_client.estimate_count([["area", "gt", "1"], ["area", "lt", "5"]]) == {
+        "count": 3,
+        "lower": 3,
+        "upper": 3,
+    }
+    # 4 of 5 and 3 of 5 events, at least 2 and at most 3 of them match both
+    assert db_client.estimate_count(
+        [["area", "gt", "1"], ["severity_index", "lt", "4"]]
+    ) == {"count": 2, "lower": 2, "upper": 3}
+
+
+def test_count_events_invalid(db_client):
+    with pytest.raises(ValueError):
+        db_client.count_events([["area", "between", "1"]])
+
+    with pytest.raises(ValueError):
+        db_client.estimate_count([["meanLat", "gt", "1"]])
+
+
+def test_count_events_per_day(db_client):
+    first_day, counts = db_client.count_events_per_day(filters=[])
+    assert first_day == 18993  # 2022-01-01
+    assert len(counts) == 365
+    assert np.flatnonzero(counts).tolist() == [0, 32, 61, 93, 124]
+
+    _, filtered_counts = db_client.count_events_per_day(
+        filters=[["severity_index", "gt", 2.5]]
+    )
+    assert np.flatnonzero(filtered_counts).tolist() == [61, 93, 124]
+
+
+def test_count_events_per_bin(db_client):
+    resolution, bin_starts, counts = db_client.count_events_per_bin(
+        filters=[], resolution="month"
+    )
+    assert resolution == "month"
+    assert len(bin_starts) == 5
+    assert bin_starts[0] == 1640995200  # 2022-01-01
+    assert counts.tolist() == [1, 1, 1, 1, 1]
+
+    resolution, bin_starts, counts = db_client.count_events_per_bin(
+        filters=[["severity_index", "gt", 2.5]],
+        start="2022-01-15T00:00:00Z",
+        end="2022-06-01T00:00:00Z",
+        bins=10,
+    )
+    assert resolution == "month"
+    assert bin_starts[0] == 1640995200
+    assert counts.tolist() == [0, 0, 1, 1, 1]
+
+    _, _, counts = db_client.count_events_per_bin(
+        filters=[["area", "gte", 2]],
+        resolution="hour",
+        start="2022-02-01T23:00:00Z",
+        end="2022-02-02T02:00:00Z",
+    )
+    assert counts.tolist() == [0, 1, 0]
+
+
+@pytest.mark.parametrize(
+    "resolution, start, end",
+    [
+        ("decade", "", ""),
+        ("hour", "1900-01-01T00:00:00Z", "2100-01-01T00:00:00Z"),
+        ("day", "2022-03-01T00:00:00Z", "2022-02-01T00:00:00Z"),
+    ],
+)
+def test_count_events_per_bin_invalid(db_client, resolution, start, end):
+    with pytest.raises(ValueError):
+        db_client.count_events_per_bin(
+            filters=[], resolution=resolution, start=start, end=end
+        )
+
+
+def test_event_statistics(db_client):
+    assert db_client.event_statistics(filters=[]) == {
+        "count": 5,
+        "first_start_time": 1640995200,
+        "last_start_time": 1651708800,
+        "area": 3,
+        "length": 3,
+        "severity_index": 3,
+    }
+
+    assert db_client.event_statistics(
+        filters=[["area", "gt", 2.5], ["start_time", "lt", "2022-05-05T00:00:00+00:00"]]
+    ) == {
+        "count": 2,
+        "first_start_time": 1646265600,
+        "last_start_time": 1649030400,
+        "area": 3.5,
+        "length": 3.5,
+        "severity_index": 3.5,
+    }
+
+    assert db_client.event_statistics(filters=[["area", "gt", 5]])["count"] == 0
+
+
+def test_query_columnar(db_client):
+
+    count, result = db_client.query_events(
+        filters=[["severity_index", "gt", 3]],
+        limit=9999,
+        fields=["event_id", "area"],
+        columnar=True,
+    )
+
+    assert count == 2
+
+    assert result == {"event_id": [4, 5], "area": [4, 5]}
+
+
+def test_stream_query_events(db_client):
+
+    count, chunks = db_client.stream_query_events(
+        filters=[["severity_index", "gt", 1]],
+        limit=None,
+        fields=["event_id"],
+        chunk_size=3,
+    )
+
+    assert count == 4
+
+    assert list(chunks) == [
+        [{"event_id": 2}, {"event_id": 3}, {"event_id": 4}],
+        [{"event_id": 5}],
+    ]
+
+
+def test_stream_query_events_no_filters_with_limit(db_client):
+
+    count, chunks = db_client.stream_query_events(
+        filters=[], limit=3, fields=["event_id"], chunk_size=2
+    )
+
+    assert count == 5
+
+    assert list(chunks) == [[{"event_id": 1}, {"event_id": 2}], [{"event_id": 3}]]
+
+
+def test_query_sorted_desc_with_limit(db_client):
+    assert db_client.query_events(
+        filters=[["area", "lt", "5"]],
+        limit=2,
+        fields=["event_id"],
+        sort_by="length",
+        order="desc",
+    ) == (4, [{"event_id": 4}, {"event_id": 3}])
+
+
+def test_query_sorted_ties_and_nan_values(data_frame):
+    data_frame["area"] = [2, np.nan, 1, 2, 1]
+    db_client = DataFrameDBClient(df=data_frame)
+
+    for order, expected in (("asc", [3, 5, 1, 4, 2]), ("desc", [1, 4, 3, 5, 2])):
+        event_ids, cursor = [], None
+
+        # pages of two, ties ordered by row and rows without area last
+        for _ in range(3):
+            _, results, cursor = db_client.query_events(
+                filters=[],
+                limit=2,
+                fields=["event_id"],
+                sort_by="area",
+                order=order,
+                cursor=cursor,
+                return_cursor=True,
+            )
+            event_ids += [result["event_id"] for result in results]
+
+        assert event_ids == expected
+        assert cursor is None
+
+
+def test_query_pages_in_storage_order(db_client):
+    count, results, cursor = db_client.query_events(
+        filters=[["area", "neq", "2"]],
+        limit=2,
+        fields=["event_id"],
+        return_cursor=True,
+    )
+    assert (count, results) == (4, [{"event_id": 1}, {"event_id": 3}])
+
+    assert db_client.query_events(
+        filters=[["area", "neq", "2"]],
+        limit=2,
+        fields=["event_id"],
+        cursor=cursor,
+        return_cursor=True,
+    ) == (4, [{"event_id": 4}, {"event_id": 5}], None)
+
+
+def test_query_sort_by_unknown_field(db_client):
+    with pytest.raises(ValueError):
+        db_client.query_events(filters=[], limit=None, sort_by="meanLat")
@@ -0,0 +1,183 @@
+import numpy as np
+import pytest
+from app.spatial import (
+    GridIndex,
+    aggregate_cells,
+    bounding_box,
+    cell_dimensions,
+    distance_km,
+    geohash_names,
+    location_mask,
+)
+
+
+def test_distance_km():
+    # Berlin to Munich
+    assert distance_km(52.52, 13.405, 48.137, 11.575) == pytest.approx(504, abs=1)
+
+
+def test_bounding_box_holds_circle():
+    rng = np.random.default_rng(0)
+    latitude, longitude = rng.uniform(59, 61, 10000), rng.uniform(9, 11, 10000)
+
+    near = location_mask("near", (60.0, 10.0, 50.0), latitude, longitude)
+    in_box = location_mask(
+        "within", bounding_box("near", (60.0, 10.0, 50.0)), latitude, longitude
+    )
+
+    assert near.any()
+    assert not (near & ~in_box).any()
+
+
+@pytest.mark.parametrize(
+    "center",
+    [
+        # beyond a hemisphere, around the north pole and the south pole
+        (50.0, 8.0, 20000.0),
+        (50.0, 8.0, 9000.0),
+        (80.0, 8.0, 2000.0),
+        (-85.0, 100.0, 1000.0),
+        # across the antimeridian
+        (0.0, 179.0, 500.0),
+    ],
+)
+def test_bounding_box_holds_large_circles(center):
+    rng = np.random.default_rng(4)
+    latitude, longitude = rng.uniform(-90, 90, 20000), rng.uniform(-180, 180, 20000)
+
+    near = location_mask("near", center, latitude, longitude)
+    in_box = location_mask("within", bounding_box("near", center), latitude, longitude)
+    index = GridIndex(latitude, longitude, rows_per_cell=16)
+
+    assert near.any()
+    assert not (near & ~in_box).any()
+    assert index.positions("near", center).tolist() == np.flatnonzero(near).tolist()
+
+
+@pytest.mark.parametrize(
+    "operator,value",
+    [
+        ("within", (48.0, 7.0, 50.5, 9.5)),
+        ("within", (47.0, 5.0, 56.0, 16.0)),
+        ("within", (10.0, 10.0, 20.0, 20.0)),
+        ("within", (49.0, 8.0, 49.0, 8.0)),
+        ("near", (51.0, 10.0, 80.0)),
+        ("near", (55.0, 15.0, 300.0)),
+        ("near", (51.0, 10.0, 0.0)),
+    ],
+)
+def test_grid_index_matches_scan(operator, value):
+    rng = np.random.default_rng(1)
+    latitude = np.round(rng.uniform(47.3, 55.0, 5000), 1)
+    longitude = np.round(rng.uniform(5.9, 15.0, 5000), 1)
+    latitude[::50] = np.nan
+
+    index = GridIndex(latitude, longitude, rows_per_cell=16)
+    expected = np.flatnonzero(location_mask(operator, value, latitude, longitude))
+
+    assert index.positions(operator, value).tolist() == expected.tolist()
+    assert index.count(operator, value) >= len(expected)
+
+
+@pytest.mark.parametrize(
+    "operator,value",
+    [
+        ("within", (48.0, 7.0, 50.5, 9.5)),
+        ("within", (40.0, 0.0, 60.0, 30.0)),
+        ("near", (55.0, 15.0, 300.0)),
+        ("near", (58.0, 20.0, 100.0)),
+    ],
+)
+def test_extended_grid_index_matches_scan(operator, value):
+    rng = np.random.default_rng(3)
+    latitude = np.round(rng.uniform(47.3, 55.0, 6000), 1)
+    longitude = np.round(rng.uniform(5.9, 15.0, 6000), 1)
+    # added locations partly lie beyond the grid of the first ones
+    latitude[4000:] += 3
+    longitude[5000:] += 5
+    latitude[::70] = np.nan
+
+    index = GridIndex(latitude[:4000], longitude[:4000], rows_per_cell=16)
+    index = index.extended(latitude[4000:5000], longitude[4000:5000], offset=4000)
+    index = index.extended(latitude[5000:], longitude[5000:], offset=5000)
+    expected = np.flatnonzero(location_mask(operator, value, latitude, longitude))
+
+    assert len(index) == (~np.isnan(latitude)).sum()
+    assert index.positions(operator, value).tolist() == expected.tolist()
+    assert index.count(operator, value) >= len(expected)
+
+
+def test_grid_index_empty():
+    index = GridIndex(np.zeros(0), np.zeros(0))
+
+    assert len(index) == 0
+    assert index.positions("within", (0.0, 0.0, 1.0, 1.0)).tolist() == []
+
+
+@pytest.mark.parametrize("cell_size,geohash", [(0.5, None), (3.0, None), (None, 2)])
+def test_aggregate_cells_matches_scan(cell_size, geohash):
+    rng = np.random.default_rng(2)
+    latitude, longitude = rng.uniform(47, 55, 3000), rng.uniform(5, 15, 3000)
+    latitude[::40] = np.nan
+    severity_index = rng.uniform(0, 10, 3000)
+    severity_index[::7] = np.nan
+
+    cell_height, cell_width = cell_dimensions(cell_size, geohash)
+    rows, columns, counts, [(sums, valid_counts)] = aggregate_cells(
+        latitude, longitude, cell_height, cell_width, [severity_index]
+    )
+
+    assert counts.sum() == (~np.isnan(latitude)).sum()
+    for row, column, count, total, valid_count in zip(
+        rows, columns, counts, sums, valid_counts
+    ):
+        in_cell = location_mask(
+            "within",
+            (
+                row * cell_height - 90,
+                column * cell_width - 180,
+                (row + 1) * cell_height - 90,
+                (column + 1) * cell_width - 180,
+            ),
+            latitude,
+            longitude,
+        )
+        # locations on the edge between two cells belong to the upper one
+        assert count <= in_cell.sum()
+        assert valid_count == (in_cell & ~np.isnan(severity_index)).sum()
+        assert total == pytest.approx(np.nansum(severity_index[in_cell]))
+
+
+def test_aggregate_cells_sparse():
+    # far apart cells are binned by their unique keys instead of directly
+    rows, columns, counts, _ = aggregate_cells(
+        np.array([-89.995, 89.995, -89.995]),
+        np.array([-179.995, 179.995, -179.995]),
+        0.01,
+        0.01,
+    )
+
+    assert rows.tolist() == [0, 17999]
+    assert columns.tolist() == [0, 35999]
+    assert counts.tolist() == [2, 1]
+
+
+def test_geohash_names():
+    cell_height, cell_width = cell_dimensions(geohash=11)
+    rows, columns, _, _ = aggregate_cells(
+        np.array([57.64911, -90.0]),
+        np.array([10.40744, 180.0]),
+        cell_height,
+        cell_width,
+    )
+
+    assert geohash_names(rows, columns, 11) == ["pbpbpbpbpbp", "u4pruydqqvj"]
+
+
+@pytest.mark.parametrize(
+    "cell_size,geohash",
+    [(None, None), (1.0, 3), (0.0, None), (200.0, None), (None, 13)],
+)
+def test_cell_dimensions_invalid(cell_size, geohash):
+    with pytest.raises(ValueError):
+        cell_dimensions(cell_size, geohash)
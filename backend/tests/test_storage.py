@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.models import DataFrameDBClient
+from app import storage
+from app.storage import (
+    columnar_attributes,
+    load_columnar,
+    save_columnar,
+    share_columnar,
+)
+
+
+@pytest.fixture()
+def data_frame():
+    start = pd.date_range("2022-01-01", periods=5, freq="10D", tz="Europe/Berlin")
+
+    return pd.DataFrame(
+        {
+            "event_id": [5, 3, 1, 4, 2],
+            "area": [5.0, 3.0, 1.0, 4.0, 2.0],
+            "length": [5, 3, 1, 4, 2],
+            "severity_index": [0.5, 0.3, 0.1, 0.4, 0.2],
+            "start": start,
+            "start_time": start.asi8 // 10**9,
+            "timeseries": [[{"index": i}] for i in range(5)],
+        },
+        index=range(10, 15),
+    )
+
+
+def test_columnar_roundtrip(data_frame, tmp_path):
+    save_columnar(
+        data_frame,
+        tmp_path,
+        indexes={"area_order": np.array([2, 4, 1, 3, 0]), "bounds": {"area": (1, 5)}},
+    )
+
+    df, indexes = load_columnar(tmp_path)
+
+    pd.testing.assert_frame_equal(df, data_frame, check_index_type=False)
+    assert indexes["area_order"].tolist() == [2, 4, 1, 3, 0]
+    assert indexes["bounds"] == {"area": (1, 5)}
+
+
+def test_columnar_categoricals(tmp_path):
+    data_frame = pd.DataFrame({"kind": pd.Categorical(["b", "a", "b", None])})
+    save_columnar(data_frame, tmp_path)
+
+    df, _ = load_columnar(tmp_path)
+
+    pd.testing.assert_frame_equal(df, data_frame, check_index_type=False)
+    assert isinstance(df["kind"].array.codes.base.base, np.memmap)
+
+
+def test_db_client_maps_columnar_without_compacting(data_frame, tmp_path):
+    DataFrameDBClient(df=data_frame).save(tmp_path / "wide")
+    DataFrameDBClient(df=data_frame, compaction="lossless").save(tmp_path / "compact")
+
+    wide = DataFrameDBClient(compaction="lossless")
+    wide.initialize_database_from_path(dataset_path=str(tmp_path / "wide"))
+    compact = DataFrameDBClient(compaction="none")
+    compact.initialize_database_from_path(dataset_path=str(tmp_path / "compact"))
+
+    # the columns stay mapped as they were written
+    assert wide.df["length"].dtype == np.int64
+    assert isinstance(wide._df["length"].values.base, np.memmap)
+    assert compact.df["length"].dtype == np.int8
+    assert compact.memory_usage().loc[("events", "length"), "dtype"] == "int8"
+    assert wide.compacted("lossless").df["length"].dtype == np.int8
+
+
+def test_columnar_columns_are_memory_mapped(data_frame, tmp_path):
+    save_columnar(data_frame, tmp_path)
+
+    df, _ = load_columnar(tmp_path)
+
+    assert isinstance(df["area"].values.base, np.memmap)
+    assert not df["area"].values.flags.writeable
+
+
+def test_db_client_from_columnar(data_frame, tmp_path):
+    DataFrameDBClient(df=data_frame).save(tmp_path)
+
+    db_client = DataFrameDBClient()
+    db_client.initialize_database_from_path(dataset_path=str(tmp_path))
+
+    assert db_client.query_events(
+        filters=[["area", "gt", 2]], limit=None, fields=["event_id"]
+    ) == (3, [{"event_id": 5}, {"event_id": 3}, {"event_id": 4}])
+    assert db_client.get_event_by_id(1)["timeseries"] == [{"index": 2}]
+
+    # copies of the read-only columns can still be written to
+    snapshot = db_client.df.copy()
+    snapshot.loc[10, "area"] = 99
+    assert db_client.df.loc[10, "area"] == 5
+
+
+def test_columnar_objects_map_their_arrays(data_frame, tmp_path):
+    save_columnar(data_frame, tmp_path, indexes={"sums": {"area": np.arange(5.0)}})
+
+    _, indexes = load_columnar(tmp_path)
+
+    assert indexes["sums"]["area"].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert not indexes["sums"]["area"].flags.writeable
+
+
+def test_share_columnar_converts_once(data_frame, tmp_path):
+    source = tmp_path / "dataset.df.pickle"
+    data_frame.to_pickle(source)
+    conversions = []
+
+    def convert(source_path, directory):
+        conversions.append(source_path)
+        save_columnar(pd.read_pickle(source_path), directory)
+
+    directory = str(tmp_path / "shared")
+    assert share_columnar(str(source), directory, convert) == directory
+    share_columnar(str(source), directory, convert)
+    assert len(conversions) == 1
+
+    # a changed source is converted again
+    data_frame.iloc[:2].to_pickle(source)
+    share_columnar(str(source), directory, convert)
+
+    df, _ = load_columnar(directory)
+    assert len(conversions) == 2
+    assert len(df) == 2
+
+
+def test_share_columnar_converts_other_versions_again(
+    data_frame, tmp_path, monkeypatch
+):
+    source = tmp_path / "dataset.df.pickle"
+    data_frame.to_pickle(source)
+    conversions = []
+
+    def convert(source_path, directory):
+        conversions.append(source_path)
+        save_columnar(pd.read_pickle(source_path), directory)
+
+    directory = str(tmp_path / "shared")
+    share_columnar(str(source), directory, convert, attributes={"compaction": "none"})
+    share_columnar(str(source), directory, convert, attributes={"compaction": "none"})
+    assert len(conversions) == 1
+
+    share_columnar(
+        str(source), directory, convert, attributes={"compaction": "float32"}
+    )
+    assert len(conversions) == 2
+
+    monkeypatch.setattr(storage, "FORMAT_VERSION", storage.FORMAT_VERSION + 1)
+    share_columnar(
+        str(source), directory, convert, attributes={"compaction": "float32"}
+    )
+    assert len(conversions) == 3
+
+
+def test_columnar_indexes_of_other_versions(data_frame, tmp_path, monkeypatch):
+    save_columnar(
+        data_frame,
+        tmp_path,
+        indexes={"order": np.arange(5), "bounds": {"area": (1, 5)}},
+        attributes={"compaction": "lossless"},
+    )
+    monkeypatch.setattr(storage, "FORMAT_VERSION", storage.FORMAT_VERSION + 1)
+
+    _, indexes = load_columnar(tmp_path)
+
+    # pickled objects may not fit the current classes, arrays still do
+    assert list(indexes) == ["order"]
+    assert columnar_attributes(tmp_path) == {"compaction": "lossless"}
+
+
+def test_db_client_from_shared_directory(data_frame, tmp_path):
+    source = tmp_path / "dataset.df.pickle"
+    data_frame.to_pickle(source, compression={"method": "gzip", "compresslevel": 1})
+
+    db_client = DataFrameDBClient()
+    db_client.initialize_database_from_path(
+        dataset_path=str(source), shared_directory=str(tmp_path / "shared")
+    )
+
+    assert isinstance(db_client._df["area"].values.base, np.memmap)
+    assert db_client.get_event_by_id(4)["timeseries"] == [{"index": 3}]
+    assert db_client.count_events_per_day([["area", "gt", "2"]])[1].sum() == 3
@@ -0,0 +1,54 @@
+import numpy as np
+from app.models import DataFrameDBClient
+from app.synthetic import generate_dataset
+from fastapi.encoders import jsonable_encoder
+
+
+def test_synthetic_events_match_dataset_shape():
+    events, timeseries = generate_dataset(1000, seed=1)
+
+    assert list(events.columns) == [
+        "event_id",
+        "area",
+        "length",
+        "severity_index",
+        "start",
+        "start_time",
+        "meanLat",
+        "meanLon",
+        "meanPrec",
+        "maxPrec",
+    ]
+    assert len(events) == len(timeseries) == 1000
+    assert events["start_time"].is_monotonic_increasing
+    assert (events["length"] >= 1).all()
+    assert [len(timeseries.records(i)) for i in range(1000)] == events[
+        "length"
+    ].tolist()
+
+
+def test_synthetic_dataset_is_deterministic():
+    first, _ = generate_dataset(200, seed=3)
+    second, _ = generate_dataset(200, seed=3)
+    other, _ = generate_dataset(200, seed=4)
+
+    assert first.equals(second)
+    assert not np.array_equal(first["area"], other["area"])
+
+
+def test_synthetic_event_detail_is_serializable():
+    events, timeseries = generate_dataset(50)
+    db_client = DataFrameDBClient(df=events, timeseries=timeseries)
+
+    event = jsonable_encoder(db_client.get_event_by_id(7))
+
+    assert event["event_id"] == 7
+    assert len(event["timeseries"]) == event["length"]
+    assert set(event["timeseries"][0]) == {
+        "latitude",
+        "longitude",
+        "area",
+        "severity_index",
+        "date",
+        "index",
+    }
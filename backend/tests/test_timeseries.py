@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+from app.models import DataFrameDBClient
+from app.timeseries import TimeseriesStore
+
+
+def hourly_records(event_id, hours):
+    return [
+        {
+            "latitude": 50.0 + hour,
+            "longitude": 10.0 + hour,
+            "area": float(event_id),
+            "severity_index": 0.5 * hour,
+            "date": f"2022-01-0{event_id}T0{hour}:00:00",
+            "index": hour,
+        }
+        for hour in range(hours)
+    ]
+
+
+@pytest.fixture()
+def timeseries():
+    return [hourly_records(1, 2), [], hourly_records(3, 3)]
+
+
+def test_timeseries_store_slices_single_events(timeseries):
+    store = TimeseriesStore.from_lists(timeseries)
+
+    assert len(store) == 3
+    assert [store.records(i) for i in range(3)] == timeseries
+
+
+def test_extended_timeseries_store(timeseries):
+    store = TimeseriesStore.from_lists(timeseries[:2])
+    extended = store.extended(timeseries[2:]).extended([[]])
+
+    assert len(store) == 2
+    assert len(extended) == 4
+    assert [extended.records(i) for i in range(4)] == timeseries + [[]]
+
+
+def test_timeseries_store_roundtrip(timeseries, tmp_path):
+    TimeseriesStore.from_lists(timeseries).save(tmp_path)
+
+    store = TimeseriesStore.load(tmp_path)
+
+    assert store.records(2) == timeseries[2]
+    assert TimeseriesStore.load(tmp_path / "missing") is None
+
+
+def test_db_client_keeps_timeseries_out_of_line(timeseries):
+    db_client = DataFrameDBClient(
+        df=pd.DataFrame(
+            {
+                "event_id": [1, 2, 3],
+                "area": [1.0, 2.0, 3.0],
+                "length": [2, 0, 3],
+                "severity_index": [1.0, 2.0, 3.0],
+                "start": pd.date_range("2022-01-01", periods=3, tz="UTC"),
+                "start_time": [1640995200, 1641081600, 1641168000],
+                "timeseries": timeseries,
+            }
+        )
+    )
+
+    assert "timeseries" not in db_client.df.columns
+    assert db_client.get_event_by_id(3)["timeseries"] == timeseries[2]
+    assert db_client.get_event_by_id(2)["timeseries"] == []
+
+
+def test_compacted_timeseries_store(timeseries):
+    store = TimeseriesStore.from_lists(timeseries).compacted()
+
+    usage = store.memory_usage()
+    assert usage.loc["latitude", "dtype"] == "float32"
+    assert usage.loc["index", "dtype"] == "int8"
+    assert usage.loc["date", "dtype"] == "datetime64[ns]"
+
+    records = store.records(2)
+    for record in records:
+        record["date"] = record["date"].isoformat()
+    assert records == timeseries[2]
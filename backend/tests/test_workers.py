@@ -0,0 +1,48 @@
+import asyncio
+import threading
+
+import pytest
+from app.workers import PoolSaturatedError, WorkerPool
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_runs_blocking_calls():
+    pool = WorkerPool(max_workers=2, max_queued=0)
+
+    assert await pool.run(sorted, [3, 1, 2], reverse=True) == [3, 2, 1]
+    assert pool.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_rejects_calls_when_saturated():
+    pool = WorkerPool(max_workers=1, max_queued=1)
+    release = threading.Event()
+
+    running = asyncio.ensure_future(pool.run(release.wait))
+    queued = asyncio.ensure_future(pool.run(release.wait))
+    await asyncio.sleep(0)
+
+    with pytest.raises(PoolSaturatedError):
+        await pool.run(release.wait)
+
+    release.set()
+    assert await asyncio.gather(running, queued) == [True, True]
+    assert pool.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_queues_admitted_calls_when_saturated():
+    pool = WorkerPool(max_workers=1, max_queued=0)
+    release = threading.Event()
+
+    running = asyncio.ensure_future(pool.run(release.wait))
+    admitted = asyncio.ensure_future(pool.run_admitted(release.wait))
+    await asyncio.sleep(0)
+
+    assert pool.pending == 2
+    with pytest.raises(PoolSaturatedError):
+        await pool.run(release.wait)
+
+    release.set()
+    assert await asyncio.gather(running, admitted) == [True, True]
+    assert pool.pending == 0
@@ -8,6 +8,7 @@ import {
 } from "../recoil/atoms";
 import { filtersToQueryParamsState } from "../recoil/selectors";
 import { DefaultApi as Api } from "../client";
+import { columnsToRecords } from "../util";
 import Highcharts from "highcharts";
 import Highstock from "highcharts/highstock";
 import Exporting from "highcharts/modules/exporting";
@@ -263,10 +264,13 @@ export default function ButtonToggleHistogramTimeline() {
   async function timelineFetchDataAndMakePlot() {
     const response = await Api.queryQueryGet({
       filterParams: queryFiltersAsParams,
+      format: "columns",
     });
 
     // sort results by start time (posix timestamp in ms)
-    let results = response.results.sort((a, b) => a.start_time - b.start_time);
+    let results = columnsToRecords(response).sort(
+      (a, b) => a.start_time - b.start_time
+    );
     let numResults = results.length;
 
     let multiSeriesData = [
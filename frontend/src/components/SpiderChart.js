@@ -13,45 +13,41 @@ export default function SpiderChart() {
   const intervalB = useRecoilValue(intervalAtoms(1));
 
   const fetchData = async () => {
-    let data = [];
-
-    let globalReferenceRange = await Api.spiderSpiderGet({
-      start: null,
-      end: null,
-      filterParams: filters,
-    });
-
-    data.push({
-      ...globalReferenceRange,
-      name: "Global Reference",
-      color: "orange",
-    });
+    let ranges = [{ name: "Global Reference", color: "orange", interval: "/" }];
 
     if (intervalA && intervalA.startDate && intervalA.endDate) {
-      data.push({
-        ...(await Api.spiderSpiderGet({
-          start: new Date(intervalA.startDate).toISOString(),
-          end: new Date(intervalA.endDate).toISOString(),
-          filterParams: filters,
-        })),
+      ranges.push({
         name: "Interval A",
         color: "blue",
+        interval:
+          new Date(intervalA.startDate).toISOString() +
+          "/" +
+          new Date(intervalA.endDate).toISOString(),
       });
     }
 
     if (intervalB && intervalB.startDate && intervalB.endDate) {
-      data.push({
-        ...(await Api.spiderSpiderGet({
-          start: new Date(intervalB.startDate).toISOString(),
-          end: new Date(intervalB.endDate).toISOString(),
-          filterParams: filters,
-        })),
+      ranges.push({
         name: "Interval B",
         color: "green",
+        interval:
+          new Date(intervalB.startDate).toISOString() +
+          "/" +
+          new Date(intervalB.endDate).toISOString(),
       });
     }
 
-    return data;
+    // fetch the values of all ranges in a single request
+    const values = await Api.spiderBatchSpiderBatchGet({
+      intervals: ranges.map((range) => range.interval),
+      filterParams: filters,
+    });
+
+    return ranges.map((range, i) => ({
+      ...values[i],
+      name: range.name,
+      color: range.color,
+    }));
   };
 
   const makePlot = (data) => {
@@ -42,8 +42,7 @@ export default function FilterModal() {
 
   const getNumResults = () => {
     const getData = ({ requestBody }) => {
-      return Api.queryQueryGet({
-        limit: 0,
+      return Api.countCountGet({
         filterParams: filtersToQueryParams,
       });
     };
@@ -1,6 +1,6 @@
 import { selector, selectorFamily } from "recoil";
 import { filtersAtom } from "./atoms";
-import _ from "../util";
+import _, { columnsToRecords } from "../util";
 import dayjs from "dayjs";
 import { DefaultApi as Api } from "../client";
 
@@ -29,7 +29,7 @@ export const filteredEventsState = selectorFamily({
   get:
     ({ filterParams }) =>
     async () =>
-      (
+      columnsToRecords(
         await Api.queryQueryGet({
           filterParams: filterParams,
           fields: [
@@ -43,6 +43,7 @@ export const filteredEventsState = selectorFamily({
             "meanPrec",
             "maxPrec",
           ],
+          format: "columns",
         }).catch((err) => console.log(err))
-      ).results,
+      ),
 });
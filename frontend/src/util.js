@@ -48,4 +48,22 @@ export const OPERATORS = {
   neq: "≠",
 };
 
+// Turn a columnar /query response ({ count, columns: { field: [values] } })
+// back into the list of records the regular response contains
+export const columnsToRecords = ({ columns }) => {
+  const fields = Object.keys(columns);
+  const numRecords = fields.length ? columns[fields[0]].length : 0;
+  const records = new Array(numRecords);
+
+  for (let i = 0; i < numRecords; i++) {
+    const record = {};
+    for (const field of fields) {
+      record[field] = columns[field][i];
+    }
+    records[i] = record;
+  }
+
+  return records;
+};
+
 export default constants;